@@ -0,0 +1,372 @@
+""" Benchmarks for the performance-sensitive parts of GroceryHelper. Each benchmark builds its own synthetic data in a
+    temporary database, so they don't need an existing grocery_db.sqlite or make any API calls. The spatial, catalog and
+    models benchmarks do load keys.py (or the keys from the environment), like the web app, though they never use them.
+
+    Usage: python3 benchmarks.py <benchmark> [--rows N]
+"""
+
+import argparse
+import math
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+import tracemalloc
+from database import ConnectionPool, DatabaseAccessor, DatabaseCreator, StoreInfoAccessor, LocationInfoAccessor, FoodItemInfoAccessor
+from models import Store, Location, FoodItem
+import supermarket_xml
+
+
+def use_temp_database():
+    """ Points the database accessors at a new, empty database in a temporary directory.
+        :return: the path to the database file - string
+    """
+    path = os.path.join(tempfile.mkdtemp(), DatabaseAccessor.FILENAME)
+    DatabaseAccessor.DATABASE_PATH = path
+    DatabaseCreator().init_db()
+    return path
+
+
+def fill_stores(db, count, seed=0):
+    """ Saves synthetic stores spread across the continental US. ZIP codes roughly increase from east to west, like
+        real ones do, so ZIP code ranges behave a bit like they would with real data.
+        :param db: the database connection to use
+        :param count: the number of stores to create - int
+        :param seed: the random seed - int
+    """
+    rnd = random.Random(seed)
+    locations = list()
+    stores = list()
+    for i in range(1, count + 1):
+        zipcode = rnd.randint(1000, 99950)
+        longitude = -67 - 57*zipcode/99999 + rnd.uniform(-3, 3)
+        latitude = rnd.uniform(26, 48)
+        locations.append((i, '{} Main St'.format(i), 'Town{}'.format(i % 997), 'MA', zipcode, latitude, longitude, i))
+        stores.append((i, '{:x}'.format(1000000 + i), 'Store {}'.format(i), i))
+    db.executemany('INSERT INTO {} (id, street_address, city, state, zipcode, latitude, longitude, store_id) '
+                   'VALUES (?, ?, ?, ?, ?, ?, ?, ?)'.format(Location.DB_TABLE_NAME), locations)
+    db.executemany('INSERT INTO {} (id, store_id, name, location_id) VALUES (?, ?, ?, ?)'.format(Store.DB_TABLE_NAME), stores)
+    db.commit()
+
+
+def time_it(label, func, repeat):
+    """ Runs a function several times and prints how long it took on average.
+        :param label: what to call the function in the output - string
+        :param func: the function to run (takes the run number as its only argument)
+        :param repeat: the number of times to run it - int
+    """
+    start = time.perf_counter()
+    for i in range(repeat):
+        func(i)
+    duration = (time.perf_counter() - start) / repeat
+    print('{0: <40} {1:9.3f} ms'.format(label, duration*1000))
+
+
+def peak_memory(label, func):
+    """ Runs a function once and prints the most memory it had allocated at any one time.
+        :param label: what to call the function in the output - string
+        :param func: the function to run (takes no arguments)
+    """
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print('{0: <40} {1:9.1f} MB'.format(label, peak/1000000))
+
+
+def bench_spatial(rows):
+    """ Compares finding the stores near a user by ZIP code range (then checking the distance to each) with the
+        spatial index and the radius search of the store catalog.
+    """
+    from catalog import StoreCatalog  # Imported here as catalog needs keys.py (through geolocation)
+    fill_stores(StoreInfoAccessor().db, rows)
+    sia = StoreInfoAccessor()
+    lia = LocationInfoAccessor()
+    rnd = random.Random(1)
+    users = [sia.get_store(rnd.randint(1, rows)).location for _ in range(20)]
+
+    def zip_range(i):
+        user = users[i]
+        stores = sia.get_stores_in_zip_range(user.zipcode-200, user.zipcode+200)
+        # Same per-store great-circle check get_stores_near_me used to do
+        nearby = list()
+        for store in stores:
+            loc = store.location
+            a = math.sin(math.radians(loc.latitude - user.latitude)/2)**2 + \
+                math.cos(math.radians(user.latitude))*math.cos(math.radians(loc.latitude)) * \
+                math.sin(math.radians(loc.longitude - user.longitude)/2)**2
+            if 2*3958.8*math.asin(math.sqrt(a)) <= 20:
+                nearby.append(store)
+
+    def spatial_index(i):
+        user = users[i]
+        lia.get_locations_within_radius(user.latitude, user.longitude, 20, 10)
+
+    def radius(i):
+        user = users[i]
+        catalog.get_stores_within_radius(user.latitude, user.longitude, 20, 10)
+
+    catalog = StoreCatalog.get_catalog()
+    print('Nearby stores ({} stores in the database)'.format(rows))
+    time_it('ZIP code range scan', zip_range, len(users))
+    time_it('Spatial index', spatial_index, len(users))
+    time_it('Store catalog', radius, len(users))
+
+
+def bench_store_save(rows):
+    """ Compares saving downloaded stores one row at a time with saving them all in one transaction. """
+    def make_stores(start):
+        return [Store('{:x}'.format(start + i), 'Store {}'.format(i), Location('{} Main St'.format(i), 'Needham', 'MA', 2492))
+                for i in range(rows)]
+
+    sia = StoreInfoAccessor()
+    lia = LocationInfoAccessor(sia.db)
+
+    def one_at_a_time(_):
+        for store in make_stores(0):
+            lia.save_location(store.location)
+            sia.save_store(store)
+            store.location.store_id = store.id
+            lia.save_location(store.location)
+
+    def bulk(_):
+        sia.save_stores(make_stores(rows))
+
+    print('Saving {} stores'.format(rows))
+    time_it('One row at a time', one_at_a_time, 1)
+    time_it('One transaction', bulk, 1)
+    sia.use_write_ahead_log()
+    time_it('One transaction (WAL)', lambda _: sia.save_stores(make_stores(2*rows)), 1)
+
+
+def bench_food_search(rows):
+    """ Compares searching item names with a LIKE scan and with the full-text index. """
+    rnd = random.Random(2)
+    # Real product names use a big vocabulary, so any one search word only appears in a small share of them
+    filler = ['{}{}'.format(rnd.choice('bcdfghklmnprstvz'), rnd.randint(100, 99999)) for _ in range(5000)]
+    words = ['organic', 'butternut', 'squash', 'apple', 'juice', 'cashews', 'greek', 'yogurt', 'cheddar', 'cheese']
+    fia = FoodItemInfoAccessor()
+    items = list()
+    for i in range(rows):
+        name = [rnd.choice(filler) for _ in range(3)]
+        if rnd.random() < 0.05:
+            name.insert(rnd.randint(0, 3), rnd.choice(words))
+        items.append(FoodItem(i, ' '.join(name), None, None, None, None))
+    fia.save_items(items)
+    queries = ['squash', 'apple juice', 'cashews', 'greek yogurt', 'cheddar']
+
+    print('Food search ({} items in the database)'.format(rows))
+    time_it('LIKE scan', lambda i: fia.get_foods_by_name(queries[i % len(queries)]), 20)
+    time_it('Full-text index', lambda i: fia.search_foods(queries[i % len(queries)]), 20)
+    time_it('Full-text index (best 50)', lambda i: fia.search_foods(queries[i % len(queries)], 50), 20)
+
+
+def bench_xml_parse(rows):
+    """ Compares parsing big Supermarket API responses with untangle (which builds the whole document as objects) and
+        with the streaming parser.
+    """
+    header = '<?xml version="1.0" encoding="utf-8"?>\n<{} xmlns:xsd="http://www.w3.org/2001/XMLSchema" ' \
+             'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xmlns="http://www.SupermarketAPI.com">'
+    stores_xml = (header.format('ArrayOfStore') + ''.join(
+        '<Store><Storename>Store {0} </Storename><Address>{0} Main St </Address><City>Needham </City><State>MA </State>'
+        '<Zip>02492-{0:04} </Zip><Phone>(781) 555-{0:04}</Phone><StoreId>{1:x}</StoreId></Store>'.format(i % 10000, 1000000 + i)
+        for i in range(rows)) + '</ArrayOfStore>').encode('utf-8')
+    products_xml = (header.format('ArrayOfProduct') + ''.join(
+        '<Product><Itemname>Organic Apple Juice {0}</Itemname><ItemDescription>Organic apple juice, {0} oz bottle'
+        '</ItemDescription><ItemCategory>Beverages</ItemCategory><ItemID>{0}</ItemID><ItemImage>'
+        'http://www.SupermarketAPI.com/images/{0}.jpg</ItemImage><AisleNumber>Aisle:{1}</AisleNumber></Product>'.format(i, i % 20)
+        for i in range(rows)) + '</ArrayOfProduct>').encode('utf-8')
+
+    def untangle_stores():
+        # What StoreFetcher used to do
+        stores = list()
+        for elem in untangle.parse(stores_xml.decode('utf-8')).ArrayOfStore.Store:
+            zip_str = elem.Zip.cdata.strip()[:5]
+            loc = Location(elem.Address.cdata.strip(), elem.City.cdata.strip(), elem.State.cdata.strip(), int(zip_str) if zip_str else None)
+            stores.append(Store(elem.StoreId.cdata, elem.Storename.cdata.strip(), loc))
+        return stores
+
+    def untangle_has_products():
+        # What StoreItemFetcher.does_store_have_item used to do
+        foods = [{'category': item.ItemCategory.cdata, 'item_id': item.ItemID.cdata, 'name': item.Itemname.cdata}
+                 for item in untangle.parse(products_xml.decode('utf-8')).ArrayOfProduct.Product]
+        return len(foods) > 0
+
+    print('Parsing responses ({0} records, {1:0.1f} MB of stores, {2:0.1f} MB of products)'
+          .format(rows, len(stores_xml)/1000000, len(products_xml)/1000000))
+    try:
+        import untangle
+    except ImportError:
+        untangle = None
+        print('(untangle is not installed, so only the streaming parser is timed)')
+    if untangle:
+        time_it('Stores (untangle)', lambda _: untangle_stores(), 3)
+    time_it('Stores (streaming)', lambda _: list(supermarket_xml.iter_stores(stores_xml)), 3)
+    if untangle:
+        time_it('Has products (untangle)', lambda _: untangle_has_products(), 3)
+    time_it('Has products (streaming)', lambda _: supermarket_xml.has_products(products_xml), 3)
+    time_it('All products (streaming)', lambda _: list(supermarket_xml.iter_products(products_xml)), 3)
+    if untangle:
+        peak_memory('Stores memory (untangle)', untangle_stores)
+    peak_memory('Stores memory (streaming)', lambda: list(supermarket_xml.iter_stores(stores_xml)))
+    if untangle:
+        peak_memory('Products memory (untangle)', untangle_has_products)
+    peak_memory('Products memory (streaming)', lambda: sum(1 for _ in supermarket_xml.iter_products(products_xml)))
+
+
+def bench_hydration(rows):
+    """ Compares reading stores and locations the way DatabaseAccessor used to (a dictionary made for each row, then
+        copied into a model object) with reading them by column position, and loading every row at once with streaming
+        them.
+    """
+    fill_stores(StoreInfoAccessor().db, rows)
+    sia = StoreInfoAccessor()
+    lia = LocationInfoAccessor(sia.db)
+
+    def make_dicts(cursor, row):
+        # The row factory DatabaseAccessor used to use
+        return dict((cursor.description[idx][0], value) for idx, value in enumerate(row))
+
+    def dict_stores():
+        cur = sia.db.cursor()
+        cur.row_factory = make_dicts
+        return [Store(row['store_id'], row['name'],
+                      Location(row['street_address'], row['city'], row['state'], row['zipcode'], row['latitude'],
+                               row['longitude'], row['location_id'], row['location_store_id']), row['id'])
+                for row in cur.execute(StoreInfoAccessor.SQL_SELECT_STORES).fetchall()]
+
+    def dict_locations():
+        cur = sia.db.cursor()
+        cur.row_factory = make_dicts
+        return [Location(row['street_address'], row['city'], row['state'], row['zipcode'], row['latitude'],
+                         row['longitude'], row['id'], row['store_id'])
+                for row in cur.execute('SELECT * FROM {}'.format(Location.DB_TABLE_NAME)).fetchall()]
+
+    print('Reading every row ({} stores in the database)'.format(rows))
+    time_it('Stores (dictionary per row)', lambda _: dict_stores(), 3)
+    time_it('Stores (column positions)', lambda _: sia.get_all_stores(), 3)
+    time_it('Locations (dictionary per row)', lambda _: dict_locations(), 3)
+    time_it('Locations (column positions)', lambda _: lia.get_all_locations(), 3)
+    peak_memory('Stores memory (dictionary per row)', dict_stores)
+    peak_memory('Stores memory (all at once)', sia.get_all_stores)
+    peak_memory('Stores memory (streamed)', lambda: sum(1 for _ in sia.iter_all_stores()))
+
+
+def bench_catalog(rows):
+    """ Compares looking up stores in the database with doing it in the in-memory store catalog, and times loading the
+        catalog and finding nearby stores in it.
+    """
+    from catalog import StoreCatalog  # Imported here as catalog needs keys.py (through geolocation)
+    fill_stores(StoreInfoAccessor().db, rows)
+    sia = StoreInfoAccessor()
+    rnd = random.Random(1)
+    users = [sia.get_store(rnd.randint(1, rows)).location for _ in range(20)]
+    store_ids = [rnd.randint(1, rows) for _ in range(1000)]
+
+    print('Store catalog ({} stores in the database)'.format(rows))
+    time_it('Load the catalog', lambda _: StoreCatalog.get_catalog(), 1)
+    catalog = StoreCatalog.get_catalog()
+    time_it('Check for changes', lambda _: StoreCatalog.get_catalog(), 1000)
+    time_it('Nearby stores (catalog)',
+            lambda i: catalog.get_stores_within_radius(users[i].latitude, users[i].longitude, 20, 10), len(users))
+    time_it('1000 store lookups (database)', lambda _: [sia.get_store(i) for i in store_ids], 1)
+    time_it('1000 store lookups (catalog)', lambda _: [catalog.get_store(i) for i in store_ids], 1)
+
+
+def bench_connections(rows):
+    """ Compares opening a new database connection for every request (what the web app used to do) with reusing
+        connections from the pool.
+    """
+    fill_stores(StoreInfoAccessor().db, rows)
+    ConnectionPool.release_connection()
+    store_ids = [random.Random(3).randint(1, rows) for _ in range(1000)]
+
+    def new_connection(i):
+        db = sqlite3.connect(DatabaseAccessor.DATABASE_PATH)
+        db.row_factory = sqlite3.Row
+        StoreInfoAccessor(db).get_store(store_ids[i])
+        db.close()
+
+    def pooled(i):
+        StoreInfoAccessor().get_store(store_ids[i])
+        ConnectionPool.release_connection()
+
+    print('One store lookup per request ({} stores in the database)'.format(rows))
+    time_it('New connection', new_connection, len(store_ids))
+    time_it('Pooled connection', pooled, len(store_ids))
+
+
+def without_slots(cls):
+    """ Makes a copy of a class that keeps its attributes in a per-object dictionary instead of slots, to compare with
+        the real one.
+    """
+    attrs = dict((name, value) for name, value in vars(cls).items()
+                 if name not in cls.__slots__ and name not in ('__slots__', '__dict__', '__weakref__'))
+    return type(cls.__name__, cls.__bases__, attrs)
+
+
+def bench_models(rows):
+    """ Measures how much memory each model object takes, with slots and without (using a copy of the class without
+        them), counting the object and anything it creates for itself, but not the values passed to it (those are
+        shared between all the objects here).
+    """
+    from planning import TripStop  # Imported here as planning needs keys.py (through geolocation)
+    location = Location('1 Main St', 'Needham', 'MA', 2492, 42.28, -71.23)
+    store = Store('1f4a6b', 'Store', location, 1)
+    items = ['apples']
+
+    def make_locations(cls):
+        return [cls('1 Main St', 'Needham', 'MA', 2492, 42.28, -71.23) for _ in range(rows)]
+
+    def make_stores(cls):
+        return [cls('1f4a6b', 'Store', location, 1) for _ in range(rows)]
+
+    def make_items(cls):
+        return [cls(1, 'Organic Apple Juice', None, None, None, None) for _ in range(rows)]
+
+    def make_stops(cls):
+        return [cls(None, store, location, 1.5, items, 1) for _ in range(rows)]
+
+    print('Memory per object ({} objects of each model)'.format(rows))
+    for cls, make in ((Location, make_locations), (Store, make_stores), (FoodItem, make_items), (TripStop, make_stops)):
+        for label, model in (('{} (no slots)'.format(cls.__name__), without_slots(cls)), (cls.__name__, cls)):
+            tracemalloc.start()
+            objects = make(model)
+            size = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            # Take out the list holding the objects, leaving just the objects themselves
+            size -= sys.getsizeof(objects)
+            print('{0: <40} {1:9.1f} bytes'.format(label, size/rows))
+            del objects
+
+
+BENCHMARKS = {
+    'spatial': (bench_spatial, 50000),
+    'store_save': (bench_store_save, 5000),
+    'food_search': (bench_food_search, 200000),
+    'xml_parse': (bench_xml_parse, 20000),
+    'models': (bench_models, 100000),
+    'hydration': (bench_hydration, 100000),
+    'catalog': (bench_catalog, 50000),
+    'connections': (bench_connections, 50000),
+}
+
+""" Make it so we can run this script and pass parameters from the command line """
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS.keys()))
+    parser.add_argument(
+        '-r',
+        '--rows',
+        action='store',
+        dest='rows',
+        default=None,
+        type=int,
+    )
+    args = parser.parse_args()
+
+    bench, default_rows = BENCHMARKS[args.benchmark]
+    use_temp_database()
+    bench(args.rows if args.rows else default_rows)
@@ -0,0 +1,145 @@
+""" An in-memory copy of all the stores in the database, kept as columns rather than objects. Stores are read and
+    searched for much more often than they change, so the web app loads them once and answers store lookups and
+    radius searches without going to SQLite. Store objects are only made for the stores a request actually gets back.
+"""
+
+import math
+import os
+import threading
+import numpy as np
+from database import ConnectionPool, DatabaseAccessor, StoreInfoAccessor, LocationInfoAccessor
+from geolocation import Geolocation
+from models import Location, Store
+
+
+class StoreCatalog:
+
+    # The catalog most recently loaded by get_catalog, the version of the stores it was loaded from, and the state of
+    # the database file when that version was last checked
+    __catalog = None
+    __catalog_version = None
+    __file_version = None
+    __load_lock = threading.Lock()
+
+    def __init__(self, db):
+        """ Loads all the stores in the database.
+            :param db: the database connection to load them with
+        """
+        cur = db.cursor()
+        cur.row_factory = None  # Plain tuples, which zip straight into columns
+        try:
+            rows = cur.execute('{} ORDER BY s.id'.format(StoreInfoAccessor.SQL_SELECT_STORES)).fetchall()
+        finally:
+            cur.close()
+        # Columns of SQL_SELECT_STORES: id, store_id, name, location_id, street_address, city, state, zipcode,
+        # latitude, longitude, location_store_id
+        columns = list(zip(*rows)) if rows else [()] * 11
+        self.row_ids = np.array(columns[0], dtype=np.int64)
+        self.store_ids = list(columns[1])
+        self.names = list(columns[2])
+        self.location_ids = list(columns[3])
+        self.street_addresses = list(columns[4])
+        self.cities = list(columns[5])
+        self.states = list(columns[6])
+        self.zipcodes = np.array([z if z is not None else -1 for z in columns[7]], dtype=np.int32)
+        # Stores that haven't been geocoded yet get NaN coordinates, which are never within any radius
+        self.latitudes = np.array([c if c is not None else np.nan for c in columns[8]], dtype=np.float64)
+        self.longitudes = np.array([c if c is not None else np.nan for c in columns[9]], dtype=np.float64)
+        self.location_store_ids = list(columns[10])
+        # The stores in order of latitude, so the ones in a band of latitudes can be found with a binary search
+        # (stores without coordinates come last)
+        self.by_latitude = np.argsort(self.latitudes, kind='stable')
+        self.sorted_latitudes = self.latitudes[self.by_latitude]
+
+    def __len__(self):
+        return len(self.row_ids)
+
+    @staticmethod
+    def get_catalog(path=None):
+        """ Gets the catalog of the stores in the database, loading it the first time and again whenever the stores
+            have changed since it was last loaded. The database is only checked for changes to the stores when the
+            database file has been written to.
+            :param path: (optional) the database file (DatabaseAccessor.DATABASE_PATH by default) - string
+            :return: the catalog - StoreCatalog
+        """
+        path = path if path else DatabaseAccessor.DATABASE_PATH
+        if StoreCatalog.__catalog is None or StoreCatalog.__file_version != StoreCatalog.get_database_version(path):
+            with StoreCatalog.__load_lock:
+                # Another thread may have checked while this one was waiting
+                file_version = StoreCatalog.get_database_version(path)
+                if StoreCatalog.__catalog is None or StoreCatalog.__file_version != file_version:
+                    db = ConnectionPool.get_connection(path)
+                    # Most writes (e.g. saving geocodes) don't touch the stores, so don't need the catalog reloading
+                    version = (path, StoreInfoAccessor(db).get_version())
+                    if StoreCatalog.__catalog is None or StoreCatalog.__catalog_version != version:
+                        catalog = StoreCatalog(db)
+                        print('Loaded {} stores into the store catalog'.format(len(catalog)))
+                        StoreCatalog.__catalog, StoreCatalog.__catalog_version = catalog, version
+                    StoreCatalog.__file_version = file_version
+        return StoreCatalog.__catalog
+
+    @staticmethod
+    def get_database_version(path):
+        """ Gets something that changes whenever the database file is written to: the modification times and sizes of
+            the file and its write-ahead log (which is where writes go first in WAL mode).
+            :param path: the database file - string
+            :return: the version - tuple
+        """
+        version = [path]
+        for file_path in (path, path + '-wal'):
+            try:
+                stat = os.stat(file_path)
+                version.extend((stat.st_mtime_ns, stat.st_size))
+            except FileNotFoundError:
+                version.extend((None, None))
+        return tuple(version)
+
+    def get_store(self, row_id):
+        """ Looks up one store.
+            :param row_id: the store's row ID in the database - int
+            :return: the store, or None if there isn't one with that ID - Store
+        """
+        i = int(np.searchsorted(self.row_ids, row_id))
+        if i < len(self.row_ids) and self.row_ids[i] == row_id:
+            return self.make_store(i)
+        return None
+
+    def get_stores_within_radius(self, latitude, longitude, miles, limit=None):
+        """ Gets the stores within a certain distance (as the crow flies) of a point, closest first. Stores without
+            coordinates aren't included.
+            :param latitude: the latitude of the point in decimal degrees - float
+            :param longitude: the longitude of the point in decimal degrees - float
+            :param miles: the search radius in miles - float
+            :param limit: (optional) the most stores to return - int
+            :return: a list of the stores found - [Store]
+        """
+        # Narrow the search down to a bounding box before working out the exact distances (with a little to spare, as
+        # the box is only approximate)
+        radius_lat = 1.05 * miles / LocationInfoAccessor.MILES_PER_DEGREE_LAT
+        radius_long = radius_lat / max(np.cos(np.radians(latitude + np.copysign(radius_lat, latitude))), 0.01)
+        start, end = np.searchsorted(self.sorted_latitudes, (latitude - radius_lat, latitude + radius_lat), side='left')
+        in_band = self.by_latitude[start:end]
+        in_box = in_band[np.abs(self.longitudes[in_band] - longitude) <= radius_long]
+        dists = Geolocation.get_euclidean_dists(latitude, longitude, self.latitudes[in_box], self.longitudes[in_box])
+        nearest = Geolocation.get_nearest(dists, miles, limit if limit is not None else len(in_box))
+        return [self.make_store(i) for i in in_box[nearest]]
+
+    def make_store(self, i):
+        """ Makes a Store object for one of the stores in the catalog.
+            :param i: the store's position in the catalog - int
+            :return: the store - Store
+        """
+        zipcode = int(self.zipcodes[i])
+        latitude = float(self.latitudes[i])
+        longitude = float(self.longitudes[i])
+        loc = Location(
+            self.street_addresses[i],
+            self.cities[i],
+            self.states[i],
+            zipcode if zipcode >= 0 else None,
+            latitude if not math.isnan(latitude) else None,
+            longitude if not math.isnan(longitude) else None,
+            self.location_ids[i],
+            self.location_store_ids[i]
+        )
+        return Store(self.store_ids[i], self.names[i], loc, int(self.row_ids[i]))
@@ -1,40 +1,186 @@
+import hashlib
+import math
+import re
 import sqlite3
-from flask import g
+import threading
+from operator import itemgetter
 import os
 from models import Store, Location, FoodItem
 
+CRAWL_PROGRESS_TABLE_NAME = 'crawl_progress'
+STORE_ITEMS_TABLE_NAME = 'store_items'
+GEOCODES_TABLE_NAME = 'geocodes'
+DISTANCES_TABLE_NAME = 'distances'
+TABLE_VERSIONS_TABLE_NAME = 'table_versions'
+
+
+class ConnectionPool:
+    """ Hands out connections to the database, with or without a Flask app. Each thread gets its own connection and
+        keeps it until it releases it (the web app does at the end of every request), and released connections are kept
+        open for the next thread that needs one, so they only have to be set up once.
+    """
+
+    MAX_IDLE_CONNECTIONS = 8  # Released connections kept open for reuse (per database file)
+    BUSY_TIMEOUT = 30  # Seconds to wait for another connection to finish writing before giving up
+    # Set on every new connection. In WAL mode readers and a writer don't block each other, so the web app keeps
+    # working while an import is running; syncing to disk only at checkpoints can lose the last few transactions in a
+    # crash, but won't corrupt the database.
+    PRAGMAS = ['PRAGMA journal_mode=WAL',
+               'PRAGMA synchronous=NORMAL',
+               'PRAGMA mmap_size=268435456',  # Read the database file through up to 256 MB of memory-mapped I/O
+               'PRAGMA cache_size=-16384']  # Up to 16 MB of pages cached per connection
+
+    __local = threading.local()  # The connections each thread is using, keyed by database path
+    __idle = dict()  # Released connections, keyed by database path
+    __idle_lock = threading.Lock()
+
+    @staticmethod
+    def get_connection(path=None):
+        """ Gets this thread's connection to the database, taking one from the pool (or opening one) if it doesn't
+            have one yet.
+            :param path: (optional) the database file (DatabaseAccessor.DATABASE_PATH by default) - string
+            :return: the connection - sqlite3.Connection
+        """
+        path = path if path else DatabaseAccessor.DATABASE_PATH
+        connections = getattr(ConnectionPool.__local, 'connections', None)
+        if connections is None:
+            connections = ConnectionPool.__local.connections = dict()
+        db = connections.get(path)
+        if db is None:
+            with ConnectionPool.__idle_lock:
+                idle = ConnectionPool.__idle.get(path)
+                db = idle.pop() if idle else None
+            if db is None:
+                db = ConnectionPool.connect(path)
+            connections[path] = db
+        return db
+
+    @staticmethod
+    def connect(path):
+        """ Opens a new connection to the database, set up the way the accessors expect.
+            :param path: the database file - string
+            :return: the connection - sqlite3.Connection
+        """
+        # Connections are only ever used by one thread at a time, but can be handed from one thread to another
+        db = sqlite3.connect(path, timeout=ConnectionPool.BUSY_TIMEOUT, check_same_thread=False)
+        # Make the database query return rows that can be read by column name, like dictionaries
+        db.row_factory = sqlite3.Row
+        for pragma in ConnectionPool.PRAGMAS:
+            db.execute(pragma)
+        return db
+
+    @staticmethod
+    def release_connection(exception=None):
+        """ Gives this thread's connections back to the pool. Anything not yet committed is rolled back. Can be
+            registered as a Flask teardown function.
+            :param exception: (optional) the exception that ended the request, if any (not used)
+        """
+        connections = getattr(ConnectionPool.__local, 'connections', None)
+        if not connections:
+            return
+        ConnectionPool.__local.connections = dict()
+        for path, db in connections.items():
+            if db.in_transaction:
+                db.rollback()
+            with ConnectionPool.__idle_lock:
+                idle = ConnectionPool.__idle.setdefault(path, list())
+                if len(idle) < ConnectionPool.MAX_IDLE_CONNECTIONS:
+                    idle.append(db)
+                    db = None
+            if db is not None:
+                db.close()
+
+    @staticmethod
+    def close_idle_connections():
+        """ Closes all the connections waiting in the pool. """
+        with ConnectionPool.__idle_lock:
+            idle = [db for connections in ConnectionPool.__idle.values() for db in connections]
+            ConnectionPool.__idle = dict()
+        for db in idle:
+            db.close()
+
+    @staticmethod
+    def has_database(path=None):
+        """ Checks whether the database file has been created (see DatabaseCreator).
+            :param path: (optional) the database file (DatabaseAccessor.DATABASE_PATH by default) - string
+            :return: True if it exists - bool
+        """
+        return os.path.exists(path if path else DatabaseAccessor.DATABASE_PATH)
+
 
 class DatabaseAccessor:
 
     FILENAME = 'grocery_db.sqlite'  # name of the sqlite database file
     DATABASE_PATH = '{}/{}'.format(os.path.dirname(os.path.realpath(__file__)), FILENAME)
+    MAX_QUERY_VALUES = 500  # Older versions of SQLite allow at most 999 values per query
+    FETCH_BATCH_SIZE = 1000  # Rows read from SQLite at a time when going through the results of a query
 
     def __init__(self, db=None):
         """ Instantiates a new DatabaseAccessor object.
-            :param db: (optional) an existing connection to the database to use, rather than create a new one
+            :param db: (optional) an existing connection to the database to use, rather than this thread's connection
+             from the ConnectionPool
         """
-        if db:
-            self.db = db
-        else:
-            self.db = getattr(g, '_database', None)
-            if self.db is None:
-                self.db = g._database = sqlite3.connect(self.DATABASE_PATH)
-            # Make the database query return a list of dictionaries rather than cursor rows
-            self.db.row_factory = self.__make_dicts
+        self.__pooled = not db
+        self.db = db if db else ConnectionPool.get_connection()
 
     def _query_db(self, query, args=(), one=False):
         """ Queries (reads) the database.
             :param query: a SQL query statement (e.g. 'select * from stores') - string
-            :param args: some SQL argument?
+            :param args: the values for the query's placeholders (a sequence for ?, or a dictionary for :name)
             :param one: if True, will return only the first result, otherwise all
-            :return a tuple of dictionaries, where each element in the tuple represents a result in the database.
-             The keys of the dictionaries correspond to the database column name and the values are the cell values.
+            :return a list of rows, where each row represents a result in the database. A row's values can be read by
+             column name (e.g. row['name']) or position. - [sqlite3.Row]
         """
         cur = self.db.execute(query, args)
         rv = cur.fetchall()
         cur.close()
         return (rv[0] if rv else None) if one else rv
 
+    def _iter_objects(self, query, args, make_parser, batch_size=FETCH_BATCH_SIZE):
+        """ Queries the database and turns the results into objects as they're read, a batch of rows at a time, so a
+            big query never has to be held in memory all at once.
+            :param query: a SQL query statement - string
+            :param args: the values for the query's placeholders (a sequence for ?, or a dictionary for :name)
+            :param make_parser: makes the function that turns a row (a tuple of values) into an object, given the
+             position of each of the query's columns in the row (see get_column_positions), so column names only need
+             to be looked up once per query
+            :param batch_size: the number of rows to read at a time - int
+            :return a generator of the objects
+        """
+        cur = self.db.cursor()
+        cur.row_factory = None  # Plain tuples, which are the quickest to read values out of by position
+        try:
+            cur.execute(query, args)
+            parse = make_parser(self.get_column_positions(cur.description))
+            while True:
+                rows = cur.fetchmany(batch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield parse(row)
+        finally:
+            cur.close()
+
+    def _query_objects(self, query, args, make_parser, one=False):
+        """ Queries the database and turns the results into objects (see _iter_objects).
+            :param one: if True, will return only the first object (or None if there were no results), otherwise all
+            :return a list of the objects
+        """
+        objects = self._iter_objects(query, args, make_parser)
+        if one:
+            first = next(objects, None)
+            objects.close()
+            return first
+        return list(objects)
+
+    @staticmethod
+    def get_column_positions(description):
+        """ Works out where each column is in the rows of a query.
+            :param description: the query's cursor.description
+            :return the position of each column, keyed by column name - dict<string,int>
+        """
+        return dict((col[0], i) for i, col in enumerate(description))
+
     def _save(self, table_name, data, id=None):
         """ Saves data to the database, either by adding a new row (if id is None) or
             by updating an existing row (if is is not None).
@@ -45,64 +191,110 @@ class DatabaseAccessor:
             :return the row id of the added new row, or 0 if an existing row was successfully updated
         """
         # Remove any items with a value of None
-        cols = list(data.keys())
-        vals = list(data.values())
-        cols_clean = list()
-        vals_clean = list()
-        for i in range(len(cols)):
-            val = vals[i]
-            if val is not None:
-                cols_clean.append(str(cols[i]))
-                if isinstance(val, int):
-                    vals_clean.append(str(val))
-                elif isinstance(val, str):
-                    vals_clean.append('"{}"'.format(val))
-                else:
-                    raise TypeError('Expected str or int, got {}.'.format(type(val)))
-        # Create the SQL and execute it
-        cursor = self.db.cursor()
+        cols = tuple(col for col, val in data.items() if val is not None)
+        vals = [data[col] for col in cols]
+        # Execute the SQL, passing the values separately so they never need escaping
         if id:
-            sql_set = list()
-            for i in range(len(cols_clean)):
-                sql_set.append('{}={}'.format(cols_clean[i], vals_clean[i]))
-            sql = "UPDATE {tn} SET {set} WHERE id={id}". \
-                format(tn=table_name, set=','.join(sql_set), id=id)
-            cursor.execute(sql, ())
+            sql = self._get_update_sql(table_name, cols)
+            self.db.execute(sql, vals + [id])
             row_id = None
         else:
-            cols_sql = ','.join(cols_clean)
-            vals_sql = ','.join(vals_clean)
-            sql = "INSERT INTO {tn} ({cn}) VALUES ({vals})". \
-                format(tn=table_name, cn=cols_sql, vals=vals_sql)
-            row_id = cursor.execute(sql, ()).lastrowid
+            sql = self._get_insert_sql(table_name, cols)
+            row_id = self.db.execute(sql, vals).lastrowid
 
         self.db.commit()
         return row_id if row_id else 0
 
-    def close(self):
-        """ Closes the database connection """
-        if self.db is not None:
-            self.db.close()
+    def _save_many(self, table_name, rows, commit=True):
+        """ Adds many new rows to a table at once.
+            :param table_name: the table in the database to save the data to
+            :param rows: dictionaries where the keys correspond to the column names and the values correspond to the
+             values to store in those cells (every dictionary must have the same keys)
+            :param commit: if False, leaves committing to the caller (e.g. to save several tables in one transaction)
+            :return the number of rows added - int
+        """
+        if len(rows) == 0:
+            return 0
+        cols = tuple(rows[0].keys())
+        sql = self._get_insert_sql(table_name, cols)
+        count = self.db.executemany(sql, ([row[col] for col in cols] for row in rows)).rowcount
+        if commit:
+            self.db.commit()
+        return count
+
+    # Cache of the INSERT and UPDATE statements built so far, so each is only built once. Using the exact same SQL
+    # string every time also lets SQLite reuse its prepared statements.
+    __save_sql = {}
+
+    @staticmethod
+    def _get_insert_sql(table_name, cols):
+        """ Gets the SQL for adding a row to a table.
+            :param table_name: the table to add to - string
+            :param cols: the names of the columns to fill in - (string)
+            :return the SQL, with ? placeholders for the values (in the same order as cols) - string
+        """
+        key = (table_name, cols, False)
+        sql = DatabaseAccessor.__save_sql.get(key)
+        if sql is None:
+            sql = DatabaseAccessor.__save_sql[key] = 'INSERT INTO {tn} ({cn}) VALUES ({vals})'\
+                .format(tn=table_name, cn=','.join(cols), vals=','.join('?' * len(cols)))
+        return sql
 
     @staticmethod
-    def __make_dicts(cursor, row):
-        """ Converts the results of a database query into a list of dictionaries, where each key corresponds to the
-            column name and each value is the value of the cell for that row.
+    def _get_update_sql(table_name, cols):
+        """ Gets the SQL for updating a row in a table.
+            :param table_name: the table the row is in - string
+            :param cols: the names of the columns to update - (string)
+            :return the SQL, with ? placeholders for the values (in the same order as cols) followed by one for the row id - string
+        """
+        key = (table_name, cols, True)
+        sql = DatabaseAccessor.__save_sql.get(key)
+        if sql is None:
+            sql = DatabaseAccessor.__save_sql[key] = 'UPDATE {tn} SET {set} WHERE id=?'\
+                .format(tn=table_name, set=','.join('{}=?'.format(col) for col in cols))
+        return sql
+
+    def _get_next_id(self, table_name):
+        """ Gets the row ID SQLite would give the next row added to an AUTOINCREMENT table. Like SQLite, this never
+            reuses the IDs of deleted rows: it goes by the highest ID the table has ever had (kept in sqlite_sequence).
+            Call it inside the transaction that adds the rows, so nothing else can take the IDs in the meantime. Adding
+            rows with explicit IDs moves sqlite_sequence on past them.
+            :param table_name: the table - string
+            :return: the next row ID - int
+        """
+        sql = 'SELECT MAX(IFNULL((SELECT seq FROM sqlite_sequence WHERE name=?), 0), ' \
+              'IFNULL((SELECT MAX(id) FROM {}), 0)) + 1 AS next_id'.format(table_name)
+        return self._query_db(sql, (table_name,), True)['next_id']
+
+    def use_write_ahead_log(self):
+        """ Switches the database to write-ahead logging and only syncs to disk at checkpoints. Much faster for big
+            imports, and readers aren't blocked while writing. A crash can lose the last few transactions, but won't
+            corrupt the database. WAL mode stays on for the database file; the sync setting is just for this connection.
+            (Connections from the ConnectionPool are already set up this way.)
         """
-        return dict((cursor.description[idx][0], value)
-                    for idx, value in enumerate(row))
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+
+    def close(self):
+        """ Closes the database connection, or gives it back to the ConnectionPool if it came from there """
+        if self.db is not None:
+            if self.__pooled:
+                ConnectionPool.release_connection()
+            else:
+                self.db.close()
 
 
 class DatabaseCreator:
 
-    SQL_CREATES = ['CREATE TABLE {} ('
+    SQL_CREATES = ['CREATE TABLE IF NOT EXISTS {} ('
                    'id INTEGER PRIMARY KEY AUTOINCREMENT,'
                    'store_id CHAR(15),'
                    'name CHAR(50),'
                    'location_id INT,'
-                   'items CHAR(200));'.format(Store.DB_TABLE_NAME),
+                   'items CHAR(200),'
+                   'content_hash CHAR(40));'.format(Store.DB_TABLE_NAME),
 
-                   'CREATE TABLE {} ('
+                   'CREATE TABLE IF NOT EXISTS {} ('
                    'id INTEGER PRIMARY KEY AUTOINCREMENT,'
                    'street_address CHAR(50),'
                    'city CHAR(20),'
@@ -112,17 +304,127 @@ class DatabaseCreator:
                    'longitude DOUBLE,'
                    'store_id CHAR(15));'.format(Location.DB_TABLE_NAME),
 
-                   'CREATE TABLE {} ('
+                   'CREATE TABLE IF NOT EXISTS {} ('
                    'id INTEGER PRIMARY KEY AUTOINCREMENT,'
                    'item_id CHAR(15),'
                    'name CHAR(200),'
                    'aisle CHAR(15),'
                    'category CHAR(20),'
                    'description CHAR(100),'
-                   'image_url CHAR(200));'.format(FoodItem.DB_TABLE_NAME)]
+                   'image_url CHAR(200));'.format(FoodItem.DB_TABLE_NAME),
+
+                   # When each ZIP code was last crawled for stores, so a crawl can pick up where it left off
+                   'CREATE TABLE IF NOT EXISTS {} ('
+                   'zipcode INTEGER PRIMARY KEY,'
+                   'store_count INT,'
+                   'crawled_at DOUBLE);'.format(CRAWL_PROGRESS_TABLE_NAME),
+
+                   # Whether stores carry ingredients, as last looked up with the Supermarket API
+                   'CREATE TABLE IF NOT EXISTS {} ('
+                   'store_id CHAR(15),'
+                   'ingredient CHAR(100),'
+                   'available INT,'
+                   'item_ids CHAR(200),'
+                   'fetched_at DOUBLE,'
+                   'PRIMARY KEY (store_id, ingredient));'.format(STORE_ITEMS_TABLE_NAME),
+
+                   # Coordinates of addresses that have been geocoded, keyed by normalized address
+                   'CREATE TABLE IF NOT EXISTS {} ('
+                   'address CHAR(200) PRIMARY KEY,'
+                   'latitude DOUBLE,'
+                   'longitude DOUBLE,'
+                   'geocoded_at DOUBLE);'.format(GEOCODES_TABLE_NAME),
+
+                   # Driving distances between saved locations, keyed by their row IDs
+                   'CREATE TABLE IF NOT EXISTS {} ('
+                   'origin_id INT,'
+                   'destination_id INT,'
+                   'miles DOUBLE,'
+                   'fetched_at DOUBLE,'
+                   'PRIMARY KEY (origin_id, destination_id));'.format(DISTANCES_TABLE_NAME),
+
+                   # A count of the changes made to each of the tables that have VERSIONED_TABLES triggers
+                   'CREATE TABLE IF NOT EXISTS {} ('
+                   'table_name CHAR(50) PRIMARY KEY,'
+                   'version INT);'.format(TABLE_VERSIONS_TABLE_NAME)]
+
+    # Columns added since the tables were first made, which older databases need adding: (table, column, type)
+    ADDED_COLUMNS = [(Store.DB_TABLE_NAME, 'content_hash', 'CHAR(40)')]
+
+    SQL_INDEXES = ['CREATE INDEX IF NOT EXISTS {tn}_zipcode ON {tn} (zipcode);'.format(tn=Location.DB_TABLE_NAME),
+                   'CREATE INDEX IF NOT EXISTS {tn}_location_id ON {tn} (location_id);'.format(tn=Store.DB_TABLE_NAME),
+                   'CREATE INDEX IF NOT EXISTS {tn}_store_id ON {tn} (store_id);'.format(tn=Store.DB_TABLE_NAME),
+                   'CREATE INDEX IF NOT EXISTS {tn}_destination_id ON {tn} (destination_id);'.format(tn=DISTANCES_TABLE_NAME)]
+
+    # Each item ID can only be saved once, so imports can be re-run without duplicating items
+    ITEM_ID_INDEX_NAME = '{}_item_id'.format(FoodItem.DB_TABLE_NAME)
+    SQL_CREATE_ITEM_ID_INDEX = 'CREATE UNIQUE INDEX {} ON {} (item_id);'.format(ITEM_ID_INDEX_NAME, FoodItem.DB_TABLE_NAME)
+    SQL_REMOVE_DUPLICATE_ITEMS = 'DELETE FROM {tn} WHERE id NOT IN (SELECT MIN(id) FROM {tn} GROUP BY item_id);'.format(tn=FoodItem.DB_TABLE_NAME)
+
+    # Full-text index over the item names, kept in sync with the items table by triggers
+    SEARCH_INDEX_NAME = '{}_fts'.format(FoodItem.DB_TABLE_NAME)
+    SQL_CREATE_SEARCH_INDEX = "CREATE VIRTUAL TABLE {} USING fts5(name, content='{}', content_rowid='id');"\
+        .format(SEARCH_INDEX_NAME, FoodItem.DB_TABLE_NAME)
+    SQL_FILL_SEARCH_INDEX = "INSERT INTO {fts}({fts}) VALUES('rebuild');".format(fts=SEARCH_INDEX_NAME)
+    SQL_SEARCH_TRIGGERS = ['CREATE TRIGGER IF NOT EXISTS {fts}_insert AFTER INSERT ON {tn} BEGIN '
+                           'INSERT INTO {fts}(rowid, name) VALUES (NEW.id, NEW.name); '
+                           'END;'.format(fts=SEARCH_INDEX_NAME, tn=FoodItem.DB_TABLE_NAME),
+
+                           'CREATE TRIGGER IF NOT EXISTS {fts}_update AFTER UPDATE OF name ON {tn} BEGIN '
+                           "INSERT INTO {fts}({fts}, rowid, name) VALUES ('delete', OLD.id, OLD.name); "
+                           'INSERT INTO {fts}(rowid, name) VALUES (NEW.id, NEW.name); '
+                           'END;'.format(fts=SEARCH_INDEX_NAME, tn=FoodItem.DB_TABLE_NAME),
+
+                           'CREATE TRIGGER IF NOT EXISTS {fts}_delete AFTER DELETE ON {tn} BEGIN '
+                           "INSERT INTO {fts}({fts}, rowid, name) VALUES ('delete', OLD.id, OLD.name); "
+                           'END;'.format(fts=SEARCH_INDEX_NAME, tn=FoodItem.DB_TABLE_NAME)]
+
+    # R*Tree index over the coordinates of the locations, kept in sync with the locations table by triggers
+    SPATIAL_INDEX_NAME = '{}_rtree'.format(Location.DB_TABLE_NAME)
+    SQL_CREATE_SPATIAL_INDEX = 'CREATE VIRTUAL TABLE {} USING rtree(id, min_lat, max_lat, min_long, max_long);'.format(SPATIAL_INDEX_NAME)
+    SQL_FILL_SPATIAL_INDEX = 'INSERT INTO {rt} SELECT id, latitude, latitude, longitude, longitude FROM {tn} ' \
+                             'WHERE latitude IS NOT NULL AND longitude IS NOT NULL;'.format(rt=SPATIAL_INDEX_NAME, tn=Location.DB_TABLE_NAME)
+    SQL_SPATIAL_TRIGGERS = ['CREATE TRIGGER IF NOT EXISTS {rt}_insert AFTER INSERT ON {tn} '
+                            'WHEN NEW.latitude IS NOT NULL AND NEW.longitude IS NOT NULL BEGIN '
+                            'INSERT INTO {rt} VALUES (NEW.id, NEW.latitude, NEW.latitude, NEW.longitude, NEW.longitude); '
+                            'END;'.format(rt=SPATIAL_INDEX_NAME, tn=Location.DB_TABLE_NAME),
+
+                            'CREATE TRIGGER IF NOT EXISTS {rt}_update AFTER UPDATE OF latitude, longitude ON {tn} BEGIN '
+                            'DELETE FROM {rt} WHERE id=OLD.id; '
+                            'INSERT INTO {rt} SELECT NEW.id, NEW.latitude, NEW.latitude, NEW.longitude, NEW.longitude '
+                            'WHERE NEW.latitude IS NOT NULL AND NEW.longitude IS NOT NULL; '
+                            'END;'.format(rt=SPATIAL_INDEX_NAME, tn=Location.DB_TABLE_NAME),
+
+                            'CREATE TRIGGER IF NOT EXISTS {rt}_delete AFTER DELETE ON {tn} BEGIN '
+                            'DELETE FROM {rt} WHERE id=OLD.id; '
+                            'END;'.format(rt=SPATIAL_INDEX_NAME, tn=Location.DB_TABLE_NAME)]
+
+    # Tables whose version (in the table_versions table) goes up with every row added, changed or removed, so readers
+    # that keep a copy of them (like the StoreCatalog) can tell when it's out of date without reading the whole table
+    VERSIONED_TABLES = [Store.DB_TABLE_NAME, Location.DB_TABLE_NAME]
+    SQL_VERSION_TRIGGERS = ['CREATE TRIGGER IF NOT EXISTS {tn}_version_{op} AFTER {op} ON {tn} BEGIN '
+                            "UPDATE {vt} SET version=version+1 WHERE table_name='{tn}'; "
+                            'END;'.format(tn=tn, op=op, vt=TABLE_VERSIONS_TABLE_NAME)
+                            for tn in VERSIONED_TABLES for op in ('insert', 'update', 'delete')]
+
+    # Saved driving distances are keyed by location row ID, so they're removed when a location is removed or moves to a
+    # different address (coordinates being filled in doesn't change the drive)
+    SQL_REMOVE_ORPHANED_DISTANCES = 'DELETE FROM {dt} WHERE origin_id NOT IN (SELECT id FROM {tn}) ' \
+                                    'OR destination_id NOT IN (SELECT id FROM {tn});'.format(dt=DISTANCES_TABLE_NAME, tn=Location.DB_TABLE_NAME)
+    SQL_DISTANCE_TRIGGERS = ['CREATE TRIGGER IF NOT EXISTS {dt}_location_delete AFTER DELETE ON {tn} BEGIN '
+                             'DELETE FROM {dt} WHERE origin_id=OLD.id OR destination_id=OLD.id; '
+                             'END;'.format(dt=DISTANCES_TABLE_NAME, tn=Location.DB_TABLE_NAME),
+
+                             'CREATE TRIGGER IF NOT EXISTS {dt}_location_move AFTER UPDATE OF street_address, city, state, zipcode ON {tn} '
+                             'WHEN NEW.street_address IS NOT OLD.street_address OR NEW.city IS NOT OLD.city '
+                             'OR NEW.state IS NOT OLD.state OR NEW.zipcode IS NOT OLD.zipcode BEGIN '
+                             'DELETE FROM {dt} WHERE origin_id=OLD.id OR destination_id=OLD.id; '
+                             'END;'.format(dt=DISTANCES_TABLE_NAME, tn=Location.DB_TABLE_NAME)]
 
     def init_db(self):
-        """ Creates the SQLite database file on the disk and creates the desired tables within the database """
+        """ Creates the SQLite database file on the disk (if needed) and creates any of the desired tables and indexes
+            that don't exist yet within the database
+        """
         # Connecting to the database file
         conn = sqlite3.connect(DatabaseAccessor.DATABASE_PATH)
         c = conn.cursor()
@@ -131,12 +433,67 @@ class DatabaseCreator:
         for sql in self.SQL_CREATES:
             c.execute(sql)
 
+        for table_name, column, column_type in self.ADDED_COLUMNS:
+            c.execute('PRAGMA table_info({})'.format(table_name))
+            if column not in [row[1] for row in c.fetchall()]:
+                c.execute('ALTER TABLE {} ADD COLUMN {} {}'.format(table_name, column, column_type))
+
+        for sql in self.SQL_INDEXES:
+            c.execute(sql)
+
+        # Databases made before item IDs were unique may have duplicates that need removing first
+        c.execute('SELECT name FROM sqlite_master WHERE name=?', (self.ITEM_ID_INDEX_NAME,))
+        if not c.fetchone():
+            c.execute(self.SQL_REMOVE_DUPLICATE_ITEMS)
+            c.execute(self.SQL_CREATE_ITEM_ID_INDEX)
+
+        # Create the full-text index, filling it with any items that are already saved
+        c.execute('SELECT name FROM sqlite_master WHERE name=?', (self.SEARCH_INDEX_NAME,))
+        if not c.fetchone():
+            c.execute(self.SQL_CREATE_SEARCH_INDEX)
+            c.execute(self.SQL_FILL_SEARCH_INDEX)
+        for sql in self.SQL_SEARCH_TRIGGERS:
+            c.execute(sql)
+
+        # Create the spatial index, filling it with any locations that are already saved
+        c.execute('SELECT name FROM sqlite_master WHERE name=?', (self.SPATIAL_INDEX_NAME,))
+        if not c.fetchone():
+            c.execute(self.SQL_CREATE_SPATIAL_INDEX)
+            c.execute(self.SQL_FILL_SPATIAL_INDEX)
+        for sql in self.SQL_SPATIAL_TRIGGERS:
+            c.execute(sql)
+
+        # Start counting the changes to the versioned tables
+        c.executemany('INSERT OR IGNORE INTO {} (table_name, version) VALUES (?, 0)'.format(TABLE_VERSIONS_TABLE_NAME),
+                      ((tn,) for tn in self.VERSIONED_TABLES))
+        for sql in self.SQL_VERSION_TRIGGERS:
+            c.execute(sql)
+
+        # Clear out distances left behind by locations removed before the triggers existed
+        c.execute('SELECT name FROM sqlite_master WHERE name=?', ('{}_location_delete'.format(DISTANCES_TABLE_NAME),))
+        if not c.fetchone():
+            c.execute(self.SQL_REMOVE_ORPHANED_DISTANCES)
+        for sql in self.SQL_DISTANCE_TRIGGERS:
+            c.execute(sql)
+
         # Committing changes and closing the connection to the database file
         conn.commit()
         conn.close()
 
 
 class StoreInfoAccessor(DatabaseAccessor):
+
+    # Selects stores along with their locations, so both can be read in one query
+    SQL_SELECT_STORES = 'SELECT s.id AS id, s.store_id AS store_id, s.name AS name, s.location_id AS location_id, ' \
+                        'l.street_address AS street_address, l.city AS city, l.state AS state, l.zipcode AS zipcode, ' \
+                        'l.latitude AS latitude, l.longitude AS longitude, l.store_id AS location_store_id ' \
+                        'FROM {st} s JOIN {lt} l ON l.id=s.location_id'.format(st=Store.DB_TABLE_NAME, lt=Location.DB_TABLE_NAME)
+    # Selects what's needed to compare stores with downloaded ones, without having to load them
+    SQL_SELECT_STORE_HASHES = 'SELECT s.id AS id, s.store_id AS store_id, s.content_hash AS content_hash, s.location_id AS location_id, ' \
+                              'l.street_address AS street_address, l.city AS city, l.state AS state, l.zipcode AS zipcode, ' \
+                              'l.latitude AS latitude, l.longitude AS longitude ' \
+                              'FROM {st} s LEFT JOIN {lt} l ON l.id=s.location_id'.format(st=Store.DB_TABLE_NAME, lt=Location.DB_TABLE_NAME)
+
     def __init__(self, db=None):
         super().__init__(db)
         self.loc_info_accessor = LocationInfoAccessor(self.db)
@@ -145,12 +502,14 @@ class StoreInfoAccessor(DatabaseAccessor):
         """ Gets all of the stores in the database
             :return a list of Store objects - [Store]
         """
-        store_sql = 'SELECT * FROM {}'.format(Store.DB_TABLE_NAME)
-        query_res = self._query_db(store_sql, ())
-        res = list()
-        for row in query_res:
-            res.append(self.__parse_store(row))
-        return res
+        return list(self.iter_all_stores())
+
+    def iter_all_stores(self, batch_size=DatabaseAccessor.FETCH_BATCH_SIZE):
+        """ Goes through all of the stores in the database without loading them all at once.
+            :param batch_size: the number of stores to read from the database at a time - int
+            :return a generator of Store objects
+        """
+        return self._iter_objects(self.SQL_SELECT_STORES, (), self.__store_parser, batch_size)
 
     def get_stores_in_zip_range(self, start_zip, end_zip):
         """ Gets all the stores located in the given ZIP code range.
@@ -158,33 +517,27 @@ class StoreInfoAccessor(DatabaseAccessor):
         :param end_zip: the ending ZIP code (also searched) - int
         :return: a list of stores found in the given range - [Store]
         """
-        locations = LocationInfoAccessor().get_locations_in_zip_range(start_zip, end_zip)
-        res = list()
-        for loc in locations:
-            store_id = loc.store_id
-            store = self.get_store(store_id)
-            res.append(store)
-        return res
+        sql = '{} WHERE l.zipcode>=? AND l.zipcode<=?'.format(self.SQL_SELECT_STORES)
+        return self._query_objects(sql, (start_zip, end_zip), self.__store_parser)
 
     def get_store(self, store_id):
         """ Gets the information for one store.
-        :param store_id: the store's alphanumeric ID
-        :return: a Store object containing the store's information - Store
-        """
-        store_sql = 'SELECT * FROM {} WHERE id={}'.format(Store.DB_TABLE_NAME, store_id)
-        query_res = self._query_db(store_sql, (), True)
-        return self.__parse_store(query_res)
-
-    def __parse_store(self, row):
-        """ Internal method for parsing the results of a database query and saving it into a Store object """
-        loc = self.loc_info_accessor.get_location(row['location_id'])
-        store = Store(
-            row['store_id'],
-            row['name'],
-            loc,
-            row['id']
-        )
-        return store
+        :param store_id: the store's row ID in the database - int
+        :return: a Store object containing the store's information, or None if there isn't a store with that ID - Store
+        """
+        store_sql = '{} WHERE s.id=?'.format(self.SQL_SELECT_STORES)
+        return self._query_objects(store_sql, (store_id,), self.__store_parser, True)
+
+    @staticmethod
+    def __store_parser(columns):
+        """ Internal method for making a function that turns the rows of a SQL_SELECT_STORES query into Store objects
+            (see _iter_objects)
+        """
+        location_values = itemgetter(columns['street_address'], columns['city'], columns['state'], columns['zipcode'],
+                                     columns['latitude'], columns['longitude'], columns['location_id'],
+                                     columns['location_store_id'])
+        store_id, name, row_id = columns['store_id'], columns['name'], columns['id']
+        return lambda row: Store(row[store_id], row[name], Location(*location_values(row)), row[row_id])
 
     def save_store(self, store, location_info_accessor=None):
         """
@@ -195,11 +548,8 @@ class StoreInfoAccessor(DatabaseAccessor):
         """
         if location_info_accessor:
             location_info_accessor.save_location(store.location)
-        data = {
-            'store_id': store.store_id,
-            'name': store.name,
-            'location_id': store.location.id,
-        }
+        data = self.get_store_data(store)
+        del data['id']
         new_id = self._save(store.DB_TABLE_NAME, data, store.id)
         # If we just added a store to the database, set the id attribute on the Store object
         if new_id:
@@ -207,7 +557,183 @@ class StoreInfoAccessor(DatabaseAccessor):
         return new_id
 
 
+    def save_stores(self, stores):
+        """
+        Adds many new stores and their locations to the database in a single transaction. The row IDs linking each
+        store and its location are reserved up front (see _get_next_id) and handed out in memory, so every row only has
+        to be written once.
+        :param stores: the new stores to save (the id attributes of them and their locations are set) - [Store]
+        :return: the number of stores added - int
+        """
+        if len(stores) == 0:
+            return 0
+        in_transaction = self.db.in_transaction
+        if not in_transaction:
+            self.db.execute('BEGIN IMMEDIATE')  # Lock the database so nothing else can take the IDs we're handing out
+        try:
+            next_store_id = self._get_next_id(Store.DB_TABLE_NAME)
+            next_location_id = self._get_next_id(Location.DB_TABLE_NAME)
+            store_rows = list()
+            location_rows = list()
+            for store in stores:
+                store.id = next_store_id
+                store.location.id = next_location_id
+                store.location.store_id = store.id
+                next_store_id += 1
+                next_location_id += 1
+                location_rows.append(LocationInfoAccessor.get_location_data(store.location))
+                store_rows.append(self.get_store_data(store))
+            self.loc_info_accessor._save_many(Location.DB_TABLE_NAME, location_rows, False)
+            self._save_many(Store.DB_TABLE_NAME, store_rows, False)
+        except Exception:
+            if not in_transaction:
+                self.db.rollback()
+            raise
+        if not in_transaction:
+            self.db.commit()
+        return len(stores)
+
+    def sync_stores(self, stores, zipcodes=None):
+        """
+        Brings the saved stores up to date with freshly downloaded ones, in a single transaction. Stores are matched up
+        by their Supermarket API store ID, and the content hash saved with each one is used to tell if it has changed,
+        so only the stores that were added, changed or removed are written.
+        :param stores: the downloaded stores (the id attributes of them and their locations are set if saved) - [Store]
+        :param zipcodes: (optional) the ZIP codes that were downloaded in full. Saved stores located in one of them that
+         weren't downloaded are removed. - set<int>
+        :return: the store IDs that were added, changed and removed, along with how many stores were unchanged and how
+         many duplicate rows (left by saving the same store more than once) were removed - dict
+        """
+        stores_dict = {}
+        for store in stores:
+            stores_dict.setdefault(store.store_id, store)
+
+        in_transaction = self.db.in_transaction
+        if not in_transaction:
+            self.db.execute('BEGIN IMMEDIATE')
+        try:
+            # Find the saved rows for the downloaded stores, keeping the first of any duplicates
+            saved = {}
+            duplicate_rows = list()
+            store_ids = list(stores_dict.keys())
+            for i in range(0, len(store_ids), self.MAX_QUERY_VALUES):
+                chunk = store_ids[i:i + self.MAX_QUERY_VALUES]
+                sql = '{} WHERE s.store_id IN ({}) ORDER BY s.id'.format(self.SQL_SELECT_STORE_HASHES, ','.join('?' * len(chunk)))
+                for row in self._query_db(sql, chunk):
+                    if row['store_id'] in saved:
+                        duplicate_rows.append(row)
+                    else:
+                        saved[row['store_id']] = row
+
+            added = list()
+            changed = list()
+            unchanged = 0
+            for store_id, store in stores_dict.items():
+                row = saved.get(store_id)
+                if row is None:
+                    added.append(store)
+                elif row['content_hash'] != self.get_store_hash(store):
+                    changed.append((row, store))
+                else:
+                    unchanged += 1
+
+            removed_rows = list()
+            if zipcodes:
+                sql = '{} WHERE l.zipcode>=? AND l.zipcode<=?'.format(self.SQL_SELECT_STORE_HASHES)
+                for row in self._query_db(sql, (min(zipcodes), max(zipcodes))):
+                    if row['zipcode'] in zipcodes and row['store_id'] not in stores_dict:
+                        removed_rows.append(row)
+
+            self.save_stores(added)
+
+            store_updates = list()
+            location_updates = list()
+            for row, store in changed:
+                store.id = row['id']
+                store.location.id = row['location_id']
+                store.location.store_id = store.id
+                loc = store.location
+                # Keep the coordinates unless the address changed
+                if (loc.street_address, loc.city, loc.state, loc.zipcode) == \
+                        (row['street_address'], row['city'], row['state'], row['zipcode']):
+                    loc.latitude = row['latitude']
+                    loc.longitude = row['longitude']
+                store_updates.append((store.name, self.get_store_hash(store), store.id))
+                location_updates.append((loc.street_address, loc.city, loc.state, loc.zipcode, loc.latitude, loc.longitude, loc.id))
+            self.db.executemany('UPDATE {} SET name=?, content_hash=? WHERE id=?'.format(Store.DB_TABLE_NAME), store_updates)
+            self.db.executemany('UPDATE {} SET street_address=?, city=?, state=?, zipcode=?, latitude=?, longitude=? '
+                                'WHERE id=?'.format(Location.DB_TABLE_NAME), location_updates)
+
+            deleted_rows = duplicate_rows + removed_rows
+            self.db.executemany('DELETE FROM {} WHERE id=?'.format(Store.DB_TABLE_NAME), ((row['id'],) for row in deleted_rows))
+            self.db.executemany('DELETE FROM {} WHERE id=?'.format(Location.DB_TABLE_NAME), ((row['location_id'],) for row in deleted_rows))
+        except Exception:
+            if not in_transaction:
+                self.db.rollback()
+            raise
+        if not in_transaction:
+            self.db.commit()
+
+        return {
+            'added': [store.store_id for store in added],
+            'changed': [store.store_id for row, store in changed],
+            'removed': [row['store_id'] for row in removed_rows],
+            'unchanged': unchanged,
+            'duplicates': len(duplicate_rows),
+        }
+
+    def get_version(self):
+        """ Gets a number that goes up whenever a store or location is added, changed or removed.
+        :return: the version - int
+        """
+        sql = 'SELECT IFNULL(SUM(version), 0) AS version FROM {} WHERE table_name IN (?, ?)'.format(TABLE_VERSIONS_TABLE_NAME)
+        return self._query_db(sql, (Store.DB_TABLE_NAME, Location.DB_TABLE_NAME), True)['version']
+
+    def get_saved_store_ids(self, store_ids):
+        """ Finds which of the given Supermarket API store IDs are already saved in the database.
+        :param store_ids: the store IDs to look for - iterable<string>
+        :return: the store IDs that were found - set<string>
+        """
+        store_ids = list(set(store_ids))
+        found = set()
+        # Look them up in chunks, since SQLite limits the number of values a query can have
+        for i in range(0, len(store_ids), self.MAX_QUERY_VALUES):
+            chunk = store_ids[i:i + self.MAX_QUERY_VALUES]
+            sql = 'SELECT store_id FROM {} WHERE store_id IN ({})'.format(Store.DB_TABLE_NAME, ','.join('?' * len(chunk)))
+            found.update(row['store_id'] for row in self._query_db(sql, chunk))
+        return found
+
+    @staticmethod
+    def get_store_data(store):
+        """ Gets the values to save in the stores table for a store.
+        :param store: the store - Store
+        :return: the values, keyed by column name - dict
+        """
+        return {
+            'id': store.id,
+            'store_id': store.store_id,
+            'name': store.name,
+            'location_id': store.location.id,
+            'content_hash': StoreInfoAccessor.get_store_hash(store),
+        }
+
+    @staticmethod
+    def get_store_hash(store):
+        """ Gets a hash of the information about a store that comes from the Supermarket API, for telling whether it
+            has changed since it was saved. The coordinates aren't included, as they're looked up separately.
+        :param store: the store - Store
+        :return: the hash, as 40 hex digits - string
+        """
+        loc = store.location
+        values = (store.name, loc.street_address, loc.city, loc.state, loc.zipcode)
+        content = '\x1f'.join('' if val is None else str(val) for val in values)
+        return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+
 class LocationInfoAccessor(DatabaseAccessor):
+
+    MILES_PER_DEGREE_LAT = 69
+
     def __init__(self, db=None):
         super().__init__(db)
 
@@ -215,12 +741,15 @@ class LocationInfoAccessor(DatabaseAccessor):
         """ Gets all of the locations stored in the database.
         :return: a Location object containing all the location's information - Location
         """
+        return list(self.iter_all_locations())
+
+    def iter_all_locations(self, batch_size=DatabaseAccessor.FETCH_BATCH_SIZE):
+        """ Goes through all of the locations in the database without loading them all at once.
+        :param batch_size: the number of locations to read from the database at a time - int
+        :return: a generator of Location objects
+        """
         location_sql = 'SELECT * FROM {}'.format(Location.DB_TABLE_NAME)
-        query_res = self._query_db(location_sql, ())
-        res = list()
-        for row in query_res:
-            res.append(self.__parse_location(row))
-        return res
+        return self._iter_objects(location_sql, (), self.__location_parser, batch_size)
 
     def get_locations_in_zip_range(self, start_zip, end_zip):
         """ Gets the information for locations in ZIP codes in the given range.
@@ -228,40 +757,111 @@ class LocationInfoAccessor(DatabaseAccessor):
         :param end_zip: the ending ZIP code (also searched) - int
         :return: a list of Location objects in the given ZIP range - [Location]
         """
-        sql = 'SELECT * FROM {} WHERE zipcode>={} AND zipcode<={}'.format(Location.DB_TABLE_NAME, start_zip, end_zip)
-        query_res = self._query_db(sql, ())
-        res = list()
-        for row in query_res:
-            res.append(self.__parse_location(row))
-        return res
+        sql = 'SELECT * FROM {} WHERE zipcode>=? AND zipcode<=?'.format(Location.DB_TABLE_NAME)
+        return self._query_objects(sql, (start_zip, end_zip), self.__location_parser)
+
+    def get_locations_within_radius(self, latitude, longitude, miles, limit=None):
+        """ Gets the locations within a certain distance of a point, closest first (see get_radius_filter). Locations
+            without coordinates aren't included.
+        :param latitude: the latitude of the point in decimal degrees - float
+        :param longitude: the longitude of the point in decimal degrees - float
+        :param miles: the search radius in miles - float
+        :param limit: (optional) the most locations to return - int
+        :return: a list of Location objects in the search radius - [Location]
+        """
+        radius_sql, args = self.get_radius_filter(latitude, longitude, miles, limit)
+        sql = 'SELECT l.* FROM {tn} l {radius}'.format(tn=Location.DB_TABLE_NAME, radius=radius_sql)
+        return self._query_objects(sql, args, self.__location_parser)
+
+    @staticmethod
+    def get_radius_filter(latitude, longitude, miles, limit=None):
+        """ Builds the SQL for finding the rows of a query on the locations table (aliased as "l") that are within a certain
+            distance of a point, closest first. The spatial index narrows the search down to a bounding box, and the
+            distances within it are worked out with an equirectangular approximation (accurate to well under 1% at the
+            distances people drive to go shopping).
+        :param latitude: the latitude of the point in decimal degrees - float
+        :param longitude: the longitude of the point in decimal degrees - float
+        :param miles: the search radius in miles - float
+        :param limit: (optional) the most rows to return - int
+        :return: the SQL to go after the FROM clause, and the named arguments it uses - (string, dict)
+        """
+        # Longitude lines get closer together further from the equator
+        long_scale = max(math.cos(math.radians(latitude)), 0.01)
+        radius_lat = miles / LocationInfoAccessor.MILES_PER_DEGREE_LAT
+        radius_long = radius_lat / long_scale
+        dist_sql = '((l.latitude - :lat)*(l.latitude - :lat) + (l.longitude - :long)*(l.longitude - :long)*:long_scale_sq)'
+        sql = 'JOIN {rt} r ON r.id=l.id ' \
+              'WHERE r.max_lat>=:min_lat AND r.min_lat<=:max_lat AND r.max_long>=:min_long AND r.min_long<=:max_long ' \
+              'AND {dist}<=:radius_sq ORDER BY {dist} LIMIT :limit' \
+            .format(rt=DatabaseCreator.SPATIAL_INDEX_NAME, dist=dist_sql)
+        args = {
+            'lat': latitude,
+            'long': longitude,
+            'long_scale_sq': long_scale*long_scale,
+            'min_lat': latitude - radius_lat,
+            'max_lat': latitude + radius_lat,
+            'min_long': longitude - radius_long,
+            'max_long': longitude + radius_long,
+            'radius_sq': radius_lat*radius_lat,
+            'limit': limit if limit is not None else -1,  # A negative limit means no limit
+        }
+        return sql, args
+
+    def get_ungeocoded_locations(self, start_zip=None, end_zip=None, limit=None):
+        """ Gets the locations whose coordinates haven't been looked up yet.
+        :param start_zip: (optional) the starting ZIP code - int
+        :param end_zip: (optional) the ending ZIP code (also searched) - int
+        :param limit: (optional) the most locations to return - int
+        :return: a list of Location objects without coordinates - [Location]
+        """
+        sql = 'SELECT * FROM {} WHERE (latitude IS NULL OR longitude IS NULL)'.format(Location.DB_TABLE_NAME)
+        args = list()
+        if start_zip is not None:
+            sql += ' AND zipcode>=?'
+            args.append(start_zip)
+        if end_zip is not None:
+            sql += ' AND zipcode<=?'
+            args.append(end_zip)
+        sql += ' ORDER BY id LIMIT ?'
+        args.append(limit if limit is not None else -1)  # A negative limit means no limit
+        return self._query_objects(sql, args, self.__location_parser)
+
+    def save_coordinates(self, locations, commit=True):
+        """ Saves just the coordinates of many locations at once.
+        :param locations: the locations (already in the database) - [Location]
+        :param commit: if False, leaves committing to the caller - bool
+        """
+        sql = 'UPDATE {} SET latitude=?, longitude=? WHERE id=?'.format(Location.DB_TABLE_NAME)
+        self.db.executemany(sql, ((loc.latitude, loc.longitude, loc.id) for loc in locations))
+        if commit:
+            self.db.commit()
 
     def get_location(self, location_id):
         """ Gets the information for a location.
         :param location_id: the unique ID for the location - int
-        :return: a Location object containing all the location's information - Location
+        :return: a Location object containing all the location's information, or None if there isn't a location with
+         that ID - Location
         """
-        sql = 'SELECT * FROM {} WHERE id={}'.format(Location.DB_TABLE_NAME, location_id)
-        row = self._query_db(sql, (), True)
-        return self.__parse_location(row)
+        sql = 'SELECT * FROM {} WHERE id=?'.format(Location.DB_TABLE_NAME)
+        return self._query_objects(sql, (location_id,), self.__location_parser, True)
 
     @staticmethod
-    def __parse_location(row):
-        """ Internal method for parsing the results of a database query and saving it into a Location object """
-        loc = Location(
-            row['street_address'],
-            row['city'],
-            row['state'],
-            row['zipcode'],
-            row['latitude'],
-            row['longitude'],
-            row['id'],
-            row['store_id']
-        )
-        return loc
+    def __location_parser(columns):
+        """ Internal method for making a function that turns the rows of a query on the locations table into Location
+            objects (see _iter_objects)
+        """
+        values = itemgetter(columns['street_address'], columns['city'], columns['state'], columns['zipcode'],
+                            columns['latitude'], columns['longitude'], columns['id'], columns['store_id'])
+        return lambda row: Location(*values(row))
 
-    def save_location(self, location):
-        """" Saves a location to the database """
-        data = {
+    @staticmethod
+    def get_location_data(location):
+        """ Gets the values to save in the locations table for a location.
+        :param location: the location - Location
+        :return: the values, keyed by column name - dict
+        """
+        return {
+            'id': location.id,
             'store_id': location.store_id,
             'street_address': location.street_address,
             'city': location.city,
@@ -270,12 +870,164 @@ class LocationInfoAccessor(DatabaseAccessor):
             'latitude': location.latitude,
             'longitude': location.longitude,
         }
+
+    def save_location(self, location):
+        """" Saves a location to the database """
+        data = self.get_location_data(location)
+        del data['id']
         new_row_id = self._save(location.DB_TABLE_NAME, data, location.id)
         if new_row_id:
             location.id = new_row_id
         return new_row_id
 
 
+class CrawlProgressAccessor(DatabaseAccessor):
+    def __init__(self, db=None):
+        super().__init__(db)
+
+    def get_crawled_zipcodes(self, start_zip, end_zip, since=0):
+        """ Gets the ZIP codes in a range whose stores have been crawled since a certain time.
+        :param start_zip: the starting ZIP code - int
+        :param end_zip: the ending ZIP code (also searched) - int
+        :param since: only include ZIP codes crawled at or after this time (in seconds since the epoch) - float
+        :return: the ZIP codes found - set<int>
+        """
+        sql = 'SELECT zipcode FROM {} WHERE zipcode>=? AND zipcode<=? AND crawled_at>=?'.format(CRAWL_PROGRESS_TABLE_NAME)
+        return set(row['zipcode'] for row in self._query_db(sql, (start_zip, end_zip, since)))
+
+    def save_crawled_zipcodes(self, store_counts, crawled_at, commit=True):
+        """ Records that ZIP codes have been crawled.
+        :param store_counts: the number of stores found in each ZIP code, keyed by ZIP code - dict<int,int>
+        :param crawled_at: when they were crawled (in seconds since the epoch) - float
+        :param commit: if False, leaves committing to the caller (e.g. to save the stores found in the same transaction) - bool
+        """
+        sql = 'INSERT OR REPLACE INTO {} (zipcode, store_count, crawled_at) VALUES (?, ?, ?)'.format(CRAWL_PROGRESS_TABLE_NAME)
+        self.db.executemany(sql, ((zipcode, count, crawled_at) for zipcode, count in store_counts.items()))
+        if commit:
+            self.db.commit()
+
+
+class StoreItemInfoAccessor(DatabaseAccessor):
+    def __init__(self, db=None):
+        super().__init__(db)
+
+    def get_store_items(self, store_ids, ingredients):
+        """ Gets what was last found out about whether stores carry ingredients.
+        :param store_ids: the Supermarket API IDs of the stores - [string]
+        :param ingredients: the (normalized) ingredients - [string]
+        :return: (whether the store has the ingredient, the IDs of the matching items, when it was looked up in seconds
+         since the epoch), keyed by (store ID, ingredient). Pairs that were never looked up are left out.
+         - dict<(string,string),(bool,[string],float)>
+        """
+        store_ids = list(set(store_ids))
+        ingredients = list(set(ingredients))
+        res = dict()
+        if len(ingredients) == 0:
+            return res
+        chunk_size = max(self.MAX_QUERY_VALUES - len(ingredients), 1)
+        for i in range(0, len(store_ids), chunk_size):
+            chunk = store_ids[i:i + chunk_size]
+            sql = 'SELECT * FROM {} WHERE store_id IN ({}) AND ingredient IN ({})'\
+                .format(STORE_ITEMS_TABLE_NAME, ','.join('?' * len(chunk)), ','.join('?' * len(ingredients)))
+            for row in self._query_db(sql, chunk + ingredients):
+                item_ids = row['item_ids'].split(',') if row['item_ids'] else []
+                res[(row['store_id'], row['ingredient'])] = (bool(row['available']), item_ids, row['fetched_at'])
+        return res
+
+    def save_store_items(self, store_items, commit=True):
+        """ Saves whether stores carry ingredients, replacing what was saved before.
+        :param store_items: (store ID, ingredient, whether the store has it, the IDs of the matching items, when it
+         was looked up in seconds since the epoch) for each lookup - [(string,string,bool,[string],float)]
+        :param commit: if False, leaves committing to the caller - bool
+        """
+        sql = 'INSERT OR REPLACE INTO {} (store_id, ingredient, available, item_ids, fetched_at) ' \
+              'VALUES (?, ?, ?, ?, ?)'.format(STORE_ITEMS_TABLE_NAME)
+        self.db.executemany(sql, ((store_id, ingredient, int(available), ','.join(item_ids), fetched_at)
+                                  for store_id, ingredient, available, item_ids, fetched_at in store_items))
+        if commit:
+            self.db.commit()
+
+
+class GeocodeInfoAccessor(DatabaseAccessor):
+    def __init__(self, db=None):
+        super().__init__(db)
+
+    def get_geocodes(self, addresses):
+        """ Gets the saved coordinates of addresses.
+        :param addresses: the normalized addresses - [string]
+        :return: (latitude, longitude) keyed by address, leaving out addresses that haven't been saved - dict<string,(float,float)>
+        """
+        addresses = list(set(addresses))
+        res = dict()
+        for i in range(0, len(addresses), self.MAX_QUERY_VALUES):
+            chunk = addresses[i:i + self.MAX_QUERY_VALUES]
+            sql = 'SELECT * FROM {} WHERE address IN ({})'.format(GEOCODES_TABLE_NAME, ','.join('?' * len(chunk)))
+            for row in self._query_db(sql, chunk):
+                res[row['address']] = (row['latitude'], row['longitude'])
+        return res
+
+    def save_geocodes(self, geocodes, geocoded_at, commit=True):
+        """ Saves the coordinates of addresses.
+        :param geocodes: (latitude, longitude) keyed by normalized address - dict<string,(float,float)>
+        :param geocoded_at: when they were looked up (in seconds since the epoch) - float
+        :param commit: if False, leaves committing to the caller - bool
+        """
+        sql = 'INSERT OR REPLACE INTO {} (address, latitude, longitude, geocoded_at) VALUES (?, ?, ?, ?)'.format(GEOCODES_TABLE_NAME)
+        self.db.executemany(sql, ((address, lat, long, geocoded_at) for address, (lat, long) in geocodes.items()))
+        if commit:
+            self.db.commit()
+
+
+class DistanceInfoAccessor(DatabaseAccessor):
+    def __init__(self, db=None):
+        super().__init__(db)
+
+    def get_distances(self, location_ids):
+        """ Gets the saved driving distances between every pair of the given locations.
+        :param location_ids: the row IDs of the locations - [int]
+        :return: the number of miles from one location to another, keyed by (origin ID, destination ID), leaving out
+         pairs that haven't been saved - dict<(int,int),float>
+        """
+        location_ids = list(set(location_ids))
+        res = dict()
+        # Each query can only have so many values, so go through the origins in chunks, each against all destinations
+        chunk_size = max(self.MAX_QUERY_VALUES - len(location_ids), 1)
+        for i in range(0, len(location_ids), chunk_size):
+            chunk = location_ids[i:i + chunk_size]
+            sql = 'SELECT origin_id, destination_id, miles FROM {} WHERE origin_id IN ({}) AND destination_id IN ({})'\
+                .format(DISTANCES_TABLE_NAME, ','.join('?' * len(chunk)), ','.join('?' * len(location_ids)))
+            for row in self._query_db(sql, chunk + location_ids):
+                res[(row['origin_id'], row['destination_id'])] = row['miles']
+        return res
+
+    def get_detour_samples(self, limit):
+        """ Gets the newest saved driving distances along with where they go from and to, for learning how much longer
+            driving is than going as the crow flies.
+        :param limit: the most distances to get - int
+        :return: (origin ZIP code, miles, origin latitude, origin longitude, destination latitude, destination
+         longitude) for each distance - [(int,float,float,float,float,float)]
+        """
+        sql = 'SELECT o.zipcode AS zipcode, d.miles AS miles, o.latitude AS lat1, o.longitude AS long1, ' \
+              't.latitude AS lat2, t.longitude AS long2 FROM {dt} d ' \
+              'JOIN {lt} o ON o.id=d.origin_id JOIN {lt} t ON t.id=d.destination_id ' \
+              'WHERE o.zipcode IS NOT NULL AND o.latitude IS NOT NULL AND o.longitude IS NOT NULL ' \
+              'AND t.latitude IS NOT NULL AND t.longitude IS NOT NULL ' \
+              'ORDER BY d.fetched_at DESC LIMIT ?'.format(dt=DISTANCES_TABLE_NAME, lt=Location.DB_TABLE_NAME)
+        return [(row['zipcode'], row['miles'], row['lat1'], row['long1'], row['lat2'], row['long2'])
+                for row in self._query_db(sql, (limit,))]
+
+    def save_distances(self, distances, fetched_at, commit=True):
+        """ Saves driving distances between locations.
+        :param distances: (origin ID, destination ID, miles) for each pair - [(int,int,float)]
+        :param fetched_at: when they were looked up (in seconds since the epoch) - float
+        :param commit: if False, leaves committing to the caller - bool
+        """
+        sql = 'INSERT OR REPLACE INTO {} (origin_id, destination_id, miles, fetched_at) VALUES (?, ?, ?, ?)'.format(DISTANCES_TABLE_NAME)
+        self.db.executemany(sql, ((origin_id, destination_id, miles, fetched_at) for origin_id, destination_id, miles in distances))
+        if commit:
+            self.db.commit()
+
+
 class FoodItemInfoAccessor(DatabaseAccessor):
     def __init__(self, db=None):
         super().__init__(db)
@@ -283,20 +1035,18 @@ class FoodItemInfoAccessor(DatabaseAccessor):
     def get_food_item_by_row_id(self, row_id):
         """ Gets the information for a food item.
         :param row_id: the unique database row ID for the food item - int
-        :return: a FoodItem object containing all the food item's information - FoodItem
+        :return: a FoodItem object containing all the food item's information, or None if it isn't found - FoodItem
         """
-        sql = 'SELECT * FROM {} WHERE id={}'.format(FoodItem.DB_TABLE_NAME, row_id)
-        row = self._query_db(sql, (), True)
-        return self.__parse_food_item(row)
+        sql = 'SELECT * FROM {} WHERE id=?'.format(FoodItem.DB_TABLE_NAME)
+        return self._query_objects(sql, (row_id,), self.__food_item_parser, True)
 
     def get_food_item_by_item_id(self, item_id):
         """ Gets the information for a food item.
         :param item_id: the unique Supermarket API item ID or the UPC code - string
-        :return: a FoodItem object containing all the food item's information - FoodItem
+        :return: a FoodItem object containing all the food item's information, or None if it isn't found - FoodItem
         """
-        sql = 'SELECT * FROM {} WHERE id={}'.format(FoodItem.DB_TABLE_NAME, item_id)
-        row = self._query_db(sql, (), True)
-        return self.__parse_food_item(row)
+        sql = 'SELECT * FROM {} WHERE item_id=?'.format(FoodItem.DB_TABLE_NAME)
+        return self._query_objects(sql, (item_id,), self.__food_item_parser, True)
 
     def get_foods_by_name(self, name):
         """
@@ -304,30 +1054,38 @@ class FoodItemInfoAccessor(DatabaseAccessor):
         :param name: the word(s) to use when searching for a matching item name - string
         :return: 
         """
-        # TODO Use a more robust method for string escaping and SQL injection prevention
-        name = name.replace("'", "''")
-        name = name.replace('"', '""')
-        sql = 'SELECT * FROM {} WHERE name LIKE "%{}%"'.format(FoodItem.DB_TABLE_NAME, name)
-        rows = self._query_db(sql, ())
-        res = list()
-        for row in rows:
-            res.append(self.__parse_food_item(row))
-        return res
+        # Escape the LIKE wildcards so they're matched literally
+        name = name.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        sql = "SELECT * FROM {} WHERE name LIKE ? ESCAPE '\\'".format(FoodItem.DB_TABLE_NAME)
+        return self._query_objects(sql, ('%{}%'.format(name),), self.__food_item_parser)
+
 
+    def search_foods(self, query, limit=None):
+        """
+        Searches the full-text index for items whose names contain all the words in the query (or words starting with
+        them, so "squash" finds "butternut squash" and "squashes").
+        :param query: the word(s) to search for - string
+        :param limit: (optional) the most items to return - int
+        :return: the matching items, best match first - [FoodItem]
+        """
+        # Quote each word so punctuation in it can't be read as search syntax, then match it as a prefix
+        words = re.findall(r'\w+', query)
+        if len(words) == 0:
+            return []
+        match = ' '.join('"{}"*'.format(word) for word in words)
+        sql = 'SELECT i.* FROM {fts} JOIN {tn} i ON i.id={fts}.rowid WHERE {fts} MATCH ? ORDER BY rank LIMIT ?'\
+            .format(fts=DatabaseCreator.SEARCH_INDEX_NAME, tn=FoodItem.DB_TABLE_NAME)
+        # A negative limit means no limit
+        return self._query_objects(sql, (match, limit if limit is not None else -1), self.__food_item_parser)
 
     @staticmethod
-    def __parse_food_item(row):
-        """ Internal method for parsing the results of a database query and saving it into a Location object """
-        item = FoodItem(
-            row['item_id'],
-            row['name'],
-            row['aisle'],
-            row['category'],
-            row['description'],
-            row['image_url'],
-            row['id']
-        )
-        return item
+    def __food_item_parser(columns):
+        """ Internal method for making a function that turns the rows of a query on the items table into FoodItem
+            objects (see _iter_objects)
+        """
+        values = itemgetter(columns['item_id'], columns['name'], columns['aisle'], columns['category'],
+                            columns['description'], columns['image_url'], columns['id'])
+        return lambda row: FoodItem(*values(row))
 
     def save_item(self, item):
         """
@@ -347,3 +1105,17 @@ class FoodItemInfoAccessor(DatabaseAccessor):
         if new_row_id:
             item.id = new_row_id
         return new_row_id
+
+    def save_items(self, items, commit=True):
+        """
+        Saves many items at once. Items whose item ID is already in the database are updated rather than added again.
+        :param items: the items to be saved - [FoodItem]
+        :param commit: if False, leaves committing to the caller - bool
+        :return: the number of items saved - int
+        """
+        sql = 'INSERT INTO {} (item_id, name) VALUES (?, ?) ' \
+              'ON CONFLICT(item_id) DO UPDATE SET name=excluded.name'.format(FoodItem.DB_TABLE_NAME)
+        self.db.executemany(sql, ((item.item_id, item.name) for item in items))
+        if commit:
+            self.db.commit()
+        return len(items)
@@ -1,69 +1,117 @@
 """ Imports the Grocery UPC Database (http://www.grocery.com/open-grocery-database-project/) into the database """
-# import csv
-import xlrd
+import csv
+import itertools
 import os
-from database import FoodItemInfoAccessor
+import time
+import argparse
+import openpyxl
+from database import FoodItemInfoAccessor, DatabaseCreator
 from models import FoodItem
-from flask import Flask
-
-app = Flask(__name__)
 
 UPC_XLSX_NAME = 'Grocery_UPC_Database.xlsx'
+UPC_XLSX_PATH = os.path.dirname(os.path.realpath(__file__)) + '/' + UPC_XLSX_NAME
+UPC_DOWNLOAD_URL = 'http://www.grocery.com/download-file/19054'
+DEFAULT_BATCH_SIZE = 5000
 
-with app.app_context():
 
-    fia = FoodItemInfoAccessor()
+def read_xlsx_rows(path):
+    """ Reads the rows of the first sheet of a spreadsheet one at a time, without loading the whole file.
+        :param path: the path to the .xlsx file - string
+        :return: a generator of rows, each a tuple of cell values (skipping the column names)
+    """
+    book = openpyxl.load_workbook(path, read_only=True)
+    try:
+        sheet = book.worksheets[0]
+        for row in sheet.iter_rows(min_row=2, values_only=True):  # Skip the first row, as it's just column names
+            yield row
+    finally:
+        book.close()
+
+
+def read_csv_rows(path):
+    """ Reads the rows of a CSV file one at a time.
+        :param path: the path to the .csv file - string
+        :return: a generator of rows, each a list of cell values (skipping the column names)
+    """
+    with open(path, newline='', encoding='utf-8') as csvfile:
+        reader = csv.reader(csvfile)
+        next(reader, None)  # Skip the first row, as it's just column names
+        for row in reader:
+            yield row
+
+
+def parse_item(row):
+    """ Creates a FoodItem from a row of the Grocery UPC Database.
+        :param row: the cell values (item ID, UPC-14, UPC-12, brand, name) - tuple
+        :return: the item, or None if the row is blank - FoodItem
+    """
+    if not row or row[0] is None or row[0] == '':
+        return None
+    item_id = int(float(row[0]))  # Spreadsheets store the ID as a float
+    name = str(row[4]).replace('"', '')
+    return FoodItem(item_id, name, None, None, None, None)
 
-    # line_count = 0
+
+def import_upc_data(path=UPC_XLSX_PATH, batch_size=DEFAULT_BATCH_SIZE):
+    """ Imports the Grocery UPC Database, downloading it first if the file doesn't exist. The rows are streamed from
+        the file and saved in batches, one transaction per batch. Items that were already imported are updated rather
+        than duplicated, so this can safely be re-run.
+        :param path: the path to the .xlsx or .csv file - string
+        :param batch_size: the number of items to save in each transaction - int
+        :return: the number of items imported - int
+    """
+    DatabaseCreator().init_db()
+    fia = FoodItemInfoAccessor()
 
     # Check for UPC data file, download it if it doesn't exist
     print('Checking for grocery UPC data...')
-    if not os.path.exists(os.path.dirname(os.path.realpath(__file__)) + '/' + UPC_XLSX_NAME):
+    if not os.path.exists(path):
         print('Downloading grocery UPC database...')
         import urllib.request
 
-        urllib.request.urlretrieve('http://www.grocery.com/download-file/19054', UPC_XLSX_NAME)
+        urllib.request.urlretrieve(UPC_DOWNLOAD_URL, path)
         print('Finished downloading.')
     else:
         print('Grocery UPC database already downloaded.')
 
-    print('Opening the data file...')
-    # Import the data from the spreadsheet
-    book = xlrd.open_workbook(UPC_XLSX_NAME)
+    print('Importing the data...')
+    rows = read_csv_rows(path) if path.lower().endswith('.csv') else read_xlsx_rows(path)
+    items = (item for item in map(parse_item, rows) if item)
+
+    start_time = time.time()
+    count = 0
+    while True:
+        batch = list(itertools.islice(items, batch_size))
+        if len(batch) == 0:
+            break
+        count += fia.save_items(batch)
+        duration = time.time() - start_time
+        print('Saved {0} items ({1:0.0f} items/s)'.format(count, count/duration if duration else 0))
 
-    sheet = book.sheets()[0]
+    duration = time.time() - start_time
+    print('Grocery UPC data successfully imported: {0} items in {1:0.3f}s'.format(count, duration))
+    return count
 
-    print('Importing the data...')
-    for r in range(1, sheet.nrows):  # Skip the first row, as it's just column names
-        # row = sheet.row(r)
-        item_id = int(sheet.cell(r, 0).value)
-        upc12 = int(sheet.cell(r, 2).value)
-        name = sheet.cell(r, 4).value.replace('"', '')
-        item = FoodItem(item_id, name, None, None, None, None)
-        fia.save_item(item)
-        if r % 100 == 0:
-            print('Successfully saved row', r)
-    print('Grocery UPC data successfully imported.')
-
-    # CSV method:
-    # with open('static/Grocery_UPC_Database.csv', newline='', encoding='utf-8') as csvfile:
-    #     try:
-    #         reader = csv.reader(csvfile, delimiter=',', quotechar='|')
-    #         for row in reader:
-    #             # if reader.line_num == 652:
-    #             #     stop = True
-    #             item_id = row[0]
-    #             line_count += 1
-    #             if reader.line_num == 1:
-    #                 continue  # Skip the first row, which is column names
-    #             # upc14 = row[1]
-    #             upc12 = row[2]
-    #             name = row[4].replace('"', '')
-    #             item = FoodItem(item_id, name, None, None, None, None)
-    #             fia.save_item(item)
-    #     finally:
-    #         print('Last row looked at:', line_count)
-    #         fia.close()
-    #         csvfile.close()
-    # print('Finished reading Grocery_UPC_Database.csv and saving its info to the database.')
 
+""" Make it so we can run this script and pass parameters from the command line """
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-f',
+        '--file',
+        action='store',
+        dest='path',
+        default=UPC_XLSX_PATH,
+        help='the .xlsx or .csv file to import (downloaded if it is missing)',
+    )
+    parser.add_argument(
+        '-b',
+        '--batch-size',
+        action='store',
+        dest='batch_size',
+        default=DEFAULT_BATCH_SIZE,
+        type=int,
+    )
+
+    args = parser.parse_args()
+    import_upc_data(args.path, args.batch_size)
@@ -0,0 +1,145 @@
+"""
+    Looks up the coordinates of every saved store that doesn't have them yet, so
+    that the web app never has to wait for stores to be geocoded.
+"""
+
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from database import ConnectionPool, LocationInfoAccessor, GeocodeInfoAccessor, DatabaseCreator
+from geolocation import Geolocation
+
+DEFAULT_WORKERS = 10  # Google allows 50 geocoding requests per second
+DEFAULT_BATCH_SIZE = 500  # Addresses to geocode before saving them
+
+
+def geocode_stores(start_zip=None, end_zip=None, worker_count=DEFAULT_WORKERS, batch_size=DEFAULT_BATCH_SIZE):
+    """ Saves the coordinates of all the store locations that don't have them yet. Addresses that have been geocoded
+        before are filled in from the database; the rest are looked up with the Google Maps Geocoding API.
+        :param start_zip: (optional) only geocode locations in this ZIP code or later - int
+        :param end_zip: (optional) only geocode locations in this ZIP code or earlier - int
+        :param worker_count: the number of geocoding requests to make at once - int
+        :param batch_size: the number of addresses to geocode before saving them - int
+        :return: the number of locations geocoded - int
+    """
+    DatabaseCreator().init_db()
+    lia = LocationInfoAccessor()
+    gia = GeocodeInfoAccessor(lia.db)
+
+    locations = lia.get_ungeocoded_locations(start_zip, end_zip)
+    print('Found {} locations without coordinates'.format(len(locations)))
+
+    # Group the locations by address, so each address is only looked up once
+    by_address = dict()
+    skipped = 0
+    for loc in locations:
+        if loc.zipcode is None:  # Not enough of an address to geocode
+            skipped += 1
+            continue
+        place_name = str(loc)
+        by_address.setdefault(Geolocation.normalize_address(place_name), (place_name, list()))[1].append(loc)
+
+    # Fill in the addresses that were geocoded before
+    saved = gia.get_geocodes(by_address.keys())
+    done = list()
+    for address, lat_long in saved.items():
+        for loc in by_address.pop(address)[1]:
+            loc.latitude, loc.longitude = lat_long
+            done.append(loc)
+    lia.save_coordinates(done)
+    count = len(done)
+    print('Filled in {} locations from saved geocodes, {} addresses to look up'.format(count, len(by_address)))
+
+    start_time = time.time()
+    failed = 0
+    looked_up = 0
+    pending = 0  # Addresses looked up since the last save
+    done = list()
+    # Geolocation.get_lat_long saves each address it looks up in the database itself, so only the coordinates of the
+    # locations are left to save here
+    with ThreadPoolExecutor(max_workers=worker_count) as executor:
+        lookups = dict((executor.submit(_geocode, place_name), address)
+                       for address, (place_name, locs) in by_address.items())
+        for lookup in as_completed(lookups):
+            address = lookups[lookup]
+            try:
+                lat_long = lookup.result()
+            except Exception as e:
+                print('Could not geocode {}: {!r}'.format(by_address[address][0], e))
+                failed += 1
+                continue
+            pending += 1
+            looked_up += 1
+            for loc in by_address[address][1]:
+                loc.latitude, loc.longitude = lat_long
+                done.append(loc)
+            if pending >= batch_size:
+                count += _save_geocoded(lia, done)
+                pending = 0
+                done = list()
+                duration = time.time() - start_time
+                print('Geocoded {0} locations ({1:0.1f} addresses/s)'.format(count, looked_up/duration if duration else 0))
+    count += _save_geocoded(lia, done)
+
+    print('Geocoded {0} locations in {1:0.3f}s ({2} addresses could not be geocoded, {3} locations had no ZIP code)'
+          .format(count, time.time() - start_time, failed, skipped))
+    return count
+
+
+def _geocode(place_name):
+    """ Looks up the coordinates of an address on a worker thread, then gives the thread's database connection back to
+        the pool.
+        :return: the address's (latitude, longitude) - (float, float)
+    """
+    try:
+        return Geolocation.get_lat_long(place_name)
+    finally:
+        ConnectionPool.release_connection()
+
+
+def _save_geocoded(lia, locations):
+    """ Saves the coordinates of newly geocoded locations in one transaction.
+        :return: the number of locations saved - int
+    """
+    lia.save_coordinates(locations)
+    return len(locations)
+
+
+""" Make it so we can run this script and pass parameters from the command line """
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-s',
+        '--start-zip',
+        action='store',
+        dest='start_zip',
+        default=None,
+        type=int,
+    )
+    parser.add_argument(
+        '-e',
+        '--end-zip',
+        action='store',
+        dest='end_zip',
+        default=None,
+        type=int,
+    )
+    parser.add_argument(
+        '-w',
+        '--workers',
+        action='store',
+        dest='workers',
+        default=DEFAULT_WORKERS,
+        type=int,
+    )
+    parser.add_argument(
+        '-b',
+        '--batch-size',
+        action='store',
+        dest='batch_size',
+        default=DEFAULT_BATCH_SIZE,
+        type=int,
+    )
+
+    args = parser.parse_args()
+    geocode_stores(args.start_zip, args.end_zip, args.workers, args.batch_size)
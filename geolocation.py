@@ -2,8 +2,14 @@
 
 import json
 import math
+import re
+import threading
+import time
+import numpy as np
+from collections import OrderedDict
 from urllib.parse import urlencode
 from urllib.request import urlopen
+from database import ConnectionPool, GeocodeInfoAccessor, DistanceInfoAccessor
 from import_keys import *
 
 
@@ -13,15 +19,61 @@ class Geolocation:
     GMAPS_DIRECTIONS_URL = "https://maps.googleapis.com/maps/api/directions/json?"
     GMAPS_DIST_BASE_URL = 'https://maps.googleapis.com/maps/api/distancematrix/json?'
     MILES_PER_DEGREE_LAT_LONG = 69
+    EARTH_RADIUS_MILES = 3958.8
+    GEOCODE_CACHE_SIZE = 4096  # Most addresses to keep the coordinates of in memory
+    GEOCODE_TRIES = 3  # Times to try geocoding an address if Google has a temporary problem
+    GEOCODE_RETRY_STATUSES = ('OVER_QUERY_LIMIT', 'UNKNOWN_ERROR')
+
+    # The coordinates of the addresses geocoded most recently, keyed by normalized address (least recently used first)
+    __geocode_cache = OrderedDict()
+    __geocode_cache_lock = threading.Lock()
 
     @staticmethod
     def load_lat_long_for_location(location):
-        """ Loads the coordinates (latitude and longitude) into the Location object by using the Google Maps Geocoding API. """
-        lat_long = Geolocation.__get_lat_long(location.__str__())
+        """ Loads the coordinates (latitude and longitude) into the Location object (see get_lat_long). """
+        lat_long = Geolocation.get_lat_long(location.__str__())
         location.latitude = lat_long[0]
         location.longitude = lat_long[1]
         return lat_long
 
+    @staticmethod
+    def get_lat_long(place_name):
+        """ Gets the coordinates of a place. Addresses that were looked up recently are kept in memory, and (once the
+            database has been created) every address looked up is saved in the database, so the Google Maps Geocoding
+            API is only used for addresses that have never been seen before.
+            :param place_name: the place name or address - string
+            :return: the place's (latitude, longitude) - (float, float)
+        """
+        address = Geolocation.normalize_address(place_name)
+        with Geolocation.__geocode_cache_lock:
+            lat_long = Geolocation.__geocode_cache.get(address)
+            if lat_long is not None:
+                Geolocation.__geocode_cache.move_to_end(address)
+                return lat_long
+
+        gia = GeocodeInfoAccessor() if ConnectionPool.has_database() else None
+        if gia:
+            lat_long = gia.get_geocodes([address]).get(address)
+        if lat_long is None:
+            lat_long = Geolocation.__get_lat_long(place_name)
+            if gia:
+                gia.save_geocodes({address: lat_long}, time.time())
+
+        with Geolocation.__geocode_cache_lock:
+            Geolocation.__geocode_cache[address] = lat_long
+            if len(Geolocation.__geocode_cache) > Geolocation.GEOCODE_CACHE_SIZE:
+                Geolocation.__geocode_cache.popitem(last=False)
+        return lat_long
+
+    @staticmethod
+    def normalize_address(place_name):
+        """ Puts an address in a standard form (lowercase, without punctuation, single spaces), so the same address is
+            only geocoded once however it was typed.
+            :param place_name: the place name or address - string
+            :return: the normalized address - string
+        """
+        return ' '.join(re.sub(r'[^\w\s]', ' ', place_name.lower()).split())
+
     @staticmethod
     def __get_json(url):
         """
@@ -47,12 +99,13 @@ class Geolocation:
 
         params_url = urlencode({'address':place_name, 'key':KEY_GEO})
         url = Geolocation.GMAPS_BASE_URL + params_url
-        try_count = 0
-        while try_count < 3:
+        # ZERO_RESULTS won't change by asking again, so only temporary problems are retried
+        for try_count in range(Geolocation.GEOCODE_TRIES):
+            if try_count > 0:
+                time.sleep(try_count)
             json = Geolocation.__get_json(url)
-            if json['status'] != 'ZERO_RESULTS':
+            if json['status'] not in Geolocation.GEOCODE_RETRY_STATUSES:
                 break
-            try_count += 1
         try:
             first_result = json['results'][0]
         except IndexError as e:
@@ -72,10 +125,42 @@ class Geolocation:
             Geolocation.load_lat_long_for_location(loc1)
         if not loc2.latitude:
             Geolocation.load_lat_long_for_location(loc2)
-        # Math from https://gis.stackexchange.com/questions/142326/calculating-longitude-length-in-miles
-        delta_lat_mi = (loc2.latitude - loc1.latitude)*Geolocation.MILES_PER_DEGREE_LAT_LONG
-        delta_long_mi = (loc2.longitude - loc1.longitude)*math.cos(loc1.latitude)*Geolocation.MILES_PER_DEGREE_LAT_LONG
-        return math.sqrt(math.pow(delta_lat_mi, 2) + math.pow(delta_long_mi, 2))
+        # Haversine formula (https://en.wikipedia.org/wiki/Haversine_formula)
+        lat1, lat2 = math.radians(loc1.latitude), math.radians(loc2.latitude)
+        delta_lat = lat2 - lat1
+        delta_long = math.radians(loc2.longitude - loc1.longitude)
+        a = math.sin(delta_lat/2)**2 + math.cos(lat1)*math.cos(lat2)*math.sin(delta_long/2)**2
+        return 2*Geolocation.EARTH_RADIUS_MILES*math.asin(math.sqrt(a))
+
+    @staticmethod
+    def get_euclidean_dists(latitude, longitude, latitudes, longitudes):
+        """ Gets the distances (as the crow flies, in miles) from one point to many points in one go.
+            :param latitude: the latitude of the starting point in decimal degrees - float
+            :param longitude: the longitude of the starting point in decimal degrees - float
+            :param latitudes: the latitudes of the other points in decimal degrees - numpy.ndarray
+            :param longitudes: the longitudes of the other points in decimal degrees - numpy.ndarray
+            :return the number of miles to each of the other points - numpy.ndarray
+        """
+        lat1 = np.radians(latitude)
+        lat2 = np.radians(np.asarray(latitudes, dtype=np.float64))
+        delta_lat = lat2 - lat1
+        delta_long = np.radians(np.asarray(longitudes, dtype=np.float64) - longitude)
+        a = np.sin(delta_lat/2)**2 + np.cos(lat1)*np.cos(lat2)*np.sin(delta_long/2)**2
+        return 2*Geolocation.EARTH_RADIUS_MILES*np.arcsin(np.sqrt(a))
+
+    @staticmethod
+    def get_nearest(distances, max_distance, number):
+        """ Picks out the closest points within a maximum distance.
+            :param distances: the distance to each point - numpy.ndarray
+            :param max_distance: the furthest a point can be - float
+            :param number: the most points to pick - int
+            :return the indices of the picked points, closest first - numpy.ndarray
+        """
+        in_range = np.flatnonzero(distances <= max_distance)
+        if len(in_range) > number:
+            # Only the closest _number_ need to be sorted
+            in_range = in_range[np.argpartition(distances[in_range], number - 1)[:number]]
+        return in_range[np.argsort(distances[in_range], kind='stable')]
 
     @staticmethod
     def get_travel_distances(origins, destinations):
@@ -84,8 +169,8 @@ class Geolocation:
             :param destinations the ending locations - [Location]
             :return a len(origins) X len(destinations) matrix with the driving distances between each origin and each destination
         """
-        dest_str = '|'.join((Geolocation.format_location_for_google(loc) for loc in origins))
-        origin_str = '|'.join((Geolocation.format_location_for_google(loc) for loc in destinations))
+        origin_str = '|'.join((Geolocation.format_location_for_google(loc) for loc in origins))
+        dest_str = '|'.join((Geolocation.format_location_for_google(loc) for loc in destinations))
         paramsurldist = Geolocation.GMAPS_DIST_BASE_URL + 'units=imperial&origins=' + origin_str + '&destinations=' + dest_str + '&key=' + KEY_DIST
         datadist = Geolocation.__get_json(paramsurldist)
         return datadist
@@ -121,50 +206,224 @@ class Geolocation:
 class DistanceMapper:
     """ Given two locations, tells you the number of miles driving between them. """
 
-    dists = {}
-
-    def load_distances(self, origins, destinations):
-        """ Gets the driving distances between each origin and all the destinations.
-            :param origins: a list of all the locations to calculate driving distances from - [Location]
-            :param destinations: a list of all the locations to calculate driving distances to - [Location]
-            :return a dictionary mapping each origin to each destination (ex: dict[origin][dest] = dist)
-        """
-        # Use the Google Distance Matrix API to get the driving distances between all the locations
-        dists = Geolocation.get_travel_distances(origins, destinations)
-        # Convert the data from JSON to dictionaries indexed by locations
-        if 'error_message' in dists:
-            return -1  # Likely too many origins and destinations for one API call
-        rows = dists['rows']
-        for i in range(len(rows)):
-            cols = rows[i]['elements']
-            origin = origins[i]
-            for j in range(len(cols)):
-                dest = destinations[j]
-                if dest != origin:  # Don't store a path from a location to itself
-                    dist = cols[j]['distance']['value']/1609  # Convert meters to miles
-                    self.add_dist(origin, dest, dist)
-        return self.dists
-
-    def add_dist(self, origin, destination, dist):
-        """ Saves a distance calculation between two locations.
-        :param origin: the originating location - Location
-        :param destination: the end location - Location
-        :param dist: the number of driving miles between the two locations - int
-        """
-        if origin not in self.dists:
-            self.dists[origin] = {}
-        if destination not in self.dists:
-            self.dists[destination] = {}
-        self.dists[origin][destination] = dist
-        self.dists[destination][origin] = dist
-
-    def get_distance(self, origin, destination):
-        """ Looks up the distance between two locations.
-            :param origin: the originating location - Location
-            :param destination: the end location - Location
-            :return the number of driving miles between the two locations - int
-        """
-        # Check to see if we know this distance. If not, load it first.
-        if origin not in self.dists and destination not in self.dists:
-            self.load_distances([origin], [destination])
-        return self.dists[origin][destination]
+    def __init__(self, provider=None):
+        """
+        :param provider: (optional) where load_matrix gets its distances from (real driving distances by default) - DistanceProvider
+        """
+        self.provider = provider if provider else DrivingDistanceProvider()
+        # Each location loaded with load_matrix gets a dense integer index into a distance matrix (equal locations,
+        # i.e. ones with the same address, share an index)
+        self.location_indices = {}
+        self.matrix = None
+
+    def load_matrix(self, locations):
+        """ Gets the distances between every pair of the given locations from the distance provider and stores them in
+            a matrix, which can then be read by index (see get_index and get_distance_by_index). Locations with the
+            same address share an index.
+            :param locations: the locations to get the distances between - [Location]
+            :return the distance matrix in miles, where matrix[i][j] is the distance from location i to j - numpy.ndarray
+        """
+        # Give each distinct address an index
+        self.location_indices = {}
+        unique_locations = list()
+        for loc in locations:
+            if loc not in self.location_indices:
+                self.location_indices[loc] = len(unique_locations)
+                unique_locations.append(loc)
+
+        self.matrix = self.provider.load_matrix(unique_locations)
+        return self.matrix
+
+    def get_index(self, location):
+        """ Looks up a location's index in the distance matrix.
+            :param location: a location passed to load_matrix - Location
+            :return the location's row/column in the matrix - int
+        """
+        return self.location_indices[location]
+
+    def get_distance_by_index(self, origin_index, destination_index):
+        """ Looks up the distance between two locations in the distance matrix.
+            :param origin_index: the originating location's index - int
+            :param destination_index: the end location's index - int
+            :return the number of driving miles between the two locations - float
+        """
+        return float(self.matrix[origin_index, destination_index])
+
+
+class DistanceProvider:
+    """ Somewhere distances between locations can come from (see DistanceMapper). On its own, it gives the distances as
+        the crow flies; subclasses give driving distances instead.
+    """
+
+    def load_matrix(self, locations):
+        """ Gets the distances between every pair of the given locations.
+            :param locations: the locations (all with different addresses and known coordinates) - [Location]
+            :return the distance matrix in miles, where matrix[i][j] is the distance from location i to j - numpy.ndarray
+        """
+        latitudes = np.array([loc.latitude for loc in locations], dtype=np.float64)
+        longitudes = np.array([loc.longitude for loc in locations], dtype=np.float64)
+        # Broadcasting a column of origins against a row of destinations gives the distance between every pair
+        return Geolocation.get_euclidean_dists(latitudes[:, None], longitudes[:, None], latitudes[None, :], longitudes[None, :])
+
+
+class DrivingDistanceProvider(DistanceProvider):
+    """ Real driving distances, from the Google Distance Matrix API. """
+
+    # Limits of one Distance Matrix API call
+    MAX_MATRIX_SIDE = 25  # Origins or destinations
+    MAX_MATRIX_ELEMENTS = 100  # Origins times destinations
+
+    def load_matrix(self, locations):
+        """ Gets the driving distances between every pair of the given locations.
+            Distances between saved locations (ones with a row ID) are kept in the database, so only the pairs that
+            have never been looked up before, and the ones to and from unsaved locations (like the user's), are
+            requested from the Distance Matrix API. They're requested in tiles small enough for one API call each.
+            :param locations: the locations (all with different addresses) - [Location]
+            :return the distance matrix in miles, where matrix[i][j] is the distance from location i to j - numpy.ndarray
+        """
+        n = len(locations)
+        matrix = np.zeros((n, n), dtype=np.float32)
+        missing = ~np.eye(n, dtype=bool)  # A location is always 0 miles from itself
+
+        # Fill in the distances that were saved before
+        saved = [i for i in range(n) if locations[i].id is not None]
+        dia = DistanceInfoAccessor() if ConnectionPool.has_database() else None
+        if dia and saved:
+            index_by_id = dict((locations[i].id, i) for i in saved)
+            for (origin_id, destination_id), miles in dia.get_distances(index_by_id.keys()).items():
+                i, j = index_by_id[origin_id], index_by_id[destination_id]
+                if i != j:
+                    matrix[i, j] = miles
+                    missing[i, j] = False
+
+        # Look up the rest. Locations with nothing known about them (unsaved ones, or new stores) get their whole row
+        # and column looked up, then any gaps left between the other locations are filled in.
+        new = [i for i in range(n) if missing[i].sum() == n - 1]
+        known = [i for i in range(n) if missing[i].sum() < n - 1]
+        fetched = self.__load_tiles(matrix, locations, new, list(range(n)), missing)
+        fetched += self.__load_tiles(matrix, locations, known, new, missing)
+        rows = [i for i in known if missing[i, known].any()]
+        cols = [j for j in known if missing[known, j].any()]
+        fetched += self.__load_tiles(matrix, locations, rows, cols, missing)
+
+        if dia:
+            new_dists = [(locations[i].id, locations[j].id, miles) for i, j, miles in fetched
+                         if locations[i].id is not None and locations[j].id is not None]
+            if new_dists:
+                dia.save_distances(new_dists, time.time())
+        return matrix
+
+    def __load_tiles(self, matrix, locations, origins, destinations, missing):
+        """ Looks up the driving distances from some locations to others with as few Distance Matrix API calls as
+            possible, skipping tiles that have no missing distances, and fills them into the matrix.
+            :param matrix: the distance matrix (updated in-place) - numpy.ndarray
+            :param locations: the locations in the matrix - [Location]
+            :param origins: the indices of the origins - [int]
+            :param destinations: the indices of the destinations - [int]
+            :param missing: which distances in the matrix still need looking up (updated as they are) - numpy.ndarray
+            :return the distances looked up (not the straight-line guesses for ones that couldn't be) - [(int, int, float)]
+        """
+        if len(origins) == 0 or len(destinations) == 0:
+            return []
+        # Make each tile as big as one API call allows
+        cols = min(self.MAX_MATRIX_SIDE, len(destinations))
+        rows = max(1, min(self.MAX_MATRIX_SIDE, self.MAX_MATRIX_ELEMENTS // cols))
+        fetched = list()
+        for r in range(0, len(origins), rows):
+            tile_origins = origins[r:r + rows]
+            for c in range(0, len(destinations), cols):
+                tile_dests = destinations[c:c + cols]
+                if not missing[np.ix_(tile_origins, tile_dests)].any():
+                    continue
+                dists = Geolocation.get_travel_distances([locations[i] for i in tile_origins], [locations[j] for j in tile_dests])
+                ok = 'error_message' not in dists and dists.get('status', 'OK') == 'OK'
+                if not ok:
+                    print('Distance Matrix request failed ({}), using straight-line distances instead'
+                          .format(dists.get('error_message', dists.get('status'))))
+                for a, i in enumerate(tile_origins):
+                    for b, j in enumerate(tile_dests):
+                        if not missing[i, j]:
+                            continue
+                        element = dists['rows'][a]['elements'][b] if ok else {}
+                        if element.get('status', 'OK') == 'OK' and 'distance' in element:
+                            miles = element['distance']['value']/1609  # Convert meters to miles
+                            fetched.append((i, j, miles))
+                        else:
+                            # Can't be driven (or the request failed), so fall back to as the crow flies
+                            miles = Geolocation.get_euclidean_dist(locations[i], locations[j])
+                        matrix[i, j] = miles
+                        missing[i, j] = False
+        return fetched
+
+
+class EstimatedDistanceProvider(DistanceProvider):
+    """ Quick estimates of driving distances, worked out locally: the distance as the crow flies times a detour factor
+        (how much longer roads make the trip). The detour factor for each region (three-digit ZIP code prefix) is
+        learned from the driving distances saved by DrivingDistanceProvider, so estimates get better as more real
+        distances are looked up.
+    """
+
+    DEFAULT_DETOUR_FACTOR = 1.3  # Used until enough real distances have been saved
+    MIN_SAMPLES = 20  # Fewest saved distances to learn a detour factor from
+    MIN_SAMPLE_MILES = 0.5  # Shorter trips are mostly about where the parking lot is, so aren't learned from
+    MAX_SAMPLES = 20000  # Most saved distances to learn from (the newest ones)
+    FACTORS_TTL = 3600  # Seconds before learning the detour factors again
+
+    # Detour factors by region, along with the one for everywhere else, as last learned
+    __factors = None
+    __factors_learned_at = 0
+
+    def load_matrix(self, locations):
+        """ Estimates the driving distances between every pair of the given locations. Every distance is scaled by the
+            same detour factor, the one for the region of the first location (the starting location, when planning a
+            trip): scaling each origin's distances by its own region's factor would let a detour through another
+            region come out shorter than the direct trip, which the route planner relies on never happening.
+            :param locations: the locations (all with different addresses and known coordinates) - [Location]
+            :return the distance matrix in miles, where matrix[i][j] is the distance from location i to j - numpy.ndarray
+        """
+        miles = super().load_matrix(locations)
+        if len(locations) == 0:
+            return miles.astype(np.float32)
+        region_factors, default_factor = self.get_detour_factors()
+        factor = region_factors.get(self.get_region(locations[0].zipcode), default_factor)
+        return (miles * factor).astype(np.float32)
+
+    @staticmethod
+    def get_region(zipcode):
+        """ Gets the region a ZIP code is in (its first three digits), or None if it isn't known. """
+        return zipcode // 100 if zipcode is not None else None
+
+    @staticmethod
+    def get_detour_factors():
+        """ Gets the detour factors learned from the saved driving distances (the median ratio of driving distance to
+            distance as the crow flies), relearning them if they're older than FACTORS_TTL. Until the database has
+            been created, the default is used.
+            :return: the detour factor for each region with enough saved distances, and the one for everywhere else -
+             (dict<int,float>, float)
+        """
+        cls = EstimatedDistanceProvider
+        if cls.__factors is not None and time.time() - cls.__factors_learned_at < cls.FACTORS_TTL:
+            return cls.__factors
+        if not ConnectionPool.has_database():
+            return {}, cls.DEFAULT_DETOUR_FACTOR
+
+        samples = DistanceInfoAccessor().get_detour_samples(cls.MAX_SAMPLES)
+        region_factors = dict()
+        default_factor = cls.DEFAULT_DETOUR_FACTOR
+        if len(samples) > 0:
+            samples = np.array(samples, dtype=np.float64)  # zipcode, miles, latitude/longitude of each end
+            straight = Geolocation.get_euclidean_dists(samples[:, 2], samples[:, 3], samples[:, 4], samples[:, 5])
+            keep = straight >= cls.MIN_SAMPLE_MILES
+            # Roads are never shorter than a straight line, and rarely more than three times as long
+            ratios = np.clip(samples[keep, 1] / straight[keep], 1, 3)
+            regions = samples[keep, 0] // 100
+            if len(ratios) >= cls.MIN_SAMPLES:
+                default_factor = float(np.median(ratios))
+            for region in np.unique(regions):
+                region_ratios = ratios[regions == region]
+                if len(region_ratios) >= cls.MIN_SAMPLES:
+                    region_factors[int(region)] = float(np.median(region_ratios))
+
+        cls.__factors = (region_factors, default_factor)
+        cls.__factors_learned_at = time.time()
+        return cls.__factors
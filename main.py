@@ -1,10 +1,7 @@
 from geolocation import Geolocation
-from database import StoreInfoAccessor
+from catalog import StoreCatalog
 from models import Location
 from planning import TripPlanner
-from flask import Flask
-
-app = Flask(__name__)
 
 
 def find_routes_given_ingredients(user_location, ingredients):
@@ -32,24 +29,13 @@ def get_stores_near_me(my_loc, radius, number):
         :param radius: search radius (miles)
         :param number: maximum number of stores to return
     """
-    sia = StoreInfoAccessor()
-    stores = sia.get_stores_in_zip_range(my_loc.zipcode-200, my_loc.zipcode+200)
-
-    stores_in_range = []
-    euc_dists = {}
-    for s in stores:
-        dist = Geolocation.get_euclidean_dist(my_loc, s.location)
-        if dist <= radius:
-            euc_dists[s.store_id] = dist
-            stores_in_range.append(s)
-
-    # Sort according to Euclidean distance
-    stores_in_range.sort(key=lambda store: euc_dists[store.store_id])
+    if not my_loc.latitude:
+        Geolocation.load_lat_long_for_location(my_loc)
 
-    # Return the top _number_ of stores
-    return stores_in_range[:number]
+    # Stores are geocoded ahead of time (by geocode_stores.py), so any that haven't been yet are left out rather than
+    # making the user wait for them. The catalog answers from memory, so this doesn't touch the database.
+    return StoreCatalog.get_catalog().get_stores_within_radius(my_loc.latitude, my_loc.longitude, radius, number)
 
 if __name__ == '__main__':
-    with app.app_context():
-        loc = Location('1000 Olin Way', 'Needham', 'MA', 2492)
-        find_routes_given_ingredients(loc, ['A', 'B'])
+    loc = Location('1000 Olin Way', 'Needham', 'MA', 2492)
+    find_routes_given_ingredients(loc, ['A', 'B'])
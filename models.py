@@ -2,17 +2,14 @@
 
 
 class Location:
+    """ A place, identified by its address: two Location objects with the same address are equal (and hash the same),
+        whether or not their coordinates or row IDs have been filled in yet.
+    """
 
     DB_TABLE_NAME = 'locations'
 
-    id = None
-    street_address = None
-    city = None
-    state = None
-    zipcode = None
-    latitude = None
-    longitude = None
-    store_id = None
+    # Slots instead of a per-object dictionary, as a lot of these get made
+    __slots__ = ('id', 'store_id', 'street_address', 'city', 'state', 'zipcode', 'latitude', 'longitude')
 
     def __init__(self, street_address, city, state, zipcode, latitude=None, longitude=None, row_id=None, store_id=None):
         """ Creates a new Location object.
@@ -36,16 +33,26 @@ class Location:
     def __str__(self):
         return '{0}, {1}, {2} {3:05d}'.format(self.street_address, self.city, self.state, self.zipcode)
 
+    def get_address(self):
+        """ Gets the parts of the address, which is what identifies a location.
+            :return: (street address, city, state, ZIP code) - tuple
+        """
+        return self.street_address, self.city, self.state, self.zipcode
+
+    def __eq__(self, other):
+        if not isinstance(other, Location):
+            return NotImplemented
+        return self.get_address() == other.get_address()
+
+    def __hash__(self):
+        return hash(self.get_address())
+
 
 class Store:
 
     DB_TABLE_NAME = 'stores'
 
-    id = None
-    store_id = None
-    name = None
-    location = None
-    items = None
+    __slots__ = ('id', 'store_id', 'name', 'location', 'items')
 
     def __init__(self, store_id, name, location, row_id=None, items=None):
         self.id = row_id
@@ -65,13 +72,7 @@ class FoodItem:
 
     DB_TABLE_NAME = 'items'
 
-    id = None
-    aisle = None
-    category = None
-    description = None
-    item_id = None
-    image_url = None
-    name = None
+    __slots__ = ('id', 'item_id', 'name', 'aisle', 'category', 'description', 'image_url')
 
     def __init__(self, item_id, name, aisle, category, description, image_url, row_id=None):
         """
@@ -1,27 +1,63 @@
-import copy
-from geolocation import Geolocation, DistanceMapper
+import bisect
+import heapq
+import numpy as np
+from geolocation import Geolocation, DistanceMapper, EstimatedDistanceProvider
 from store_item_fetcher import StoreItemFetcher
 
 
 class TripPlanner:
 
-    def __init__(self, starting_location, distances=None):
+    # Number of routes kept (and returned) while planning
+    MAX_ROUTES = 10
+    # Largest number of candidate stores to solve exactly with dynamic programming (rather than a pruned search)
+    EXACT_SOLVER_MAX_STORES = 16
+    # Number of the best routes (each visiting a different set of stores) to measure again with real driving distances
+    RESCORED_ROUTES = 5
+
+    def __init__(self, starting_location, distances=None, max_routes=MAX_ROUTES, real_distances=None,
+                 rescored_routes=RESCORED_ROUTES):
+        """
+        :param starting_location: where the trip starts and ends - Location
+        :param distances: (optional) the DistanceMapper to search for routes with. By default, routes are searched for
+         with estimated distances, and the best ones are measured again with real driving distances. - DistanceMapper
+        :param max_routes: the number of routes to find - int
+        :param real_distances: (optional) the DistanceMapper to measure the best routes again with (by default, real
+         driving distances unless distances was given) - DistanceMapper
+        :param rescored_routes: the number of the best routes to measure again - int
+        """
         self.stores = None
         self.starting_location = starting_location
-        self.distance_mapper = distances if distances else DistanceMapper()
+        if distances:
+            self.distance_mapper = distances
+            self.real_distance_mapper = real_distances
+        else:
+            self.distance_mapper = DistanceMapper(EstimatedDistanceProvider())
+            self.real_distance_mapper = real_distances if real_distances else DistanceMapper()
+        self.max_routes = max_routes
+        self.rescored_routes = rescored_routes
+        self.__route_count = 0
+        self.__dists = None
+        self.__home_index = None
 
     def find_routes(self, needed_items, nearby_stores, max_distance, use_api=True):
-        """ Finds all the possible routes to purchase the needed items within the specified search radius.
+        """ Finds the best routes to purchase the needed items within the specified search radius.
             NOTE: The list of stores passed may include stores outside the search radius. This method will
             filter the list based on search radius before finding routes.
             :param needed_items: list of grocery items needed - [str]
             :param nearby_stores: list of nearby stores - [Store]
             :param max_distance: maximum distance (in miles) of stores from starting location to include in route - int
             :param use_api: whether or not to use the Supermarket API - bool
-            :return a list of TripPlans sorted best to worst - [TripPlan]
+            :return a list of (at most max_routes, or rescored_routes if they're measured again with real distances)
+             TripPlans sorted best to worst - [TripPlan]
         """
-        # Filter the stores to only include stores with a Euclidean distance within the specified search radius
-        self.stores = [store for store in nearby_stores if Geolocation.get_euclidean_dist(self.starting_location, store.location) <= max_distance]
+        # Filter the stores to only include stores with a Euclidean distance within the specified search radius. Stores
+        # are geocoded ahead of time (by geocode_stores.py), so any that haven't been yet are left out.
+        nearby_stores = [store for store in nearby_stores
+                         if store.location.latitude is not None and store.location.longitude is not None]
+        latitudes = np.array([store.location.latitude for store in nearby_stores], dtype=np.float64)
+        longitudes = np.array([store.location.longitude for store in nearby_stores], dtype=np.float64)
+        dists = Geolocation.get_euclidean_dists(self.starting_location.latitude, self.starting_location.longitude, latitudes, longitudes)
+        self.stores = [nearby_stores[i] for i in np.flatnonzero(dists <= max_distance)]
 
         print('Checking nearest {} stores for the needed items...'.format(len(self.stores)))
         # Load items at stores
@@ -35,70 +71,305 @@ class TripPlanner:
         # Get distances between places
         locations = [store.location for store in self.stores]
         locations.insert(0, self.starting_location)
-        self.distance_mapper.load_distances(locations, locations)
+        self.distance_mapper.load_matrix(locations)
+        # Plain lists are quicker than a numpy array for reading one distance at a time
+        self.__dists = self.distance_mapper.matrix.tolist()
+        self.__home_index = self.distance_mapper.get_index(self.starting_location)
 
         print('Planning...')
-        base_plan = TripPlan(first_stop=self.starting_location)
-        routes = self.__find_path_continuations(base_plan, [], needed_items, 2*max_distance)  # Max distance is the diameter of the circle
-        # Add returning to the starting point
-        for route in routes:
-            dist_home = self.distance_mapper.get_distance(route.last_stop.location, self.starting_location)
-            home_stop = TripStop(route.last_stop, None, self.starting_location, dist_home, None, 0)
-            route.add_stop(home_stop)
-
-        # Sort stores best to worst
-        routes.sort(key=lambda r: r.last_stop.dist_from_start)
+        max_dist_btwn_stops = 2*max_distance  # Max distance is the diameter of the circle
+        index = ItemCoverageIndex(needed_items, self.stores)
+        # The shortest route always visits exactly one minimal set of covering stores, so stores that aren't in any
+        # of those sets never need to be considered
+        covers = index.find_minimal_covers()
+        candidates = list(range(len(index.stores)))
+        if covers is not None:
+            in_any_cover = 0
+            for cover in covers:
+                in_any_cover |= cover
+            candidates = [i for i in candidates if in_any_cover & (1 << i)]
+
+        if len(candidates) <= self.EXACT_SOLVER_MAX_STORES:
+            routes = self.__find_optimal_routes(index, candidates, max_dist_btwn_stops)
+        else:
+            routes = self.__find_best_routes(index, candidates, covers, max_dist_btwn_stops)
+
+        if self.real_distance_mapper and len(routes) > 0:
+            routes = self.__rescore_routes(routes, max_dist_btwn_stops)
 
         return True, routes
 
-    def __find_path_continuations(self, base_plan, visited, items_needed, max_dist_btwn_stops):
-        """ Recursively finds all the paths to other stores starting at a given store.
-
-            :param base_plan: a TripPlan to extend - TripPlan
-            :param visited: dictionary of Stores visited (key is store ID) - [int: Store]
-            :param items_needed: list of items still needed - [string?]  # TODO Decide on type for item
-            :return list of TripPlans
-        """
-        possible_paths = list()
-        for next_store in self.stores:
-            if next_store not in visited:
-                visited_copy = copy.copy(visited)
-                visited_copy.append(next_store)
-                # Get list of items available at this store
-                items_here = next_store.items
-                # If this store doesn't have any items, skip it
-                if not items_here or len(items_here) == 0:
-                    continue
+    def __rescore_routes(self, routes, max_dist_btwn_stops):
+        """ Measures the best few routes again with real_distance_mapper, and puts them back in order by their real
+            lengths. Only the places on those routes need real distances, so this takes far fewer lookups than the
+            search itself. The rest of the routes are dropped, as their lengths can't be compared with real ones.
 
-                # Keep track of which items to get here, and which we have left to get
-                items_left = list()
-                items_to_get_here = list()
-                for item in items_needed:
-                    if item in items_here:
-                        items_to_get_here.append(item)
-                    else:
-                        items_left.append(item)
-                # Calculate distance to here from previous stop
-                distance_to_store = self.distance_mapper.get_distance(base_plan.last_stop.location, next_store.location)
-
-                # Get the score for the store
-                score = self.__get_store_score(items_here, items_needed, distance_to_store, max_dist_btwn_stops)
-
-                # Add this stop to the plan
-                base_plan_copy = copy.deepcopy(base_plan)
-
-                this_stop = TripStop(base_plan_copy.last_stop, next_store, next_store.location, distance_to_store, items_to_get_here, score)
-                base_plan_copy.add_stop(this_stop)
-                if len(items_left) > 0:
-                    # Now plan paths to all of the unvisited stores
-                    found_paths = self.__find_path_continuations(base_plan_copy, visited_copy, items_left, max_dist_btwn_stops)
-
-                    for path in found_paths:
-                        possible_paths.append(path)
+            :param routes: the routes found, best first - [TripPlan]
+            :param max_dist_btwn_stops: the maximum distance between two stops (used for scoring) - int
+            :return up to rescored_routes of the routes, sorted shortest to longest by their real lengths - [TripPlan]
+        """
+        # The same stores visited in reverse order are usually next to each other in the list, and are about as long,
+        # so only the first route visiting each set of stores is measured
+        top = list()
+        store_sets = set()
+        for route in routes:
+            if len(top) >= self.rescored_routes:
+                break
+            stops = route.get_stops_as_list()
+            store_set = frozenset(stop.store.store_id for stop in stops if stop.store)
+            if store_set not in store_sets:
+                store_sets.add(store_set)
+                top.append(stops)
+        locations = [stop.location for stops in top for stop in stops]
+        mapper = self.real_distance_mapper
+        print('Measuring the best {} routes with real distances...'.format(len(top)))
+        mapper.load_matrix(locations)
+
+        rescored = list()
+        for stops in top:
+            plan = TripPlan(first_stop=self.starting_location)
+            items_needed = [item for stop in stops if stop.items_to_get for item in stop.items_to_get]
+            for prev_stop, stop in zip(stops, stops[1:]):
+                dist = mapper.get_distance_by_index(mapper.get_index(prev_stop.location), mapper.get_index(stop.location))
+                if stop.store:
+                    score = self.__get_store_score(stop.store.items, items_needed, dist, max_dist_btwn_stops)
+                    items_needed = [item for item in items_needed if item not in stop.items_to_get]
+                    plan = plan.extend(stop.store, stop.location, dist, stop.items_to_get, score)
                 else:
-                    possible_paths.append(base_plan_copy)
+                    plan = self.__return_home(plan, dist)
+            rescored.append(plan)
+        rescored.sort(key=lambda plan: plan.last_stop.dist_from_start)
+        return rescored
+
+    def __find_optimal_routes(self, index, candidates, max_dist_btwn_stops):
+        """ Finds the provably shortest round trips that pick up all the needed items, using Held-Karp style dynamic
+            programming over (set of stores visited, store we're at). Takes O(2^n * n^2) time for n candidate stores,
+            so only use it for small sets of stores. Only the shortest order of visiting each set of stores is worked
+            out, so every route found visits a different set of stores.
+
+            :param index: the items carried by each store - ItemCoverageIndex
+            :param candidates: positions (in index.stores) of the stores that may be visited - [int]
+            :param max_dist_btwn_stops: the maximum distance between two stops (used for scoring) - int
+            :return up to max_routes TripPlans, sorted shortest to longest (empty if no route picks up everything) -
+             [TripPlan]
+        """
+        n = len(candidates)
+        stores = [index.stores[i] for i in candidates]
+        coverage = [index.store_masks[i] for i in candidates]
+        all_items = index.all_items
+        at = [self.distance_mapper.get_index(store.location) for store in stores]
+        home = self.__home_index
+        dists = [[self.__dists[a][b] for b in at] for a in at]
+        dists_from_home = [self.__dists[home][a] for a in at]
+        dists_home = [self.__dists[a][home] for a in at]
+
+        # cost[visited][j] is the shortest distance from home through all the stores in visited, ending at store j
+        inf = float('inf')
+        cost = [None] * (1 << n)
+        prev = [None] * (1 << n)
+        covered = [0] * (1 << n)
+        for j in range(n):
+            cost[1 << j] = [inf] * n
+            cost[1 << j][j] = dists_from_home[j]
+            prev[1 << j] = [None] * n
+
+        finished = list()  # (total distance, visited, last store) of the shortest route through each covering set
+        for visited in range(1, 1 << n):
+            lowest = visited & -visited
+            covered[visited] = covered[visited ^ lowest] | coverage[lowest.bit_length() - 1]
+            if cost[visited] is None:
+                continue  # Never reached, since some store along the way wouldn't have added anything new
+            if covered[visited] == all_items:
+                # Everything has been picked up, so the only thing left to do is drive home
+                finished.append(min((cost[visited][j] + dists_home[j], visited, j) for j in range(n)))
+                continue
+            for k in range(n):
+                # Only go to stores we haven't been to that supply something we still need
+                if visited & (1 << k) or not coverage[k] & ~covered[visited]:
+                    continue
+                next_visited = visited | (1 << k)
+                if cost[next_visited] is None:
+                    cost[next_visited] = [inf] * n
+                    prev[next_visited] = [None] * n
+                for j in range(n):
+                    dist = cost[visited][j] + dists[j][k]
+                    if dist < cost[next_visited][k]:
+                        cost[next_visited][k] = dist
+                        prev[next_visited][k] = j
+
+        routes = list()
+        for _, visited, j in heapq.nsmallest(self.max_routes, finished):
+            # Walk back through the table to recover the order the stores were visited in
+            order = list()
+            while j is not None:
+                order.append(j)
+                visited, j = visited ^ (1 << j), prev[visited][j]
+            order.reverse()
+
+            plan = TripPlan(first_stop=self.starting_location)
+            items_left = all_items
+            prev_stop = None
+            for j in order:
+                store = stores[j]
+                distance_to_store = dists[prev_stop][j] if prev_stop is not None else dists_from_home[j]
+                prev_stop = j
+                score = self.__get_store_score(store.items, index.get_items(items_left), distance_to_store, max_dist_btwn_stops)
+                plan = plan.extend(store, store.location, distance_to_store, index.get_items(coverage[j] & items_left), score)
+                items_left &= ~coverage[j]
+            routes.append(self.__return_home(plan, dists_home[order[-1]]))
+        return routes
+
+    def __find_best_routes(self, index, candidates, covers, max_dist_btwn_stops):
+        """ Finds the shortest round trips (starting and ending at the starting location) that pick up all the
+            needed items, using a depth-first branch-and-bound search.
+
+            :param index: the items carried by each store - ItemCoverageIndex
+            :param candidates: positions (in index.stores) of the stores that may be visited - [int]
+            :param covers: the minimal covering sets of stores, or None if there were too many to list - [int]
+            :param max_dist_btwn_stops: the maximum distance between two stops (used for scoring) - int
+            :return up to max_routes TripPlans, sorted shortest to longest - [TripPlan]
+        """
+        store_indices = [self.distance_mapper.get_index(store.location) for store in index.stores]
+        dists_home = dict((i, self.__dists[store_indices[i]][self.__home_index]) for i in candidates)
+        # For each candidate store, the stores carrying each item sorted by how far out of the way they are (going
+        # there then home instead of straight home), for working out how much further a partial route has to go
+        detours = dict()
+        for i in candidates:
+            dists_from_store = self.__dists[store_indices[i]]
+            detours[i] = [sorted((dists_from_store[store_indices[s]] + dists_home[s], s) for s in candidates
+                                 if s != i and index.store_masks[s] & (1 << bit))
+                          for bit in range(len(index.items))]
+        if covers is None:
+            # Any candidate may be visited, which is the same as every candidate making up one big "cover"
+            all_candidates = 0
+            for i in candidates:
+                all_candidates |= 1 << i
+            covers = [all_candidates]
+
+        self.__route_count = 0
+        best_routes = list()  # Heap of (-total distance, tie breaker, last store, plan) holding the best complete routes found so far
+        shortest_to_state = dict()  # The shortest few distances found to each (stores visited, store we're at)
+        base_plan = TripPlan(first_stop=self.starting_location)
+        self.__extend_route(base_plan, self.__home_index, 0, index.all_items, index, store_indices, covers, dists_home,
+                            detours, shortest_to_state, best_routes, max_dist_btwn_stops)
+
+        # Only the routes that made the cut get the trip home added
+        best_routes.sort(key=lambda r: (-r[0], r[1]))
+        return [self.__return_home(plan, dists_home[last]) for _, _, last, plan in best_routes]
+
+    def __extend_route(self, base_plan, at, visited, items_left, index, store_indices, covers, dists_home, detours,
+                       shortest_to_state, best_routes, max_dist_btwn_stops):
+        """ Recursively extends a partial route with every store that still supplies something we need, closest
+            stores first. A branch is abandoned as soon as it can't beat the worst route we're keeping: either because
+            the shortest way to finish it (going on to fetch the item that's furthest out of the way, then home) is
+            already too long, or because max_routes shorter routes have already been found to the same stores, ending
+            at the same store (which can be finished in exactly the same ways).
+
+            :param base_plan: the partial route to extend - TripPlan
+            :param at: the distance matrix index of the last stop on the partial route - int
+            :param visited: bitmask of the stores (by position in index.stores) already on the partial route - int
+            :param items_left: bitmask of the items still needed - int
+            :param index: the items carried by each store - ItemCoverageIndex
+            :param store_indices: the distance matrix index of each store in index.stores - [int]
+            :param covers: the minimal covering sets of stores that include every store visited so far - [int]
+            :param dists_home: distance from each candidate store back to the starting location - {int: float}
+            :param detours: for each candidate store, the distance via each other store carrying each item (by bit
+             position) then home, shortest first - {int: [[(float, int)]]}
+            :param shortest_to_state: the shortest distances found so far to each (visited, store) (updated in-place) -
+             {(int, int): [float]}
+            :param best_routes: heap of the best complete routes found so far (updated in-place) - [tuple]
+            :param max_dist_btwn_stops: the maximum distance between two stops (used for scoring) - int
+        """
+        dists_from_here = self.__dists[at]
+        # A store that isn't in any of the remaining covers would make the set of stores visited more than a minimal
+        # cover, and a store that doesn't supply anything new can only make the route longer
+        allowed = 0
+        for cover in covers:
+            allowed |= cover
+        allowed &= ~visited
+        options = list()
+        for i in dists_home:
+            if allowed & (1 << i) and index.store_masks[i] & items_left:
+                options.append((dists_from_here[store_indices[i]], i))
+        # Try the closest stores first so good complete routes are found (and the bound tightens) early
+        options.sort(key=lambda o: o[0])
+
+        for distance_to_store, i in options:
+            dist_so_far = base_plan.last_stop.dist_from_start + distance_to_store
+            next_visited = visited | (1 << i)
+            new_items_left = items_left & ~index.store_masks[i]
+            if len(best_routes) >= self.max_routes and dist_so_far + dists_home[i] >= -best_routes[0][0]:
+                continue  # Can't beat the routes we already have
+
+            next_covers = [cover for cover in covers if cover & (1 << i)]
+            if new_items_left:
+                # Routes that got here the same way but shorter will always stay shorter
+                shortest = shortest_to_state.setdefault((next_visited, i), [])
+                if len(shortest) >= self.max_routes and shortest[-1] <= dist_so_far:
+                    continue
+                bisect.insort(shortest, dist_so_far)
+                del shortest[self.max_routes:]
+                if len(best_routes) >= self.max_routes:
+                    dist_left = -best_routes[0][0] - dist_so_far
+                    if self.__get_dist_to_finish(next_visited, new_items_left, next_covers, detours[i], dist_left) >= dist_left:
+                        continue  # Still can't beat them once the items left have been fetched
+
+            next_store = index.stores[i]
+            score = self.__get_store_score(next_store.items, index.get_items(items_left), distance_to_store, max_dist_btwn_stops)
+            plan = base_plan.extend(next_store, next_store.location, distance_to_store, index.get_items(index.store_masks[i] & items_left), score)
+            if new_items_left:
+                self.__extend_route(plan, store_indices[i], next_visited, new_items_left, index, store_indices, next_covers,
+                                    dists_home, detours, shortest_to_state, best_routes, max_dist_btwn_stops)
+            else:
+                self.__route_count += 1
+                entry = (-(dist_so_far + dists_home[i]), self.__route_count, i, plan)
+                if len(best_routes) < self.max_routes:
+                    heapq.heappush(best_routes, entry)
+                else:
+                    heapq.heapreplace(best_routes, entry)
 
-        return possible_paths
+    @staticmethod
+    def __get_dist_to_finish(visited, items_left, covers, detours, enough=float('inf')):
+        """ Gets a lower bound on the distance left to drive to finish a partial route: every item still needed has to
+            be fetched from some store we haven't been to yet before heading home, so the route is at least as long as
+            the shortest detour via a store for the item that's hardest to get to.
+
+            :param visited: bitmask of the stores already on the partial route - int
+            :param items_left: bitmask of the items still needed - int
+            :param covers: the minimal covering sets of stores that include every store visited so far - [int]
+            :param detours: the distance via each store carrying each item then home from the last stop on the route,
+             shortest first - [[(float, int)]]
+            :param enough: (optional) stop working out the bound as soon as it gets this high - float
+            :return the lower bound (or enough, if it's at least that), or infinity if some item can't be fetched any
+             more - float
+        """
+        allowed = 0
+        for cover in covers:
+            allowed |= cover
+        allowed &= ~visited
+        dist_to_finish = 0
+        while items_left:
+            item = items_left & -items_left
+            items_left ^= item
+            for dist_via_store, s in detours[item.bit_length() - 1]:
+                if allowed & (1 << s):
+                    if dist_via_store >= enough:
+                        return enough
+                    if dist_via_store > dist_to_finish:
+                        dist_to_finish = dist_via_store
+                    break
+            else:
+                return float('inf')
+        return dist_to_finish
+
+    def __return_home(self, plan, dist_home):
+        """ Finishes a route that has picked up everything by driving back to the starting location.
+
+            :param plan: the route to finish - TripPlan
+            :param dist_home: the distance from the last store back to the starting location - float
+            :return the finished route - TripPlan
+        """
+        return plan.extend(None, self.starting_location, dist_home, None, 0)
 
     # Weights for scoring
     ITEMS_WEIGHT = 0.6
@@ -123,65 +394,154 @@ class TripPlanner:
         return distance_score#(percent_have * self.ITEMS_WEIGHT + distance_score * self.DISTANCE_WEIGHT)/(self.ITEMS_WEIGHT + self.DISTANCE_WEIGHT)
 
 
+class ItemCoverageIndex:
+    """ Planning-time index of which needed items each store carries. Every needed item gets a bit position, and each
+        store gets an integer mask of the needed items it carries, so working out what's left to buy after a stop is
+        just a bitwise operation.
+    """
+
+    # Most minimal covering sets of stores to list, and most steps to take looking for them, before giving up
+    MAX_COVERS = 5000
+    MAX_COVER_SEARCH_STEPS = 100000
+
+    def __init__(self, needed_items, stores):
+        """
+        :param needed_items: list of grocery items needed - [str]
+        :param stores: the stores that may be visited - [Store]
+        """
+        self.items = list(dict.fromkeys(needed_items))  # Drop duplicates but keep the order
+        self.item_bits = dict((item, 1 << i) for i, item in enumerate(self.items))
+        self.all_items = (1 << len(self.items)) - 1
+        # Stores that don't carry anything we need are dropped straight away
+        self.stores = list()
+        self.store_masks = list()
+        for store in stores:
+            mask = self.get_mask(store.items)
+            if mask:
+                self.stores.append(store)
+                self.store_masks.append(mask)
+        self.__search_steps_left = 0
+
+    def get_mask(self, items):
+        """ Gets the bitmask for a collection of items (items that aren't needed are ignored).
+            :param items: the items - [str]
+            :return the bitmask - int
+        """
+        mask = 0
+        for item in items if items else []:
+            mask |= self.item_bits.get(item, 0)
+        return mask
+
+    def get_items(self, mask):
+        """ Gets the items in a bitmask, in the order they were needed.
+            :param mask: the bitmask - int
+            :return the items - [str]
+        """
+        return [item for item in self.items if self.item_bits[item] & mask]
+
+    def find_minimal_covers(self, max_covers=MAX_COVERS, max_steps=MAX_COVER_SEARCH_STEPS):
+        """ Finds every minimal set of stores that together carry all the needed items (i.e. no store could be left
+            out and still have every item covered).
+            :param max_covers: the most covering sets to list - int
+            :param max_steps: the most partial sets of stores to look at while searching - int
+            :return bitmasks of store positions (in self.stores), or None if there were more than max_covers or they
+             took more than max_steps to find - [int]
+        """
+        covers = set()
+        item_stores = [[i for i, mask in enumerate(self.store_masks) if mask & (1 << bit)]
+                       for bit in range(len(self.items))]
+        self.__search_steps_left = max_steps
+        if not self.__add_covers(0, 0, 0, [], covers, set(), max_covers, item_stores):
+            return None
+        return list(covers)
+
+    def __add_covers(self, chosen, covered, covered_twice, chosen_masks, covers, searched, max_covers, item_stores):
+        """ Recursively finds the minimal covering sets by picking, in turn, each store that carries the item not yet
+            covered that the fewest stores carry. A set is abandoned as soon as one of its stores is no longer needed
+            (everything it carries is carried by another store in the set too), as adding more stores can't make it
+            minimal again, so only minimal covers are ever reached. The same set can be reached in more than one
+            order, but is only searched from once.
+            :param chosen: bitmask of the stores chosen so far - int
+            :param covered: bitmask of the items carried by at least one of them - int
+            :param covered_twice: bitmask of the items carried by at least two of them - int
+            :param chosen_masks: the items carried by each of them - [int]
+            :param searched: the sets of stores already searched from (updated in-place) - {int}
+            :return False if more than max_covers were found or the search ran out of steps, otherwise True - bool
+        """
+        self.__search_steps_left -= 1
+        if self.__search_steps_left < 0:
+            return False
+        missing = self.all_items & ~covered
+        if not missing:
+            covers.add(chosen)
+            return len(covers) <= max_covers
+        stores_for_item = min((item_stores[bit] for bit in range(len(self.items)) if missing & (1 << bit)), key=len)
+        for i in stores_for_item:
+            next_chosen = chosen | (1 << i)
+            if chosen & (1 << i) or next_chosen in searched:
+                continue
+            searched.add(next_chosen)
+            mask = self.store_masks[i]
+            next_covered_twice = covered_twice | (covered & mask)
+            # Each store needs to carry something no other store in the set does
+            if any(not chosen_mask & ~next_covered_twice for chosen_mask in chosen_masks):
+                continue
+            chosen_masks.append(mask)
+            found_all = self.__add_covers(next_chosen, covered | mask, next_covered_twice, chosen_masks, covers, searched,
+                                          max_covers, item_stores)
+            chosen_masks.pop()
+            if not found_all:
+                return False
+        return True
+
+
 class TripPlan:
+    """ A route. Plans are never modified once created: each one only knows its last stop, and every stop points
+        back at the stop before it. Extending a plan makes a new plan in constant time, and plans extended from the
+        same route share all of that route's stops instead of copying them.
+    """
 
     def __init__(self, **options):
         if 'first_stop' in options:  # We're starting a new route, and we know our first stop
             first_stop_location = options['first_stop']
-            self.first_stop = TripStop(None, None, first_stop_location, 0, None, 1)
-            self.last_stop = self.first_stop
-            self.score = self.first_stop.score
+            self.last_stop = TripStop(None, None, first_stop_location, 0, None, 1)
+            self.score = self.last_stop.score
         else:  # We're starting a new route, but we don't know our first stop yet
-            self.first_stop = None
             self.last_stop = None
             self.score = 0
 
-    def add_stop(self, new_stop):
-        """ Adds a new stop to the plan.
+    def extend(self, store, location, dist_from_prev, items_to_get, score):
+        """ Creates a new plan that continues this one with one more stop. This plan is left unchanged.
 
-            :param new_stop: the new stop - TripStop
+            :param store: store at the new stop (None if it isn't a store) - Store
+            :param location: the location of the new stop - Location
+            :param dist_from_prev: distance from the current last stop - float
+            :param items_to_get: the items to get at the new stop - [str]
+            :param score: score of the new stop - float
+            :return the extended plan - TripPlan
         """
-        if self.first_stop:  # Check if we already have at least one stop
-            self.last_stop.next_stop = new_stop
-            self.last_stop = new_stop
-        else:  # No existing stops, so this is our first one
-            self.first_stop = new_stop
-            self.last_stop = new_stop
-        self.score += new_stop.score
+        plan = TripPlan()
+        plan.last_stop = TripStop(self.last_stop, store, location, dist_from_prev, items_to_get, score)
+        plan.score = self.score + score
+        return plan
 
     def get_stops_as_list(self):
-        """ Returns a list of the stops. """
-        stop = self.first_stop
+        """ Returns a list of the stops, first to last. """
+        stop = self.last_stop
         res = list()
         while stop:
             res.append(stop)
-            stop = stop.next_stop
+            stop = stop.prev_stop
+        res.reverse()
         return res
 
-    @staticmethod
-    def combine(first_plan, second_plan):
-        """ Combines the two TripPlans into one. """
-        first_plan.last_stop = second_plan.first_stop
-        second_plan.first_stop = first_plan.last_stop
-        return first_plan
-
-    @staticmethod
-    def clone(first_stop):
-        """ Creates a new copy this plan.
-
-            :param first_stop: the first stop in the trip
-            :return a new TripPlan with the same attributes as the old one
-        """
-        first_stop_new = TripStop(None, first_stop.store, first_stop.store.location, first_stop.dist_from_prev, first_stop.items_to_get, first_stop.score)
-        prev_stop = first_stop_new
-        while prev_stop.next_stop:
-            prev_stop.next_stop = TripStop(prev_stop.prev_stop, prev_stop.store, prev_stop.store.location, prev_stop.dist_from_prev, prev_stop.items_to_get, prev_stop.score)
-        return first_stop_new
-
 
 class TripStop:
     """ Node for planning trips """
 
+    # Slots instead of a per-object dictionary, as route searches make a lot of these
+    __slots__ = ('prev_stop', 'store', 'location', 'dist_from_prev', 'dist_from_start', 'items_to_get', 'score')
+
     def __init__(self, prev_stop, store, location, dist_from_prev, items_to_get, score):
         """
         :param prev_stop: previous stop on this trip - TripStop
@@ -197,7 +557,6 @@ class TripStop:
         self.dist_from_start = (prev_stop.dist_from_start + dist_from_prev) if prev_stop else dist_from_prev
         self.items_to_get = items_to_get
         self.score = score
-        self.next_stop = None
 
     def get_items_as_string(self):
         """ Returns the items as a nicely formatted string for display to the user. """
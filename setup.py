@@ -5,7 +5,13 @@ print('Downloading stores in Boston area...')
 StoreDbUpdater(2000, 3000, 100)
 print('Done downloading stores\n')
 
+print('Geocoding stores...')
+from geocode_stores import geocode_stores
+geocode_stores()
+print('Done geocoding stores\n')
+
 print('Importing grocery UPC data...')
 import food_db_import
+food_db_import.import_upc_data()
 print('Done importing grocery UPC data')
 print('App is ready to use')
\ No newline at end of file
@@ -1,8 +1,11 @@
-from models import Location, Store
 from supermarket_api_base import SupermarketAPIBase
+import supermarket_xml
+import asyncio
+import random
 import threading
+import time
+import aiohttp
 import requests
-import untangle
 
 
 class StoreFetcher(SupermarketAPIBase):
@@ -16,35 +19,138 @@ class StoreFetcher(SupermarketAPIBase):
         """ Fetches all of the stores for a given zip code
 
             :param zipcode: the zip code - int
-            :returns a list of Stores found - list<Store>
+            :returns a list of Stores found, or None if the request failed - list<Store>
         """
         # Build URL to make API call
         url = self.build_url(self.REQUEST_NAME, ZipCode=zipcode)
         # Request data from server (XML)
-        xml_str = requests.get(url, headers=self.HEADERS).text
-        # Parse XML into an XML object
-        xml = untangle.parse(xml_str)
+        try:
+            response = requests.get(url, headers=self.HEADERS, timeout=AsyncStoreFetcher.REQUEST_TIMEOUT)
+        except requests.exceptions.RequestException as e:
+            print('ZIP code {0:05}: {1!r}'.format(zipcode, e))
+            return None
+        if response.status_code != 200:
+            print('ZIP code {0:05}: HTTP {1}'.format(zipcode, response.status_code))
+            return None
+        try:
+            return self.parse_stores(response.content)
+        except supermarket_xml.ParseError as e:
+            print('ZIP code {0:05}: invalid response ({1})'.format(zipcode, e))
+            return None
 
-        stores = list()
+    @staticmethod
+    def parse_stores(xml):
+        """ Parses a StoresByZip response.
 
-        try:
-            # Create a Store object for each XML element and add it to the list
-            for elem in xml.ArrayOfStore.Store:
-                store_id = elem.StoreId.cdata
-                name = elem.Storename.cdata.strip()
-                address = elem.Address.cdata.strip()
-                city = elem.City.cdata.strip()
-                state = elem.State.cdata.strip()
-                zip_str = elem.Zip.cdata.strip()[:5]
-                zipcode = int(zip_str) if len(zip_str) > 0 else None
-                # phone = elem.Phone.cdata.strip()
-                loc = Location(address, city, state, zipcode)
-                store = Store(store_id, name, loc)
-                stores.append(store)
-        except IndexError:
-            pass
-
-        return stores
+            :param xml: the XML returned by the API - string or bytes
+            :returns a list of Stores found - list<Store>
+            :raises supermarket_xml.ParseError: if the response isn't an ArrayOfStore (e.g. an error message)
+        """
+        return list(supermarket_xml.iter_stores(xml))
+
+
+class AsyncStoreFetcher(SupermarketAPIBase):
+    """ Crawls stores for many ZIP codes at once using asyncio. All the requests share one pool of kept-alive
+        connections, at most `concurrency` are in flight at a time, they're spaced out to stay under a
+        requests-per-second limit, and failed requests are retried with exponential backoff.
+    """
+
+    DEFAULT_CONCURRENCY = 20
+    DEFAULT_REQUESTS_PER_SECOND = 50
+    DEFAULT_RETRIES = 3
+    RETRY_BASE_DELAY = 0.5  # Seconds to wait before the first retry (doubled for each retry after that)
+    REQUEST_TIMEOUT = 30  # Seconds
+
+    def __init__(self, api_key, concurrency=DEFAULT_CONCURRENCY, requests_per_second=DEFAULT_REQUESTS_PER_SECOND,
+                 retries=DEFAULT_RETRIES, url_base=SupermarketAPIBase.URL_BASE):
+        """
+        :param api_key: the Supermarket API key - string
+        :param concurrency: the most requests to have going at once - int
+        :param requests_per_second: the most requests to start each second (0 for no limit) - float
+        :param retries: the number of times to retry a failed request - int
+        :param url_base: (optional) the base URL of the API, e.g. to point at a local test server - string
+        """
+        super().__init__(api_key, url_base)
+        self.concurrency = concurrency
+        self.requests_per_second = requests_per_second
+        self.retries = retries
+        self.__next_request_time = 0
+        self.__rate_lock = None
+
+    def crawl(self, zipcodes, handle_stores):
+        """ Fetches the stores in each ZIP code, passing them on as soon as each ZIP code is done.
+
+            :param zipcodes: the ZIP codes to fetch stores for - iterable<int>
+            :param handle_stores: called with (zipcode, stores) for each ZIP code fetched - function
+            :returns the ZIP codes that couldn't be fetched even after retrying - list<int>
+        """
+        return asyncio.run(self.crawl_async(zipcodes, handle_stores))
+
+    async def crawl_async(self, zipcodes, handle_stores):
+        """ Coroutine version of crawl. """
+        zipcodes = iter(zipcodes)
+        failed = list()
+        self.__next_request_time = 0
+        self.__rate_lock = asyncio.Lock()
+        timeout = aiohttp.ClientTimeout(total=self.REQUEST_TIMEOUT)
+        connector = aiohttp.TCPConnector(limit=self.concurrency)
+        async with aiohttp.ClientSession(headers=self.HEADERS, timeout=timeout, connector=connector) as session:
+            # A fixed number of workers pull ZIP codes as they go, so memory use doesn't grow with the size of the range
+            workers = [self.__crawl_worker(session, zipcodes, handle_stores, failed) for _ in range(self.concurrency)]
+            await asyncio.gather(*workers)
+        return failed
+
+    async def __crawl_worker(self, session, zipcodes, handle_stores, failed):
+        """ Fetches ZIP codes one after another until there are none left. """
+        for zipcode in zipcodes:
+            stores = await self.fetch_all_stores_in_zip(session, zipcode)
+            if stores is None:
+                failed.append(zipcode)
+            else:
+                handle_stores(zipcode, stores)
+
+    async def fetch_all_stores_in_zip(self, session, zipcode):
+        """ Fetches all of the stores for a given zip code, retrying if the request fails.
+
+            :param session: the HTTP session to use - aiohttp.ClientSession
+            :param zipcode: the zip code - int
+            :returns a list of Stores found, or None if the request kept failing - list<Store>
+        """
+        url = self.build_url(StoreFetcher.REQUEST_NAME, ZipCode=zipcode)
+        for attempt in range(self.retries + 1):
+            if attempt > 0:
+                await asyncio.sleep(self.RETRY_BASE_DELAY * 2**(attempt - 1) * random.uniform(1, 1.5))
+            await self.__wait_for_rate_limit()
+            try:
+                async with session.get(url) as response:
+                    if response.status >= 500 or response.status == 429:
+                        print('ZIP code {0:05} attempt {1}: HTTP {2}'.format(zipcode, attempt + 1, response.status))
+                        continue
+                    if response.status != 200:
+                        # Not worth retrying (e.g. the API key was rejected)
+                        print('ZIP code {0:05}: HTTP {1}'.format(zipcode, response.status))
+                        return None
+                    xml = await response.read()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                print('ZIP code {0:05} attempt {1}: {2!r}'.format(zipcode, attempt + 1, e))
+                continue
+            try:
+                return StoreFetcher.parse_stores(xml)
+            except supermarket_xml.ParseError as e:
+                print('ZIP code {0:05}: invalid response ({1})'.format(zipcode, e))
+                return None
+        return None
+
+    async def __wait_for_rate_limit(self):
+        """ Waits until the next request can be started without going over the requests-per-second limit. """
+        if not self.requests_per_second:
+            return
+        async with self.__rate_lock:
+            now = time.monotonic()
+            start_time = max(now, self.__next_request_time)
+            self.__next_request_time = start_time + 1/self.requests_per_second
+        if start_time > now:
+            await asyncio.sleep(start_time - now)
 
 
 class StoresDS:
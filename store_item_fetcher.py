@@ -1,43 +1,65 @@
-import untangle
-import requests
-from xml.sax._exceptions import SAXParseException
+import itertools
 import threading
-from database import FoodItemInfoAccessor
+import time
+import requests
+import supermarket_xml
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from database import ConnectionPool, FoodItemInfoAccessor, StoreItemInfoAccessor
 from import_keys import *
 
 
 class StoreItemFetcher:
 
-    def __init__(self, use_api=False):
+    MAX_LOOKUP_THREADS = 32  # Most Supermarket API requests to have going at once, across all route requests
+    DEFAULT_MAX_WORKERS = 16  # Most Supermarket API requests to have going at once for one route request
+    DEFAULT_DEADLINE = 30  # Seconds to wait for all the lookups for a route request
+    REQUEST_TIMEOUT = 10  # Seconds to wait for any one Supermarket API request
+    DEFAULT_CACHE_TTL = 7*24*3600  # Seconds to trust a saved lookup for
+    DEFAULT_CACHE_STALE_TTL = 7*24*3600  # Seconds after that to keep using it while it's looked up again in the background
+    MAX_SAVED_ITEM_IDS = 10  # Most matching item IDs to save for each lookup
+
+    # One HTTP session shared by every lookup, so connections to the API get reused
+    session = requests.Session()
+    session.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=MAX_LOOKUP_THREADS))
+
+    # Does the lookups for every route request, so the number of threads doesn't grow with the number of requests
+    lookup_executor = ThreadPoolExecutor(max_workers=MAX_LOOKUP_THREADS)
+
+    # Looks stale lookups up again in the background, without holding up the requests that used them
+    refresh_executor = ThreadPoolExecutor(max_workers=2)
+    refreshing = set()  # (store ID, ingredient) pairs being looked up again
+    refreshing_lock = threading.Lock()
+
+    def __init__(self, use_api=False, max_workers=DEFAULT_MAX_WORKERS, deadline=DEFAULT_DEADLINE,
+                 cache_ttl=DEFAULT_CACHE_TTL, cache_stale_ttl=DEFAULT_CACHE_STALE_TTL):
         """
         Initializes a StoreItemFetcher to get information about items at stores.
         :param use_api: if True, will use the Supermarket API, otherwise just uses the grocery UPC database from grocery.com
+        :param max_workers: the most Supermarket API requests to have going at once - int
+        :param deadline: the most seconds to spend checking stores with the Supermarket API - float
+        :param cache_ttl: the seconds a saved Supermarket API lookup is used for before looking it up again - float
+        :param cache_stale_ttl: the seconds after cache_ttl that a saved lookup is still used, while it's looked up again
+         in the background - float
         """
         self.use_api = use_api
-
+        self.max_workers = max_workers
+        self.deadline = deadline
+        self.cache_ttl = cache_ttl
+        self.cache_stale_ttl = cache_stale_ttl
 
     def check_stores_for_ingredients(self, ingredients, stores):
         """ Given a list of stores objects and ingredients returns dictionary of ingredients with stores_ids as values"""
 
         if self.use_api:  # Use Supermarket API
-            main_thread = threading.current_thread()
-            for store in stores:
-                for ing in ingredients:
-                    # StoreItemFetcher._check_store_for_items(store, ing)
-                    t = threading.Thread(target=StoreItemFetcher._check_store_for_items, args=(store, ing))
-                    t.start()
-
-                # Wait till all threads finish before continuing
-                for t in threading.enumerate():
-                    if t is not main_thread:
-                        t.join()
-                print('Finished processing store')
+            for store, ingredient, has_item in self.iter_store_items(ingredients, stores):
+                if has_item and ingredient not in store.items:
+                    store.items.append(ingredient)
 
         else:  # Use the local database
             fia = FoodItemInfoAccessor()
             store_groups = self.__filter_stores_and_group(stores)
             for ingredient in ingredients:
-                results = fia.get_foods_by_name(ingredient)
+                results = fia.search_foods(ingredient)
                 if len(results) > 0:
                     print('Added food to {} stores'.format(self.__add_food_to_appropriate_stores(results, store_groups, ingredient)))
                 else:
@@ -96,44 +118,151 @@ class StoreItemFetcher:
         return added_count
 
 
+    def iter_store_items(self, ingredients, stores):
+        """ Checks whether each store has each ingredient. Lookups saved within the last cache_ttl seconds are used
+            as they are. Ones saved within cache_stale_ttl seconds before that are used too, but looked up again in the
+            background. The rest are looked up with the Supermarket API, with at most max_workers requests going at
+            once, and saved. Results are yielded as they arrive; any lookups still unfinished when the deadline passes
+            are abandoned.
+            :param ingredients: the ingredients to look for - [str]
+            :param stores: the stores to check - [Store]
+            :return a generator of (store, ingredient, whether the store has it) tuples - (Store, str, bool)
+        """
+        normalized = dict((ingredient, self.normalize_ingredient(ingredient)) for ingredient in ingredients)
+        sia = StoreItemInfoAccessor()
+        saved = sia.get_store_items([store.store_id for store in stores], list(normalized.values()))
+        now = time.time()
+
+        to_look_up = list()
+        stale = list()
+        for store in stores:
+            for ingredient in ingredients:
+                key = (store.store_id, normalized[ingredient])
+                saved_lookup = saved.get(key)
+                age = now - saved_lookup[2] if saved_lookup else None
+                if saved_lookup and age <= self.cache_ttl + self.cache_stale_ttl:
+                    if age > self.cache_ttl:
+                        stale.append(key)
+                    yield store, ingredient, saved_lookup[0]
+                else:
+                    to_look_up.append((store, ingredient))
+        if stale:
+            self.__refresh_in_background(stale)
+        if len(to_look_up) == 0:
+            return
+
+        # Lookups are handed to the shared executor a few at a time, so one request can't take all of its threads, and
+        # ones that haven't been handed over yet can simply be dropped if the deadline passes
+        deadline = time.monotonic() + self.deadline
+        to_look_up = iter(to_look_up)
+        lookups = dict()
+        found = list()
+        try:
+            while True:
+                for store, ingredient in itertools.islice(to_look_up, self.max_workers - len(lookups)):
+                    lookup = StoreItemFetcher.lookup_executor.submit(StoreItemFetcher.fetch_store_item_ids,
+                                                                     normalized[ingredient], store.store_id)
+                    lookups[lookup] = (store, ingredient)
+                if len(lookups) == 0:
+                    break
+                done, _ = wait(lookups, timeout=deadline - time.monotonic(), return_when=FIRST_COMPLETED)
+                if len(done) == 0:
+                    print('Gave up on {} store lookups after {}s'.format(len(lookups) + sum(1 for _ in to_look_up), self.deadline))
+                    break
+                for lookup in done:
+                    store, ingredient = lookups.pop(lookup)
+                    item_ids = lookup.result()
+                    if item_ids is not None:  # Failed lookups aren't saved, so they're tried again next time
+                        found.append((store.store_id, normalized[ingredient], len(item_ids) > 0, item_ids, time.time()))
+                    yield store, ingredient, bool(item_ids)
+        finally:
+            for lookup in lookups:
+                lookup.cancel()
+            sia.save_store_items(found)
+
     @staticmethod
-    def _check_store_for_items(store, ingredient):
-        """ Checks if each store has each item. If it does, it adds it to the list of items attached to the store object. """
-        print('Checking store for ingredient {}'.format(ingredient))
-        if StoreItemFetcher.does_store_have_item(ingredient, store.store_id):
-            store.items.append(ingredient)
-        print('Done checking store')
+    def __refresh_in_background(keys):
+        """ Looks up (store ID, ingredient) pairs again and saves the results, without waiting for them. Pairs that
+            are already being looked up again are skipped.
+        """
+        with StoreItemFetcher.refreshing_lock:
+            keys = [key for key in keys if key not in StoreItemFetcher.refreshing]
+            StoreItemFetcher.refreshing.update(keys)
+        if keys:
+            StoreItemFetcher.refresh_executor.submit(StoreItemFetcher.__refresh, keys)
+
+    @staticmethod
+    def __refresh(keys):
+        """ Looks up (store ID, ingredient) pairs and saves the results (runs in the background). """
+        try:
+            found = list()
+            for store_id, ingredient in keys:
+                item_ids = StoreItemFetcher.fetch_store_item_ids(ingredient, store_id)
+                if item_ids is not None:
+                    found.append((store_id, ingredient, len(item_ids) > 0, item_ids, time.time()))
+            StoreItemInfoAccessor().save_store_items(found)
+        except Exception as e:
+            print('Refreshing {} store lookups failed: {!r}'.format(len(keys), e))
+        finally:
+            ConnectionPool.release_connection()
+            with StoreItemFetcher.refreshing_lock:
+                StoreItemFetcher.refreshing.difference_update(keys)
+
+    @staticmethod
+    def normalize_ingredient(ingredient):
+        """ Puts an ingredient in a standard form (lowercase, single spaces), so that lookups are saved under the same
+            name however it was typed.
+            :param ingredient: the ingredient - string
+            :return: the normalized ingredient - string
+        """
+        return ' '.join(ingredient.lower().split())
 
     @staticmethod
     def does_store_have_item(ingredient, store_id):
         """Given an ingredient and a store id, returns True is item is at that store and False if it is not"""
+        # Only parses as far as the first product
+        return bool(StoreItemFetcher.__search_store(ingredient, store_id, supermarket_xml.has_products))
+
+    @staticmethod
+    def fetch_store_item_ids(ingredient, store_id):
+        """ Looks up which items matching an ingredient a store has with the Supermarket API.
+            :param ingredient: the ingredient - string
+            :param store_id: the Supermarket API ID of the store - string
+            :return the IDs of the first MAX_SAVED_ITEM_IDS matching items (empty if the store doesn't have the
+             ingredient), or None if the lookup failed - [string]
+        """
+        def parse_item_ids(xml):
+            # Only parses as far as the products that are kept
+            products = itertools.islice(supermarket_xml.iter_products(xml), StoreItemFetcher.MAX_SAVED_ITEM_IDS)
+            return [product['item_id'] for product in products]
+        return StoreItemFetcher.__search_store(ingredient, store_id, parse_item_ids)
+
+    @staticmethod
+    def __search_store(ingredient, store_id, parse):
+        """ Searches a store for an ingredient with the Supermarket API.
+            :param ingredient: the ingredient - string
+            :param store_id: the Supermarket API ID of the store - string
+            :param parse: reads what's needed from the response (a SearchForItem response) - function
+            :return what parse returned, or None if the lookup failed
+        """
         #store_id is store id
-        foods_at_store = []
         url = StoreItemFetcher.format_food_url(store_id, ingredient)
         try:
-            xml_string = requests.get(url, timeout=10).text
+            xml = StoreItemFetcher.session.get(url, timeout=StoreItemFetcher.REQUEST_TIMEOUT).content
         except requests.exceptions.Timeout:
             print('Request timed out')
-            return False
+            return None
+        except requests.exceptions.RequestException as e:
+            print('Request failed for store {} looking for {}: {}'.format(store_id, ingredient, e))
+            return None
         try:
-            foods = untangle.parse(xml_string)
-        except SAXParseException as e:
+            return parse(xml)
+        except supermarket_xml.ParseError as e:
             print('Invalid response received for store {} looking for {}'.format(store_id, ingredient))
             print('Request URL: ', url)
-            print('Response: ', xml_string)
+            print('Response: ', xml)
             print(e)
-            return False
-        for item in foods.ArrayOfProduct.Product:
-            f = {
-                'category': item.ItemCategory.cdata,
-                'item_id': item.ItemID.cdata,
-                'name': item.Itemname.cdata
-            }
-            foods_at_store.append(f)
-        if len(foods_at_store) > 0:
-            return True
-        else:
-            return False
+            return None
 
 
     @staticmethod
@@ -145,29 +274,23 @@ class StoreItemFetcher:
         return base_url + SUPERMARKET_API_KEY + store + food
 
 if __name__ == '__main__':
-    from flask import Flask, g
     from main import get_stores_near_me
     from models import Location
     from geolocation import Geolocation
     from planning import TripPlanner
 
-    app = Flask(__name__)
-    with app.app_context():
-
-        needed_items = ['apples', 'cashews', 'butternut squash']
+    needed_items = ['apples', 'cashews', 'butternut squash']
 
-        try:
-            user_loc = Location('1000 Olin Way', 'Needham', 'MA', 2492)
-            Geolocation.load_lat_long_for_location(user_loc)
-            stores = get_stores_near_me(user_loc, 10, 20)
-            # sif = StoreItemFetcher(False)
-            # sif.check_stores_for_ingredients(needed_items, stores)
-            planner = TripPlanner(user_loc)
-            plans = planner.find_routes(needed_items, stores, 20, False)
-            for plan in plans:
-                print(plan)
+    try:
+        user_loc = Location('1000 Olin Way', 'Needham', 'MA', 2492)
+        Geolocation.load_lat_long_for_location(user_loc)
+        stores = get_stores_near_me(user_loc, 10, 20)
+        # sif = StoreItemFetcher(False)
+        # sif.check_stores_for_ingredients(needed_items, stores)
+        planner = TripPlanner(user_loc)
+        plans = planner.find_routes(needed_items, stores, 20, False)
+        for plan in plans:
+            print(plan)
 
-        finally:
-            db = getattr(g, '_database', None)
-            if db:
-                db.close()
+    finally:
+        ConnectionPool.release_connection()
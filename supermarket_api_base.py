@@ -4,8 +4,13 @@ class SupermarketAPIBase:
     URL_BASE = 'http://www.SupermarketAPI.com/api.asmx/'
     API_KEY_URL_PARAM = 'APIKEY'
 
-    def __init__(self, api_key):
+    def __init__(self, api_key, url_base=URL_BASE):
+        """
+        :param api_key: the Supermarket API key - string
+        :param url_base: (optional) the base URL of the API, e.g. to point at a local test server - string
+        """
         self.api_key = api_key
+        self.url_base = url_base
 
     def build_url(self, request_type, **params):
         """ Builds a request URL
@@ -14,7 +19,7 @@ class SupermarketAPIBase:
             :param params: the parameters to include in the request - <string,string>
             :returns the full URL for the request as a string - string
         """
-        url = '%s%s?%s=%s' % (self.URL_BASE, request_type, self.API_KEY_URL_PARAM, self.api_key)
+        url = '%s%s?%s=%s' % (self.url_base, request_type, self.API_KEY_URL_PARAM, self.api_key)
         for param, val in params.items():
             url = '%s&%s=%s' % (url, param, val)
 
@@ -0,0 +1,80 @@
+""" Streaming parsers for the XML responses of the Supermarket API. Records are read one at a time as the response is
+    parsed, so a big response never has to be held as a whole tree, and a caller that only needs the first record can
+    stop without parsing the rest.
+"""
+
+import io
+import xml.etree.ElementTree as ET
+from models import Location, Store
+
+# Raised for responses that aren't valid XML, or aren't the kind of response expected
+ParseError = ET.ParseError
+
+
+def iter_records(xml, record_tag, root_tag=None):
+    """ Reads the records in a response one at a time.
+        :param xml: the response - string or bytes
+        :param record_tag: the tag of the elements holding each record (e.g. 'Store') - string
+        :param root_tag: (optional) the tag the root element must have (e.g. 'ArrayOfStore'). The API answers some bad
+         requests (like ones with an invalid key) with a different root element and no records, which would otherwise
+         look just like a response with no records. - string
+        :return: a generator of records, each a dictionary of the text in the record's child elements keyed by their
+         tags (without namespaces) - dict<string,string>
+        :raises ParseError: if the response isn't valid XML, or root_tag is given and the response is empty or has a
+         different root element
+    """
+    if isinstance(xml, str):
+        xml = xml.encode('utf-8')
+    if len(xml.strip()) == 0:
+        # An empty response has no records, but isn't the kind of response expected either
+        if root_tag is not None:
+            raise ParseError('Expected an {} element but the response was empty'.format(root_tag))
+        return
+    root = None
+    for event, elem in ET.iterparse(io.BytesIO(xml), events=('start', 'end')):
+        if root is None:
+            root = elem
+            if root_tag is not None and _local_name(root.tag) != root_tag:
+                raise ParseError('Expected an {} element but got {}'.format(root_tag, _local_name(root.tag)))
+        elif event == 'end' and _local_name(elem.tag) == record_tag:
+            yield dict((_local_name(child.tag), child.text or '') for child in elem)
+            # Let go of the records already read, so memory use doesn't grow with the size of the response
+            root.clear()
+
+
+def iter_stores(xml):
+    """ Reads the stores in a StoresByZip response one at a time.
+        :param xml: the response (an ArrayOfStore) - string or bytes
+        :return: a generator of the stores found - Store
+    """
+    for record in iter_records(xml, 'Store', 'ArrayOfStore'):
+        zip_str = record.get('Zip', '').strip()[:5]
+        zipcode = int(zip_str) if len(zip_str) > 0 else None
+        loc = Location(record.get('Address', '').strip(), record.get('City', '').strip(), record.get('State', '').strip(), zipcode)
+        yield Store(record.get('StoreId', ''), record.get('Storename', '').strip(), loc)
+
+
+def iter_products(xml):
+    """ Reads the products in a SearchForItem response one at a time.
+        :param xml: the response (an ArrayOfProduct) - string or bytes
+        :return: a generator of the products found, each with a 'category', 'item_id' and 'name' - dict<string,string>
+    """
+    for record in iter_records(xml, 'Product', 'ArrayOfProduct'):
+        yield {
+            'category': record.get('ItemCategory', ''),
+            'item_id': record.get('ItemID', ''),
+            'name': record.get('Itemname', ''),
+        }
+
+
+def has_products(xml):
+    """ Checks whether a SearchForItem response has any products, only parsing as far as the first one.
+        :param xml: the response (an ArrayOfProduct) - string or bytes
+        :return: True if there is at least one product - bool
+    """
+    return next(iter_products(xml), None) is not None
+
+
+def _local_name(tag):
+    """ Removes the namespace from a tag (e.g. '{http://www.SupermarketAPI.com}Store' becomes 'Store') """
+    return tag.rsplit('}', 1)[-1]
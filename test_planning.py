@@ -0,0 +1,160 @@
+""" Checks the routes the trip planner finds against the shortest routes found by trying every possible route.
+    Run with: python -m unittest test_planning
+"""
+
+import itertools
+import os
+import random
+import unittest
+from unittest import mock
+
+# The planner imports the API keys, but never needs them here
+for key in ('SUPERMARKET_API_KEY', 'KEY_GEO', 'KEY_DIST', 'KEY_DIRECT', 'RECIPE_API_KEY', 'YUMMLY_API_KEY',
+            'MAPS_API_KEY', 'MAPS_EMBED_KEY'):
+    os.environ.setdefault(key, '')
+
+import planning
+from geolocation import DistanceMapper, DistanceProvider, EstimatedDistanceProvider
+from models import Location, Store
+
+
+class DetourDistanceProvider(DistanceProvider):
+    """ Distances as the crow flies, except that getting to every other store takes twice as long. """
+
+    def load_matrix(self, locations):
+        detours = [2 if loc.id is not None and loc.id % 2 == 0 else 1 for loc in locations]
+        return super().load_matrix(locations) * detours
+
+
+class TripPlannerTest(unittest.TestCase):
+
+    def make_trip(self, seed, store_count, item_count, chance, zipcodes=(2492,)):
+        """ Makes a random set of stores around home, each carrying each item with the given chance, and each in one
+            of the given ZIP codes (home is in the first).
+        """
+        rnd = random.Random(seed)
+        home = Location('1 Home St', 'Boston', 'MA', zipcodes[0], 42.0, -71.0)
+        items = ['item {}'.format(i) for i in range(item_count)]
+        stores = list()
+        for s in range(store_count):
+            loc = Location('{} Main St'.format(s), 'Boston', 'MA', rnd.choice(zipcodes),
+                           42 + rnd.uniform(-0.2, 0.2), -71 + rnd.uniform(-0.2, 0.2), s + 1)
+            stores.append(Store(str(s), 'Store {}'.format(s), loc, s + 1,
+                                items=[item for item in items if rnd.random() < chance]))
+        return home, items, stores
+
+    def find_routes(self, home, items, stores, exact_solver_max_stores, max_routes=planning.TripPlanner.MAX_ROUTES,
+                    real_distances=None, provider=None):
+        """ Plans routes with the given size limit for the exact solver (with straight-line distances by default). """
+        provider = provider if provider else DistanceProvider()
+        planner = planning.TripPlanner(home, DistanceMapper(provider), max_routes=max_routes,
+                                       real_distances=real_distances)
+        fetcher = mock.Mock()
+        fetcher.check_stores_for_ingredients.side_effect = lambda needed_items, stores: (True, stores)
+        with mock.patch.object(planning, 'StoreItemFetcher', return_value=fetcher), \
+                mock.patch.object(planning.TripPlanner, 'EXACT_SOLVER_MAX_STORES', exact_solver_max_stores):
+            found, routes = planner.find_routes(items, stores, 100, use_api=False)
+        self.assertTrue(found)
+        return routes
+
+    def find_shortest_route(self, home, items, stores, provider=None):
+        """ Finds the length of the shortest route that picks up every item by trying every order of every set of
+            stores.
+        """
+        provider = provider if provider else DistanceProvider()
+        dists = provider.load_matrix([home] + [store.location for store in stores])
+        shortest = float('inf')
+        for count in range(1, len(stores) + 1):
+            for order in itertools.permutations(range(1, len(stores) + 1), count):
+                if set(items) <= set(item for i in order for item in stores[i - 1].items):
+                    stops = (0,) + order + (0,)
+                    shortest = min(shortest, sum(dists[a][b] for a, b in zip(stops, stops[1:])))
+        return shortest
+
+    def check_route(self, route, items):
+        """ Checks that a route picks up every item and ends back home. """
+        stops = route.get_stops_as_list()
+        self.assertIsNone(stops[0].store)
+        self.assertIsNone(stops[-1].store)
+        picked_up = [item for stop in stops[1:-1] for item in stop.items_to_get]
+        self.assertCountEqual(picked_up, items)
+        for stop in stops[1:-1]:
+            self.assertTrue(set(stop.items_to_get) <= set(stop.store.items))
+
+    def test_matches_brute_force(self):
+        for seed in range(25):
+            home, items, stores = self.make_trip(seed, 7, 5, 0.3)
+            if not all(any(item in store.items for store in stores) for item in items):
+                continue
+            shortest = self.find_shortest_route(home, items, stores)
+            # Keeping fewer routes makes the search prune more
+            for exact_solver_max_stores, max_routes in itertools.product((0, len(stores)), (1, 3, 10)):
+                with self.subTest(seed=seed, exact_solver_max_stores=exact_solver_max_stores, max_routes=max_routes):
+                    routes = self.find_routes(home, items, stores, exact_solver_max_stores, max_routes)
+                    self.assertLessEqual(len(routes), max_routes)
+                    self.assertAlmostEqual(routes[0].last_stop.dist_from_start, shortest, places=4)
+                    lengths = [route.last_stop.dist_from_start for route in routes]
+                    self.assertEqual(lengths, sorted(lengths))
+                    for route in routes:
+                        self.check_route(route, items)
+
+    def test_search_matches_exact_solver(self):
+        for seed in range(10):
+            home, items, stores = self.make_trip(seed, 14, 8, 0.2)
+            if not all(any(item in store.items for store in stores) for item in items):
+                continue
+            with self.subTest(seed=seed):
+                exact = self.find_routes(home, items, stores, len(stores))
+                searched = self.find_routes(home, items, stores, 0, max_routes=1)
+                self.assertAlmostEqual(exact[0].last_stop.dist_from_start,
+                                       searched[0].last_stop.dist_from_start, places=4)
+
+    def test_search_keeps_best_routes(self):
+        for seed in range(10):
+            home, items, stores = self.make_trip(seed, 14, 8, 0.2)
+            if not all(any(item in store.items for store in stores) for item in items):
+                continue
+            with self.subTest(seed=seed):
+                # Pruning harder to keep fewer routes mustn't lose any of the best ones
+                few = self.find_routes(home, items, stores, 0, max_routes=3)
+                many = self.find_routes(home, items, stores, 0, max_routes=10)
+                for a, b in zip(few, many):
+                    self.assertAlmostEqual(a.last_stop.dist_from_start, b.last_stop.dist_from_start, places=4)
+
+    def test_estimated_distances_match_brute_force(self):
+        # Stores in regions that learned different detour factors than home's
+        detour_factors = ({24: 1.0, 25: 2.0, 26: 1.25}, 1.5)
+        with mock.patch.object(EstimatedDistanceProvider, 'get_detour_factors', return_value=detour_factors):
+            for seed in range(25):
+                home, items, stores = self.make_trip(seed, 7, 5, 0.3, (2492, 2592, 2692))
+                if not all(any(item in store.items for store in stores) for item in items):
+                    continue
+                shortest = self.find_shortest_route(home, items, stores, EstimatedDistanceProvider())
+                for exact_solver_max_stores in (0, len(stores)):
+                    with self.subTest(seed=seed, exact_solver_max_stores=exact_solver_max_stores):
+                        routes = self.find_routes(home, items, stores, exact_solver_max_stores, max_routes=1,
+                                                  provider=EstimatedDistanceProvider())
+                        self.assertAlmostEqual(routes[0].last_stop.dist_from_start, shortest, places=3)
+
+    def test_rescored_routes_are_measured(self):
+        for seed in range(10):
+            home, items, stores = self.make_trip(seed, 14, 6, 0.25)
+            if not all(any(item in store.items for store in stores) for item in items):
+                continue
+            for exact_solver_max_stores in (0, len(stores)):
+                with self.subTest(seed=seed, exact_solver_max_stores=exact_solver_max_stores):
+                    routes = self.find_routes(home, items, stores, exact_solver_max_stores,
+                                              real_distances=DistanceMapper(DetourDistanceProvider()))
+                    self.assertLessEqual(len(routes), planning.TripPlanner.RESCORED_ROUTES)
+                    lengths = [route.last_stop.dist_from_start for route in routes]
+                    self.assertEqual(lengths, sorted(lengths))
+                    for route in routes:
+                        self.check_route(route, items)
+                        stops = [stop.location for stop in route.get_stops_as_list()]
+                        dists = DetourDistanceProvider().load_matrix(stops)
+                        self.assertAlmostEqual(route.last_stop.dist_from_start,
+                                               sum(dists[i][i + 1] for i in range(len(stops) - 1)), places=4)
+
+
+if __name__ == '__main__':
+    unittest.main()
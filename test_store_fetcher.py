@@ -0,0 +1,130 @@
+""" Checks the store crawler against a local stand-in for the Supermarket API.
+    Run with: python -m unittest test_store_fetcher
+"""
+
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+from urllib.parse import parse_qs, urlparse
+
+from store_fetcher import AsyncStoreFetcher
+
+STORES_XML = '<?xml version="1.0" encoding="utf-8"?>' \
+             '<ArrayOfStore xmlns="http://www.SupermarketAPI.com">{}</ArrayOfStore>'
+STORE_XML = '<Store><Storename>Store {0}</Storename><Address>{0} Main St</Address><City>Needham</City>' \
+            '<State>MA</State><Zip>{1:05}</Zip><Phone /><StoreId>{1:x}{0}</StoreId></Store>'
+# What the API answers with when it doesn't like a request
+ERROR_XML = '<?xml version="1.0" encoding="utf-8"?>' \
+            '<string xmlns="http://www.SupermarketAPI.com">Invalid API key</string>'
+
+
+class StubSupermarketAPI:
+    """ Answers StoresByZip requests with two stores per ZIP code, except for the ZIP codes given special answers.
+        Remembers when each request for each ZIP code came in.
+    """
+
+    def __init__(self):
+        self.answers = dict()  # ZIP code -> the (status, body) to answer each request with, the last one repeating
+        self.requests = dict()  # ZIP code -> the times its requests came in
+        self.lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                zipcode = int(parse_qs(urlparse(self.path).query)['ZipCode'][0])
+                with stub.lock:
+                    times = stub.requests.setdefault(zipcode, list())
+                    times.append(time.monotonic())
+                    answers = stub.answers.get(zipcode, [(200, None)])
+                    status, body = answers[min(len(times), len(answers)) - 1]
+                if body is None:
+                    body = STORES_XML.format(''.join(STORE_XML.format(i, zipcode) for i in range(2)))
+                body = body.encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'text/xml; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.url_base = 'http://127.0.0.1:{}/api.asmx/'.format(self.server.server_address[1])
+        self.thread = threading.Thread(target=self.server.serve_forever, args=(0.05,), daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class AsyncStoreFetcherTest(unittest.TestCase):
+
+    RETRY_BASE_DELAY = 0.05
+
+    def setUp(self):
+        self.api = StubSupermarketAPI()
+        self.addCleanup(self.api.close)
+        patcher = mock.patch.object(AsyncStoreFetcher, 'RETRY_BASE_DELAY', self.RETRY_BASE_DELAY)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def crawl(self, zipcodes, **kwargs):
+        """ Crawls the stub API, returning the stores found by ZIP code and the ZIP codes that failed. """
+        fetcher = AsyncStoreFetcher('key', url_base=self.api.url_base, **kwargs)
+        found = dict()
+        failed = fetcher.crawl(zipcodes, lambda zipcode, stores: found.setdefault(zipcode, stores))
+        return found, failed
+
+    def test_fetches_stores(self):
+        found, failed = self.crawl(range(2490, 2500), retries=0)
+        self.assertEqual(failed, [])
+        self.assertCountEqual(found.keys(), range(2490, 2500))
+        for zipcode, stores in found.items():
+            self.assertEqual([store.name for store in stores], ['Store 0', 'Store 1'])
+            self.assertTrue(all(store.location.zipcode == zipcode for store in stores))
+
+    def test_retries_server_errors_with_backoff(self):
+        self.api.answers[2492] = [(500, ''), (503, ''), (200, None)]
+        self.api.answers[2493] = [(500, '')]
+        found, failed = self.crawl([2491, 2492, 2493], retries=2, requests_per_second=0)
+        self.assertEqual(failed, [2493])
+        self.assertCountEqual(found.keys(), [2491, 2492])
+        self.assertEqual(len(found[2492]), 2)
+        for zipcode in (2492, 2493):
+            times = self.api.requests[zipcode]
+            self.assertEqual(len(times), 3)
+            # Each retry waits at least twice as long as the one before
+            for attempt, (a, b) in enumerate(zip(times, times[1:])):
+                self.assertGreaterEqual(b - a, 0.9 * self.RETRY_BASE_DELAY * 2**attempt)
+
+    def test_error_responses_fail_without_retrying(self):
+        self.api.answers[2492] = [(200, ERROR_XML)]
+        self.api.answers[2493] = [(404, '')]
+        self.api.answers[2494] = [(200, '')]
+        found, failed = self.crawl(range(2491, 2496), retries=2)
+        self.assertCountEqual(failed, [2492, 2493, 2494])
+        self.assertCountEqual(found.keys(), [2491, 2495])
+        for zipcode in failed:
+            self.assertEqual(len(self.api.requests[zipcode]), 1)
+
+    def test_rate_limit(self):
+        requests_per_second = 40
+        zipcodes = range(2400, 2420)
+        found, failed = self.crawl(zipcodes, concurrency=10, requests_per_second=requests_per_second)
+        self.assertEqual(failed, [])
+        times = sorted(t for zip_times in self.api.requests.values() for t in zip_times)
+        self.assertEqual(len(times), len(zipcodes))
+        # Allow for the requests taking different amounts of time to get to the server
+        self.assertGreaterEqual(times[-1] - times[0], 0.9 * (len(times) - 1) / requests_per_second)
+        for i in range(len(times) - requests_per_second // 4):
+            # No burst of requests goes faster than the limit either
+            self.assertGreaterEqual(times[i + requests_per_second // 4] - times[i], 0.2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,46 +4,65 @@
     to the database.
 """
 
-from store_fetcher import StoreFetcher
-from database import StoreInfoAccessor, LocationInfoAccessor, DatabaseCreator
+from store_fetcher import StoreFetcher, AsyncStoreFetcher
+from database import StoreInfoAccessor, CrawlProgressAccessor, DatabaseCreator
 import math
 import threading
 import time
 import argparse
-from flask import Flask
 from import_keys import *
 
-app = Flask(__name__)
-
 LOWEST_ZIP = 501
 HIGHEST_ZIP = 99950
 DEFAULT_WORKERS = 100
+DEFAULT_CHECKPOINT_TTL = 24  # Hours before a checkpointed crawl fetches a ZIP code again
+CHECKPOINT_BATCH_SIZE = 100  # ZIP codes to download before saving them
 
 
 class StoreDbUpdater:
 
-    def __init__(self, start_zip, end_zip, worker_count):
+    def __init__(self, start_zip, end_zip, worker_count, use_wal=False, use_async=False,
+                 requests_per_second=AsyncStoreFetcher.DEFAULT_REQUESTS_PER_SECOND, checkpoint=False,
+                 checkpoint_ttl=DEFAULT_CHECKPOINT_TTL, sync=False):
         """ Downloads all the stores in the given ZIP range.
             :param start_zip: the starting ZIP code - int
             :param end_zip: the ending ZIP code (also scanned) - int
             :param worker_count: the number of simultaneous requests to make
+            :param use_wal: if True, switches the database to write-ahead logging for faster saving - bool
+            :param use_async: if True, downloads with asyncio over kept-alive connections instead of one thread per worker - bool
+            :param requests_per_second: the most requests to start each second when use_async is True (0 for no limit) - float
+            :param checkpoint: if True, saves the stores as each batch of ZIP codes finishes, and skips ZIP codes that
+             were crawled within the last checkpoint_ttl hours, so a crawl that stopped part way can be resumed (always
+             downloads with asyncio) - bool
+            :param checkpoint_ttl: how many hours a checkpointed ZIP code counts as up to date - float
+            :param sync: if True, updates the stores that are already saved (only writing the ones that changed) and
+             removes the ones that are gone, rather than only adding new stores - bool
         """
 
-        with app.app_context():
-            # Create a database if one does not already exist
-            if not os.path.exists(StoreInfoAccessor.DATABASE_PATH):
-                dc = DatabaseCreator()
-                dc.init_db()
+        # Create the database (or any tables and indexes missing from it)
+        dc = DatabaseCreator()
+        dc.init_db()
+
+        if checkpoint:
+            self.__crawl_with_checkpoints(start_zip, end_zip, worker_count, use_wal, requests_per_second, checkpoint_ttl, sync)
+            return
+
+        start_time = time.time()
 
-            start_time = time.time()
+        # Initialize data structure to store results in
+        sd = StoresDS()
 
+        if use_async:
+            sf = AsyncStoreFetcher(SUPERMARKET_API_KEY, worker_count, requests_per_second)
+            failed = sf.crawl(range(start_zip, end_zip + 1), lambda zipcode, stores: sd.add_stores(stores, zipcode))
+        else:
+            failed = sd.failed
             # Break up ZIP codes
             zip_range = end_zip - start_zip + 1
             zips_per_worker = math.ceil(zip_range / worker_count)
 
-            # Initialize API interface and data structure to store results in
+            # Initialize API interface
             sf = StoreFetcher(SUPERMARKET_API_KEY)
-            sd = StoresDS()
 
             # Start threads to parallelize downloads
             for i in range(worker_count):
@@ -62,34 +81,69 @@ class StoreDbUpdater:
             for t in threading.enumerate():
                 if t is not main_thread:
                     t.join()
+        if failed:
+            print('Could not fetch stores for {} ZIP codes: {}'.format(len(failed), ', '.join('{:05}'.format(z) for z in sorted(failed))))
+
+        # Calculate how long it took to download (in seconds)
+        dl_duration = time.time() - start_time
+        # Print out results
+        print("Downloaded data for {0} stores in {1:0.3f}s".format(len(sd.stores_dict), dl_duration))
+        print("Average speed (using {0} workers): {1:0.3f} ms/request".format(worker_count, dl_duration/(end_zip-start_zip+1)*1000))
+
+        # Save the data
+        print('Saving data...')
+        start_time = time.time()
+
+        sia = StoreInfoAccessor()
+        if use_wal:
+            sia.use_write_ahead_log()
+        if sync:
+            # Only the ZIP codes that were downloaded are checked for removed stores (not ones that failed, which
+            # would otherwise look like they had no stores left)
+            diff = sia.sync_stores(list(sd.stores_dict.values()), sd.zipcodes)
+            print_sync_report(diff)
+        else:
+            # Only add the stores that aren't saved yet, so downloading a range again doesn't duplicate them
+            saved = sia.get_saved_store_ids(sd.stores_dict.keys())
+            new_stores = [store for store_id, store in sd.stores_dict.items() if store_id not in saved]
+            sia.save_stores(new_stores)
+            print('Added {} new stores'.format(len(new_stores)))
+
+        # Calculate how long it took to run (in seconds)
+        save_duration = time.time() - start_time
+        # Print out results
+        print("Saved in {0:0.3f}s".format(save_duration))
+
+    @staticmethod
+    def __crawl_with_checkpoints(start_zip, end_zip, worker_count, use_wal, requests_per_second, checkpoint_ttl, sync):
+        """ Downloads and saves all the stores in the given ZIP range a batch at a time (see __init__). """
+        sia = StoreInfoAccessor()
+        if use_wal:
+            sia.use_write_ahead_log()
+        cpa = CrawlProgressAccessor(sia.db)
+
+        # Skip the ZIP codes that are already up to date
+        up_to_date = cpa.get_crawled_zipcodes(start_zip, end_zip, time.time() - checkpoint_ttl*3600)
+        zipcodes = (zipcode for zipcode in range(start_zip, end_zip + 1) if zipcode not in up_to_date)
+        to_crawl = end_zip - start_zip + 1 - len(up_to_date)
+        print('Skipping {0} ZIP codes crawled in the last {1:g} hours, {2} to go'.format(len(up_to_date), checkpoint_ttl, to_crawl))
+
+        start_time = time.time()
+        cp = CrawlCheckpoint(sia, cpa, to_crawl, sync=sync)
+        sf = AsyncStoreFetcher(SUPERMARKET_API_KEY, worker_count, requests_per_second)
+        try:
+            failed = sf.crawl(zipcodes, cp.add_stores)
+        finally:
+            # Save whatever was downloaded, even if the crawl was interrupted
+            cp.save()
 
-            # Calculate how long it took to download (in seconds)
-            dl_duration = time.time() - start_time
-            # Print out results
-            print("Downloaded data for {0} stores in {1:0.3f}s".format(len(sd.stores_dict), dl_duration))
-            print("Average speed (using {0} threads): {1:0.3f} ms/request".format(worker_count, dl_duration/(end_zip-start_zip)/1000))
-
-            # Save the data
-            print('Saving data...')
-            start_time = time.time()
-
-            sia = StoreInfoAccessor()
-            lia = LocationInfoAccessor(sia.db)
-            for store in sd.stores_dict.values():
-                # print(store)
-                lia.save_location(store.location)
-                store.location_id = store.location.id
-                sia.save_store(store)
-                # Update the store ID reference
-                # print('Store ID: {}'.format(store.location.store_id))
-
-                store.location.store_id = store.id
-                lia.save_location(store.location)
-
-            # Calculate how long it took to run (in seconds)
-            save_duration = time.time() - start_time
-            # Print out results
-            print("Saved in {0:0.3f}s".format(save_duration))
+        duration = time.time() - start_time
+        print('Crawled {0} ZIP codes and added {1} new stores in {2:0.3f}s'.format(cp.zipcodes_saved, cp.stores_added, duration))
+        if sync:
+            print_sync_report(cp.sync_diff)
+        if failed:
+            print('Could not fetch stores for {} ZIP codes (they will be retried next time): {}'
+                  .format(len(failed), ', '.join('{:05}'.format(z) for z in sorted(failed))))
 
     @staticmethod
     def __download_stores_in_range(start_zip, end_zip, fetcher, store_ds):
@@ -103,16 +157,91 @@ class StoreDbUpdater:
         thread_name = threading.current_thread().getName()
         for zipcode in range(start_zip, end_zip):
             new_stores = fetcher.fetch_all_stores_in_zip(zipcode)
-            store_ds.add_stores(new_stores)
+            if new_stores is None:
+                store_ds.add_failed_zipcode(zipcode)
+                continue
+            store_ds.add_stores(new_stores, zipcode)
             print('{0} fetched {1} stores for ZIP code {2:05}'.format(thread_name, len(new_stores), zipcode))
 
         # print('Fetched data for {0:01d} stores'.format(len(sd.stores_dict)))
 
 
+class CrawlCheckpoint:
+
+    def __init__(self, store_info_accessor, crawl_progress_accessor, zipcode_count=None, batch_size=CHECKPOINT_BATCH_SIZE,
+                 sync=False):
+        """ Collects the stores downloaded for a batch of ZIP codes, then saves them along with the ZIP codes that are
+            done in one transaction. Only one batch is kept in memory at a time.
+
+            :param store_info_accessor: the accessor to save the stores with - StoreInfoAccessor
+            :param crawl_progress_accessor: the accessor to record the ZIP codes with (using the same connection) - CrawlProgressAccessor
+            :param zipcode_count: (optional) the number of ZIP codes being crawled, for showing progress - int
+            :param batch_size: the number of ZIP codes to collect before saving - int
+            :param sync: if True, syncs each batch with the saved stores (see StoreInfoAccessor.sync_stores) rather than
+             only adding new stores - bool
+        """
+        self.sia = store_info_accessor
+        self.cpa = crawl_progress_accessor
+        self.zipcode_count = zipcode_count
+        self.batch_size = batch_size
+        self.stores_dict = {}
+        self.store_counts = {}
+        self.zipcodes_saved = 0
+        self.stores_added = 0
+        self.sync = sync
+        self.sync_diff = {'added': [], 'changed': [], 'removed': [], 'unchanged': 0, 'duplicates': 0}
+
+    def add_stores(self, zipcode, stores):
+        """ Adds the stores downloaded for a ZIP code, saving the batch if it's full.
+
+            :param zipcode: the ZIP code - int
+            :param stores: the stores found in it - list<Store>
+        """
+        for store in stores:
+            self.stores_dict.setdefault(store.store_id, store)
+        self.store_counts[zipcode] = len(stores)
+        if len(self.store_counts) >= self.batch_size:
+            self.save()
+
+    def save(self):
+        """ Saves the stores in the current batch that aren't already in the database, and marks its ZIP codes as done. """
+        if len(self.store_counts) == 0:
+            return
+        db = self.sia.db
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            if self.sync:
+                # Stores are found by the ZIP code they're in, so any saved in this batch's ZIP codes that weren't
+                # downloaded are gone
+                diff = self.sia.sync_stores(list(self.stores_dict.values()), set(self.store_counts.keys()))
+                for key, val in diff.items():
+                    self.sync_diff[key] += val
+                new_count = len(diff['added'])
+            else:
+                saved = self.sia.get_saved_store_ids(self.stores_dict.keys())
+                new_stores = [store for store_id, store in self.stores_dict.items() if store_id not in saved]
+                self.sia.save_stores(new_stores)
+                new_count = len(new_stores)
+            self.cpa.save_crawled_zipcodes(self.store_counts, time.time(), False)
+        except Exception:
+            db.rollback()
+            raise
+        db.commit()
+
+        self.zipcodes_saved += len(self.store_counts)
+        self.stores_added += new_count
+        progress = '{}/{}'.format(self.zipcodes_saved, self.zipcode_count) if self.zipcode_count else self.zipcodes_saved
+        print('Saved {0} ZIP codes ({1} new stores), {2} done'.format(len(self.store_counts), new_count, progress))
+        self.stores_dict = {}
+        self.store_counts = {}
+
+
 class StoresDS:
 
     def __init__(self):
         self.stores_dict = {}
+        self.zipcodes = set()
+        self.failed = list()
         self.lock = threading.Lock()
 
     def add_store(self, store):
@@ -134,13 +263,42 @@ class StoresDS:
             self.lock.release()
 
 
-    def add_stores(self, stores):
+    def add_stores(self, stores, zipcode=None):
         """ Adds multiple stores to the data set. Just a masked call to add_store, so same add/update behavior.
 
             :param stores: stores to add to the data set - list<Store>
+            :param zipcode: (optional) the ZIP code the stores were downloaded for, to record that it's done - int
         """
         for store in stores:
             self.add_store(store)
+        if zipcode is not None:
+            with self.lock:
+                self.zipcodes.add(zipcode)
+
+    def add_failed_zipcode(self, zipcode):
+        """ Records a ZIP code whose stores couldn't be downloaded, so it isn't treated as having no stores.
+
+            :param zipcode: the ZIP code - int
+        """
+        with self.lock:
+            self.failed.append(zipcode)
+
+
+def print_sync_report(diff, max_listed=20):
+    """ Prints what changed in a sync (see StoreInfoAccessor.sync_stores).
+
+        :param diff: the changes - dict
+        :param max_listed: the most store IDs to list for each kind of change - int
+    """
+    print('Stores added: {0}, changed: {1}, removed: {2}, unchanged: {3}'
+          .format(len(diff['added']), len(diff['changed']), len(diff['removed']), diff['unchanged']))
+    for key in ('added', 'changed', 'removed'):
+        store_ids = diff[key]
+        if store_ids:
+            more = ' and {} more'.format(len(store_ids) - max_listed) if len(store_ids) > max_listed else ''
+            print('  {0}: {1}{2}'.format(key.capitalize(), ', '.join(store_ids[:max_listed]), more))
+    if diff['duplicates']:
+        print('  Removed {} duplicate store rows'.format(diff['duplicates']))
 
 """ Make it so we can run this script and pass parameters from the command line """
 if __name__ == '__main__':
@@ -170,6 +328,48 @@ if __name__ == '__main__':
         default=DEFAULT_WORKERS,
         type=int,
     )
+    parser.add_argument(
+        '--wal',
+        action='store_true',
+        dest='use_wal',
+        help='use write-ahead logging (faster saving, and the web app can keep reading while saving)',
+    )
+
+    parser.add_argument(
+        '--async',
+        action='store_true',
+        dest='use_async',
+        help='download with asyncio, reusing connections (--workers sets how many requests are in flight)',
+    )
+    parser.add_argument(
+        '--rps',
+        action='store',
+        dest='requests_per_second',
+        default=AsyncStoreFetcher.DEFAULT_REQUESTS_PER_SECOND,
+        type=float,
+        help='the most requests to start each second when using --async (0 for no limit)',
+    )
+    parser.add_argument(
+        '--checkpoint',
+        action='store_true',
+        dest='checkpoint',
+        help='save progress as the crawl goes and skip recently crawled ZIP codes, so it can be stopped and resumed (uses asyncio)',
+    )
+    parser.add_argument(
+        '--ttl',
+        action='store',
+        dest='checkpoint_ttl',
+        default=DEFAULT_CHECKPOINT_TTL,
+        type=float,
+        help='with --checkpoint, the hours before a ZIP code is crawled again',
+    )
+    parser.add_argument(
+        '--sync',
+        action='store_true',
+        dest='sync',
+        help='update changed stores and remove stores that are gone, rather than only adding new ones',
+    )
 
     args = parser.parse_args()
-    sdu = StoreDbUpdater(args.start_zip, args.end_zip, args.workers)
+    sdu = StoreDbUpdater(args.start_zip, args.end_zip, args.workers, args.use_wal, args.use_async, args.requests_per_second,
+                         args.checkpoint, args.checkpoint_ttl, args.sync)
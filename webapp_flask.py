@@ -8,13 +8,17 @@ from geolocation import Geolocation
 from flask import render_template, request, send_from_directory
 from models import Location
 from main import find_routes_given_ingredients
-from database import DatabaseAccessor
+from database import ConnectionPool, DatabaseAccessor, DatabaseCreator
+from catalog import StoreCatalog
 
 HOST = '0.0.0.0' if 'PORT' in os.environ else '127.0.0.1'
 PORT = int(os.environ.get('PORT', 5000))
 
 app = Flask(__name__)
 
+# Give each request's database connection back to the pool once the request is done
+app.teardown_appcontext(ConnectionPool.release_connection)
+
 @app.route('/')
 def starting_page():
     return render_template('home.html')
@@ -190,4 +194,7 @@ def get_html_for_stop(stop, i):
 if __name__ == '__main__':
     # HOST = '0.0.0.0' if 'PORT' in os.environ else '127.0.0.1'
     # PORT = int(os.environ.get('PORT', 5000))
+    DatabaseCreator().init_db()
+    StoreCatalog.get_catalog()  # Load the stores now, rather than during the first request
+    ConnectionPool.release_connection()
     app.run(host=HOST, port=PORT)